@@ -1,26 +1,64 @@
 from datetime import date, datetime, timedelta
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
+import base64
+import binascii
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from io import BytesIO
+import hashlib
+import json
+import multiprocessing
+import os
 import re
+import zipfile
 
-from flask import Flask, jsonify, request, send_file
+import click
+from flask import Flask, jsonify, request, send_file, stream_with_context, url_for
 from flask_cors import CORS
 from flask_migrate import Migrate
+from sqlalchemy import (
+    Numeric,
+    and_,
+    bindparam,
+    case,
+    cast,
+    func,
+    insert,
+    literal,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import undefer
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 from werkzeug.wrappers import Response
 
-from openpyxl import Workbook
+from openpyxl import Workbook, load_workbook
+from PIL import Image, UnidentifiedImageError
 from openpyxl.styles import Alignment, Font, PatternFill
 from openpyxl.utils import get_column_letter
+from openpyxl.utils.exceptions import InvalidFileException
 
+import cartera
 from config import Config
+from idempotencia import Idempotencia
+from instrumentation import init_instrumentation
 from models import (
     Bancos,
+    CarteraVencimiento,
     CategoriaProducto,
     Cliente,
     ConsumoMateriaPrima,
     ConsumoProductoComponente,
+    EnvioOrden,
+    EnvioOrdenItem,
     EstadoOrden,
+    FotoProducto,
+    KpiProcesoDiario,
+    KpiProductoDiario,
+    ListaPrecio,
+    ListaPrecioItem,
     MateriaPrima,
     MateriaPrimaAjuste,
     Permiso,
@@ -37,6 +75,7 @@ from models import (
     OrdenItem,
     db,
 )
+from trabajos import ArchivoTrabajo, ColaTrabajos, respuesta_encolado
 
 
 
@@ -54,11 +93,18 @@ def create_app():
 
     db.init_app(app)
     migrate.init_app(app, db)
+    init_instrumentation(app)
+    cola_trabajos = ColaTrabajos(app)
+    idempotencia = Idempotencia(app)
 
     @app.route("/")
     def index():
         return jsonify({"message": "API funcionando"})
 
+    @app.errorhandler(413)
+    def request_demasiado_grande(exc):
+        return jsonify({"error": "El archivo excede el tamaño permitido"}), 413
+
     @app.route("/auth/login", methods=["POST"])
     def login():
         """
@@ -93,6 +139,36 @@ def create_app():
             }
         )
 
+    # ---------- CACHE HTTP (ETag) ----------
+
+    def _version_tabla(model) -> str:
+        """Version barata de una tabla: count + max(actualizado_en).
+
+        Cualquier alta, baja o modificacion (via onupdate) cambia el resultado.
+        """
+        columna = (
+            model.actualizada_en
+            if hasattr(model, "actualizada_en")
+            else model.actualizado_en
+        )
+        total, ultima = db.session.query(func.count(model.id), func.max(columna)).one()
+        return f"{total}:{ultima.isoformat() if ultima else ''}"
+
+    def _etag_catalogo(*modelos) -> str:
+        partes = [request.path, request.query_string.decode()]
+        partes.extend(_version_tabla(m) for m in modelos)
+        return hashlib.sha1("|".join(partes).encode()).hexdigest()
+
+    def _respuesta_condicional(etag: str, construir):
+        """Responde 304 si el cliente ya tiene la version; si no, serializa."""
+        if request.if_none_match.contains(etag):
+            resp = app.response_class(status=304)
+        else:
+            resp = jsonify(construir())
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "no-cache"
+        return resp
+
     # ---------- CRUD PRODUCTOS ----------
 
     def categoria_to_dict(categoria: CategoriaProducto) -> dict:
@@ -166,11 +242,19 @@ def create_app():
         db.session.commit()
         return jsonify({"message": "Categoría eliminada"})
 
-    def producto_to_dict(producto: Producto) -> dict:
-        return {
+    def producto_to_dict(producto: Producto, incluir_foto: bool = False) -> dict:
+        foto_archivo = producto.foto_archivo
+        data = {
             "id": producto.id,
             "nombre": producto.nombre,
-            "foto": producto.foto,
+            "foto_url": url_for("obtener_foto_producto", hash_foto=foto_archivo.hash)
+            if foto_archivo
+            else None,
+            "foto_miniatura_url": url_for(
+                "obtener_miniatura_foto_producto", hash_foto=foto_archivo.hash
+            )
+            if foto_archivo
+            else None,
             "codigo": producto.codigo,
             "categoria_id": producto.categoria_id,
             "activo": producto.activo,
@@ -187,6 +271,74 @@ def create_app():
             if producto.actualizado_en
             else None,
         }
+        if incluir_foto:
+            data["foto"] = producto.foto
+        return data
+
+    def _generar_miniatura(contenido: bytes):
+        try:
+            imagen = Image.open(BytesIO(contenido))
+            imagen.load()
+        except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+            raise ValueError("La foto no es una imagen válida")
+
+        mimetype = Image.MIME.get(imagen.format or "", "application/octet-stream")
+        lado = app.config.get("FOTO_MINIATURA_PX", 256)
+        miniatura = imagen.copy()
+        miniatura.thumbnail((lado, lado))
+        buffer = BytesIO()
+        if miniatura.mode in ("RGBA", "LA", "P"):
+            miniatura.save(buffer, format="PNG", optimize=True)
+            miniatura_mimetype = "image/png"
+        else:
+            miniatura.convert("RGB").save(buffer, format="JPEG", quality=85)
+            miniatura_mimetype = "image/jpeg"
+        return mimetype, buffer.getvalue(), miniatura_mimetype
+
+    def _guardar_foto(contenido: bytes) -> FotoProducto:
+        """Guarda la imagen una sola vez por contenido y genera su miniatura."""
+        if not contenido:
+            raise ValueError("La foto está vacía")
+        hash_foto = hashlib.sha256(contenido).hexdigest()
+        existente = FotoProducto.query.filter_by(hash=hash_foto).first()
+        if existente:
+            return existente
+        mimetype, miniatura, miniatura_mimetype = _generar_miniatura(contenido)
+        foto = FotoProducto(
+            hash=hash_foto,
+            mimetype=mimetype,
+            contenido=contenido,
+            miniatura=miniatura,
+            miniatura_mimetype=miniatura_mimetype,
+        )
+        db.session.add(foto)
+        db.session.flush()
+        return foto
+
+    def _decodificar_data_uri(valor: str) -> bytes:
+        _, _, datos = valor.partition(",")
+        try:
+            return base64.b64decode(datos, validate=False)
+        except (binascii.Error, ValueError):
+            raise ValueError("La foto no es un data URI base64 válido")
+
+    def _asignar_foto_producto(producto: Producto, valor) -> None:
+        """Los data URI se mueven a fotos_producto; una URL se guarda tal cual
+        solo si el producto no tiene foto subida.
+
+        Un valor vacio o null no borra la foto (los clientes reenvian el objeto
+        tal como lo recibieron); para quitarla esta DELETE /productos/<id>/foto.
+        """
+        valor = valor.strip() if isinstance(valor, str) else None
+        if not valor:
+            return
+        if valor.startswith("data:"):
+            foto = _guardar_foto(_decodificar_data_uri(valor))
+            producto.foto_id = foto.id
+            producto.foto = None
+        elif producto.foto_id is None:
+            producto.foto = valor
+
 
     @app.route("/productos", methods=["GET"])
     def listar_productos():
@@ -209,13 +361,25 @@ def create_app():
                 q = q.filter(Producto.es_terminado == es_terminado)
 
         # Si solo quieres productos que realmente esten usados como componente
+        modelos_version = [Producto]
         if _parse_bool(request.args.get("solo_componentes_usados"), default=False):
             q = q.join(
                 ProductoComponente, Producto.id == ProductoComponente.componente_id
             ).distinct()
-
-        productos = q.order_by(Producto.id).all()
-        return jsonify([producto_to_dict(p) for p in productos])
+            modelos_version.append(ProductoComponente)
+
+        # La foto legada puede ser un data URI enorme; solo se envía si se pide.
+        incluir_foto = _parse_bool(request.args.get("incluir_foto"), default=False)
+        if incluir_foto:
+            q = q.options(undefer(Producto.foto))
+
+        return _respuesta_condicional(
+            _etag_catalogo(*modelos_version),
+            lambda: [
+                producto_to_dict(p, incluir_foto=incluir_foto)
+                for p in q.order_by(Producto.id).all()
+            ],
+        )
 
     @app.route("/productos/<int:producto_id>", methods=["GET"])
     def obtener_producto(producto_id: int):
@@ -236,16 +400,18 @@ def create_app():
         if isinstance(value, str) and not value.strip():
             return default
         try:
-            return Decimal(str(value))
-        except (TypeError, ValueError):
+            numero = Decimal(str(value))
+        except (TypeError, ValueError, InvalidOperation):
+            raise ValueError(f"El campo {field_name} debe ser numérico")
+        if not numero.is_finite():
             raise ValueError(f"El campo {field_name} debe ser numérico")
+        return numero
 
     @app.route("/productos", methods=["POST"])
     def crear_producto():
         data = request.get_json(silent=True) or {}
         nombre = (data.get("nombre") or "").strip()
         codigo = (data.get("codigo") or "").strip()
-        foto = (data.get("foto") or "").strip() or None
         categoria_id = data.get("categoria_id")
         activo = _parse_bool(data.get("activo"), default=True)
         es_producto_final = _parse_bool(
@@ -298,7 +464,6 @@ def create_app():
         producto = Producto(
             nombre=nombre,
             codigo=codigo,
-            foto=foto,
             categoria_id=categoria_id,
             activo=activo,
             es_producto_final=es_producto_final,
@@ -310,6 +475,11 @@ def create_app():
             stock_reservado=stock_reservado or 0,
             stock_minimo=stock_minimo or 0,
         )
+        try:
+            _asignar_foto_producto(producto, data.get("foto"))
+        except ValueError as exc:
+            db.session.rollback()
+            return jsonify({"error": str(exc)}), 400
         db.session.add(producto)
         db.session.commit()
         return jsonify(producto_to_dict(producto)), 201
@@ -351,7 +521,11 @@ def create_app():
             producto.sku = sku
 
         if "foto" in data:
-            producto.foto = (data.get("foto") or "").strip() or None
+            try:
+                _asignar_foto_producto(producto, data.get("foto"))
+            except ValueError as exc:
+                db.session.rollback()
+                return jsonify({"error": str(exc)}), 400
 
         if "categoria_id" in data:
             categoria_id = data.get("categoria_id")
@@ -431,6 +605,630 @@ def create_app():
         db.session.commit()
         return jsonify(producto_to_dict(producto))
 
+    # ---------- PRECIOS MASIVOS ----------
+
+    CAMPOS_PRECIO = ("precio_cf", "precio_minorista", "precio_mayorista")
+    LOTE_PRECIOS = 500
+
+    def _hojas_xlsx(archivo) -> dict:
+        """{titulo de hoja en minusculas: filas} con cada fila como dict.
+
+        Se lee en modo read_only (streaming). Los encabezados van en
+        minusculas y cada dict lleva "_fila" con el numero de fila de Excel
+        para reportar errores. Se omiten filas vacias.
+        """
+        try:
+            libro = load_workbook(archivo, read_only=True, data_only=True)
+        except (InvalidFileException, zipfile.BadZipFile, KeyError, OSError):
+            raise ValueError("El archivo debe ser un xlsx válido")
+        try:
+            hojas = {}
+            for hoja in libro.worksheets:
+                filas = hoja.iter_rows(values_only=True)
+                encabezados = [
+                    str(valor).strip().lower() if valor is not None else None
+                    for valor in next(filas, ())
+                ]
+                resultado = []
+                for numero, fila in enumerate(filas, start=2):
+                    if all(v is None or str(v).strip() == "" for v in fila):
+                        continue
+                    datos = {enc: v for enc, v in zip(encabezados, fila) if enc}
+                    datos["_fila"] = numero
+                    resultado.append(datos)
+                hojas[hoja.title.strip().lower()] = resultado
+            return hojas
+        finally:
+            libro.close()
+
+    def _filas_xlsx(archivo) -> list:
+        """Filas de la primera hoja (ver _hojas_xlsx)."""
+        return next(iter(_hojas_xlsx(archivo).values()), [])
+
+    def _precios_por_codigo(filas) -> dict:
+        """{codigo: {campo: Decimal}} a partir de filas JSON o de Excel."""
+        precios = {}
+        for indice, fila in enumerate(filas):
+            if not isinstance(fila, dict):
+                raise ValueError("Cada elemento de precios debe ser un objeto")
+            ref = f"fila {fila['_fila']}" if "_fila" in fila else f"precios[{indice}]"
+            codigo = str(fila.get("codigo") or "").strip()
+            if not codigo:
+                raise ValueError(f"{ref}: codigo es requerido")
+            if codigo in precios:
+                raise ValueError(f"{ref}: codigo {codigo} repetido")
+            valores = {}
+            for campo in CAMPOS_PRECIO:
+                try:
+                    valor = _parse_decimal(fila.get(campo), campo)
+                except ValueError as exc:
+                    raise ValueError(f"{ref}: {exc}")
+                if valor is None:
+                    continue
+                if valor < 0:
+                    raise ValueError(f"{ref}: {campo} no puede ser negativo")
+                valores[campo] = valor.quantize(Decimal("0.01"))
+            if not valores:
+                raise ValueError(f"{ref}: no trae precios")
+            precios[codigo] = valores
+        if not precios:
+            raise ValueError("No hay precios para actualizar")
+        return precios
+
+    def _columnas_precio():
+        return (Producto.id, Producto.codigo, Producto.nombre) + tuple(
+            getattr(Producto, campo) for campo in CAMPOS_PRECIO
+        )
+
+    def _cambio_precio(fila, despues: dict) -> dict:
+        antes = {campo: float(getattr(fila, campo)) for campo in CAMPOS_PRECIO}
+        return {
+            "id": fila.id,
+            "codigo": fila.codigo,
+            "nombre": fila.nombre,
+            "antes": antes,
+            "despues": {
+                campo: float(despues[campo]) if campo in despues else antes[campo]
+                for campo in CAMPOS_PRECIO
+            },
+        }
+
+    def _actualizar_precios_por_codigo(precios: dict, preview: bool) -> dict:
+        codigos = list(precios)
+        existentes = {}
+        for inicio in range(0, len(codigos), LOTE_PRECIOS):
+            lote = codigos[inicio : inicio + LOTE_PRECIOS]
+            filas = db.session.query(*_columnas_precio()).filter(
+                Producto.codigo.in_(lote)
+            )
+            existentes.update((fila.codigo, fila) for fila in filas)
+        faltantes = [codigo for codigo in codigos if codigo not in existentes]
+        if faltantes:
+            raise LookupError(f"codigos no encontrados: {faltantes[:50]}")
+
+        if preview:
+            cambios = [
+                _cambio_precio(existentes[codigo], precios[codigo])
+                for codigo in codigos
+            ]
+            return {"productos": len(codigos), "cambios": cambios}
+
+        for inicio in range(0, len(codigos), LOTE_PRECIOS):
+            lote = codigos[inicio : inicio + LOTE_PRECIOS]
+            valores = {}
+            for campo in CAMPOS_PRECIO:
+                por_codigo = {c: precios[c][campo] for c in lote if campo in precios[c]}
+                if por_codigo:
+                    valores[campo] = case(
+                        por_codigo,
+                        value=Producto.codigo,
+                        else_=getattr(Producto, campo),
+                    )
+            db.session.execute(
+                update(Producto)
+                .where(Producto.codigo.in_(lote))
+                .values(valores)
+                .execution_options(synchronize_session=False)
+            )
+        return {"productos": len(codigos)}
+
+    def _actualizar_precios_por_regla(data: dict, preview: bool) -> dict:
+        ajuste = data.get("ajuste")
+        if not isinstance(ajuste, dict):
+            raise ValueError("Envía precios (por codigo) o ajuste")
+        tipo = (ajuste.get("tipo") or "").strip().lower()
+        if tipo not in ("porcentaje", "absoluto"):
+            raise ValueError("ajuste.tipo debe ser porcentaje o absoluto")
+        valor = _parse_decimal(ajuste.get("valor"), "ajuste.valor")
+        if valor is None:
+            raise ValueError("ajuste.valor es requerido")
+        campos = ajuste.get("campos") or list(CAMPOS_PRECIO)
+        if (
+            not isinstance(campos, list)
+            or not all(isinstance(campo, str) for campo in campos)
+            or set(campos) - set(CAMPOS_PRECIO)
+        ):
+            raise ValueError(f"ajuste.campos admite: {', '.join(CAMPOS_PRECIO)}")
+
+        filtros = []
+        if data.get("categoria_id") is not None:
+            categoria_id = _id_entero(data.get("categoria_id"))
+            if categoria_id is None:
+                raise ValueError("categoria_id debe ser entero")
+            _validate_fk(CategoriaProducto, categoria_id, "categoria_id")
+            filtros.append(Producto.categoria_id == categoria_id)
+        if data.get("codigos") is not None:
+            codigos = data.get("codigos")
+            if not isinstance(codigos, list) or not codigos:
+                raise ValueError("codigos debe ser una lista no vacía")
+            filtros.append(Producto.codigo.in_([str(c).strip() for c in codigos]))
+        if not filtros and not _parse_bool(data.get("todos"), default=False):
+            raise ValueError("Indica categoria_id, codigos o todos=true")
+
+        nuevos = {}
+        for campo in campos:
+            columna = getattr(Producto, campo)
+            if tipo == "porcentaje":
+                factor = 1 + valor / Decimal("100")
+                nuevos[campo] = func.round(columna * factor, 2)
+            else:
+                nuevos[campo] = func.round(columna + valor, 2)
+
+        negativos = (
+            db.session.query(Producto.codigo)
+            .filter(*filtros)
+            .filter(or_(*[expr < 0 for expr in nuevos.values()]))
+            .limit(50)
+            .all()
+        )
+        if negativos:
+            codigos = [fila.codigo for fila in negativos]
+            raise ValueError(f"El ajuste deja precios negativos: {codigos}")
+
+        if preview:
+            etiquetas = [expr.label(f"nuevo_{campo}") for campo, expr in nuevos.items()]
+            filas = (
+                db.session.query(*_columnas_precio(), *etiquetas)
+                .filter(*filtros)
+                .order_by(Producto.id)
+            )
+            cambios = [
+                _cambio_precio(
+                    fila, {campo: getattr(fila, f"nuevo_{campo}") for campo in nuevos}
+                )
+                for fila in filas
+            ]
+            return {"productos": len(cambios), "cambios": cambios}
+
+        resultado = db.session.execute(
+            update(Producto)
+            .where(*filtros)
+            .values(nuevos)
+            .execution_options(synchronize_session=False)
+        )
+        return {"productos": resultado.rowcount}
+
+    @app.route("/productos/precios", methods=["POST"])
+    def actualizar_precios_masivo():
+        """Actualiza precios de muchos productos con un UPDATE por lote.
+
+        - JSON {"precios": [{codigo, precio_cf, ...}]} o un xlsx (multipart,
+          campo "archivo") con columnas codigo y precio_*: precios absolutos.
+        - JSON {"ajuste": {tipo: porcentaje|absoluto, valor, campos}} filtrado
+          por categoria_id y/o codigos (o todos=true).
+        Con preview=true no se modifica nada y se devuelven los cambios.
+        """
+        archivo = request.files.get("archivo")
+        if archivo:
+            data = request.form.to_dict()
+        else:
+            data = request.get_json(silent=True) or {}
+        preview = _parse_bool(data.get("preview"), default=False)
+
+        try:
+            if archivo:
+                resultado = _actualizar_precios_por_codigo(
+                    _precios_por_codigo(_filas_xlsx(archivo.stream)), preview
+                )
+            elif "precios" in data:
+                if not isinstance(data.get("precios"), list):
+                    raise ValueError("precios debe ser una lista")
+                resultado = _actualizar_precios_por_codigo(
+                    _precios_por_codigo(data.get("precios")), preview
+                )
+            else:
+                resultado = _actualizar_precios_por_regla(data, preview)
+        except ValueError as exc:
+            db.session.rollback()
+            return jsonify({"error": str(exc)}), 400
+        except LookupError as exc:
+            db.session.rollback()
+            return jsonify({"error": str(exc)}), 404
+
+        if not preview:
+            db.session.commit()
+        resultado["preview"] = preview
+        return jsonify(resultado)
+
+    # ---------- CATALOGO EXCEL ----------
+
+    MIMETYPE_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    LOTE_CATALOGO = 1000
+    # Columnas de la hoja Productos. En productos nuevos las celdas vacias o
+    # columnas ausentes toman el valor por defecto de crear_producto; en los
+    # existentes dejan el valor actual (solo codigo es obligatorio).
+    COLUMNAS_CATALOGO = (
+        "codigo",
+        "nombre",
+        "categoria",
+        "activo",
+        "es_producto_final",
+        "es_terminado",
+        "precio_cf",
+        "precio_minorista",
+        "precio_mayorista",
+        "stock_minimo",
+    )
+
+    def _insert_upsert(model):
+        if db.engine.dialect.name == "postgresql":
+            return pg_insert(model)
+        return sqlite_insert(model)
+
+    @cola_trabajos.tarea("catalogo-excel")
+    def _generar_excel_catalogo(parametros: dict) -> ArchivoTrabajo:
+        """Hojas Categorias y Productos en modo write_only (filas en streaming)."""
+        wb = Workbook(write_only=True)
+        ws_cat = wb.create_sheet("Categorias")
+        ws_cat.append(["nombre", "descripcion"])
+        categorias = db.session.query(
+            CategoriaProducto.nombre, CategoriaProducto.descripcion
+        ).order_by(CategoriaProducto.nombre)
+        for fila in categorias:
+            ws_cat.append(list(fila))
+
+        ws_prod = wb.create_sheet("Productos")
+        ws_prod.append(list(COLUMNAS_CATALOGO))
+        productos = (
+            db.session.query(
+                Producto.codigo,
+                Producto.nombre,
+                CategoriaProducto.nombre,
+                Producto.activo,
+                Producto.es_producto_final,
+                Producto.es_terminado,
+                Producto.precio_cf,
+                Producto.precio_minorista,
+                Producto.precio_mayorista,
+                Producto.stock_minimo,
+            )
+            .join(CategoriaProducto, CategoriaProducto.id == Producto.categoria_id)
+            .order_by(Producto.codigo)
+            .execution_options(yield_per=LOTE_CATALOGO)
+        )
+        for fila in productos:
+            ws_prod.append(
+                [float(v) if isinstance(v, Decimal) else v for v in fila]
+            )
+
+        buffer = BytesIO()
+        wb.save(buffer)
+        nombre = f"catalogo_{date.today().isoformat()}.xlsx"
+        return ArchivoTrabajo(buffer.getvalue(), nombre, MIMETYPE_XLSX)
+
+    @app.route("/productos/catalogo/excel", methods=["GET"])
+    def exportar_catalogo_excel():
+        if _parse_bool(request.args.get("asincrono"), default=False):
+            return respuesta_encolado(cola_trabajos.encolar("catalogo-excel", {}))
+        archivo = _generar_excel_catalogo({})
+        return send_file(
+            BytesIO(archivo.contenido),
+            mimetype=archivo.mimetype,
+            as_attachment=True,
+            download_name=archivo.nombre,
+        )
+
+    def _validar_catalogo(filas_categorias, filas_productos):
+        """Valida las dos hojas en una sola pasada.
+
+        Devuelve (categorias, existentes, productos, nuevos, errores):
+        categorias de la hoja {nombre: descripcion}, las ya existentes
+        {nombre: id} resueltas con una consulta, productos {codigo: datos}, los
+        codigos que aun no existen y errores por fila. En los productos
+        existentes los campos vacios quedan en None (no se modifican).
+        """
+        errores = []
+        categorias = {}
+        for fila in filas_categorias:
+            nombre = str(fila.get("nombre") or "").strip()
+            if not nombre:
+                errores.append(
+                    {
+                        "hoja": "Categorias",
+                        "fila": fila["_fila"],
+                        "error": "nombre es requerido",
+                    }
+                )
+                continue
+            descripcion = fila.get("descripcion")
+            categorias[nombre] = str(descripcion).strip() if descripcion else None
+
+        nombres = {
+            str(fila.get("categoria") or "").strip() for fila in filas_productos
+        }
+        codigos = list(
+            {str(fila.get("codigo") or "").strip() for fila in filas_productos}
+        )
+        registrados = set()
+        for inicio in range(0, len(codigos), LOTE_CATALOGO):
+            registrados.update(
+                codigo
+                for (codigo,) in db.session.query(Producto.codigo).filter(
+                    Producto.codigo.in_(codigos[inicio : inicio + LOTE_CATALOGO])
+                )
+            )
+        existentes = dict(
+            db.session.query(CategoriaProducto.nombre, CategoriaProducto.id).filter(
+                CategoriaProducto.nombre.in_(nombres | set(categorias))
+            )
+        )
+
+        productos = {}
+        for fila in filas_productos:
+            numero = fila["_fila"]
+            try:
+                codigo = str(fila.get("codigo") or "").strip()
+                nombre = str(fila.get("nombre") or "").strip()
+                categoria = str(fila.get("categoria") or "").strip()
+                nuevo = codigo not in registrados
+                if not codigo:
+                    raise ValueError("El código es requerido")
+                if nuevo and not nombre:
+                    raise ValueError("El nombre es requerido")
+                if codigo in productos:
+                    raise ValueError(f"código {codigo} repetido")
+                if (nuevo or categoria) and (
+                    categoria not in existentes and categoria not in categorias
+                ):
+                    raise ValueError(f"Categoría no encontrada: {categoria}")
+                es_producto_final = _parse_bool(
+                    fila.get("es_producto_final"), default=True if nuevo else None
+                )
+                es_terminado = _parse_bool(fila.get("es_terminado"), default=None)
+                if es_producto_final is False:
+                    es_terminado = False
+                elif es_terminado is None and nuevo:
+                    es_terminado = True
+                datos = {
+                    "codigo": codigo,
+                    "nombre": nombre or None,
+                    "categoria": categoria or None,
+                    "activo": _parse_bool(
+                        fila.get("activo"), default=True if nuevo else None
+                    ),
+                    "es_producto_final": es_producto_final,
+                    "es_terminado": es_terminado,
+                }
+                for campo in CAMPOS_PRECIO + ("stock_minimo",):
+                    valor = _parse_decimal(
+                        fila.get(campo), campo, default=Decimal("0") if nuevo else None
+                    )
+                    if valor is not None and valor < 0:
+                        raise ValueError(f"{campo} no puede ser negativo")
+                    datos[campo] = valor
+            except ValueError as exc:
+                errores.append({"hoja": "Productos", "fila": numero, "error": str(exc)})
+                continue
+            productos[codigo] = datos
+        nuevos = [codigo for codigo in productos if codigo not in registrados]
+        return categorias, existentes, productos, nuevos, errores
+
+    @app.route("/productos/catalogo/excel", methods=["POST"])
+    def importar_catalogo_excel():
+        """Importa el xlsx de exportar_catalogo_excel (multipart, campo "archivo").
+
+        Las categorias se crean o actualizan por nombre; los productos nuevos
+        se insertan con INSERT ... ON CONFLICT y los existentes se actualizan
+        con un UPDATE por lotes donde las celdas vacias conservan el valor
+        actual. Todo se valida antes de escribir: si alguna fila falla no se
+        aplica nada. Con validar=true solo se valida. El stock actual no se
+        importa.
+        """
+        archivo = request.files.get("archivo")
+        if not archivo:
+            return jsonify({"error": "archivo es requerido"}), 400
+        solo_validar = _parse_bool(request.form.get("validar"), default=False)
+        try:
+            hojas = _hojas_xlsx(archivo.stream)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+        filas_productos = hojas.get("productos")
+        if filas_productos is None:
+            filas_productos = next(iter(hojas.values()), [])
+
+        categorias, existentes, productos, nuevos, errores = _validar_catalogo(
+            hojas.get("categorias", []), filas_productos
+        )
+        resumen = {
+            "categorias": len(categorias),
+            "productos": len(productos),
+            "errores": errores[:200],
+            "total_errores": len(errores),
+        }
+        if errores:
+            return jsonify(resumen), 400
+        if solo_validar:
+            return jsonify(resumen)
+
+        ahora = datetime.utcnow()
+        if categorias:
+            stmt = _insert_upsert(CategoriaProducto)
+            actualizar = {
+                "descripcion": func.coalesce(
+                    stmt.excluded.descripcion, CategoriaProducto.descripcion
+                ),
+                "actualizada_en": ahora,
+            }
+            db.session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[CategoriaProducto.nombre], set_=actualizar
+                ),
+                [
+                    {
+                        "nombre": nombre,
+                        "descripcion": descripcion,
+                        "creada_en": ahora,
+                        "actualizada_en": ahora,
+                    }
+                    for nombre, descripcion in categorias.items()
+                ],
+            )
+            existentes = dict(
+                db.session.query(CategoriaProducto.nombre, CategoriaProducto.id).filter(
+                    CategoriaProducto.nombre.in_(
+                        set(categorias)
+                        | {p["categoria"] for p in productos.values() if p["categoria"]}
+                    )
+                )
+            )
+
+        campos = [campo for campo in COLUMNAS_CATALOGO if campo != "codigo"]
+        campos[campos.index("categoria")] = "categoria_id"
+        for datos in productos.values():
+            categoria = datos.pop("categoria")
+            datos["categoria_id"] = existentes[categoria] if categoria else None
+
+        # executemany (insertmanyvalues) en vez de un VALUES gigante. Si otro
+        # proceso crea el codigo entre la validacion y el insert, se actualiza.
+        stmt = _insert_upsert(Producto)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Producto.codigo],
+            set_={
+                **{campo: getattr(stmt.excluded, campo) for campo in campos},
+                "actualizado_en": ahora,
+            },
+        )
+        for inicio in range(0, len(nuevos), LOTE_CATALOGO):
+            filas = [
+                dict(
+                    productos[codigo],
+                    creado_en=ahora,
+                    actualizado_en=ahora,
+                    stock_actual=Decimal("0"),
+                    stock_reservado=Decimal("0"),
+                )
+                for codigo in nuevos[inicio : inicio + LOTE_CATALOGO]
+            ]
+            db.session.execute(stmt, filas)
+
+        # En los existentes una celda vacia (None) conserva el valor actual.
+        tabla = Producto.__table__
+        stmt = (
+            tabla.update()
+            .where(tabla.c.codigo == bindparam("b_codigo"))
+            .values(
+                {
+                    **{
+                        campo: func.coalesce(
+                            bindparam(f"b_{campo}", type_=tabla.c[campo].type),
+                            tabla.c[campo],
+                        )
+                        for campo in campos
+                    },
+                    "actualizado_en": ahora,
+                }
+            )
+        )
+        creados = set(nuevos)
+        actualizados = [codigo for codigo in productos if codigo not in creados]
+        for inicio in range(0, len(actualizados), LOTE_CATALOGO):
+            filas = [
+                {f"b_{campo}": valor for campo, valor in productos[codigo].items()}
+                for codigo in actualizados[inicio : inicio + LOTE_CATALOGO]
+            ]
+            db.session.execute(stmt, filas)
+        db.session.commit()
+
+        resumen.update(
+            productos_creados=len(nuevos), productos_actualizados=len(actualizados)
+        )
+        return jsonify(resumen)
+
+    @app.route("/productos/<int:producto_id>/foto", methods=["PUT"])
+    def subir_foto_producto(producto_id: int):
+        """Sube la foto como multipart (campo "foto") o como cuerpo binario."""
+        producto = Producto.query.get_or_404(producto_id)
+        limite = app.config["FOTO_MAX_BYTES"]
+        if (request.content_length or 0) > limite:
+            return jsonify({"error": "La foto excede el tamaño permitido"}), 413
+        archivo = request.files.get("foto")
+        contenido = archivo.read(limite + 1) if archivo else request.get_data()
+        if len(contenido) > limite:
+            return jsonify({"error": "La foto excede el tamaño permitido"}), 413
+        try:
+            foto = _guardar_foto(contenido)
+        except ValueError as exc:
+            db.session.rollback()
+            return jsonify({"error": str(exc)}), 400
+        producto.foto_id = foto.id
+        producto.foto = None
+        db.session.commit()
+        return jsonify(producto_to_dict(producto))
+
+    @app.route("/productos/<int:producto_id>/foto", methods=["DELETE"])
+    def eliminar_foto_producto(producto_id: int):
+        producto = Producto.query.get_or_404(producto_id)
+        producto.foto_id = None
+        producto.foto = None
+        db.session.commit()
+        return jsonify({"message": "Foto eliminada"})
+
+    def _respuesta_foto(hash_foto: str, miniatura: bool):
+        columna = FotoProducto.miniatura if miniatura else FotoProducto.contenido
+        foto = (
+            FotoProducto.query.options(undefer(columna))
+            .filter_by(hash=hash_foto)
+            .first_or_404()
+        )
+        resp = app.response_class(
+            foto.miniatura if miniatura else foto.contenido,
+            mimetype=foto.miniatura_mimetype if miniatura else foto.mimetype,
+        )
+        # El contenido nunca cambia para un hash dado.
+        resp.set_etag(f"{foto.hash}-m" if miniatura else foto.hash)
+        resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return resp.make_conditional(request)
+
+    @app.route("/productos/fotos/<string:hash_foto>", methods=["GET"])
+    def obtener_foto_producto(hash_foto: str):
+        return _respuesta_foto(hash_foto, miniatura=False)
+
+    @app.route("/productos/fotos/<string:hash_foto>/miniatura", methods=["GET"])
+    def obtener_miniatura_foto_producto(hash_foto: str):
+        return _respuesta_foto(hash_foto, miniatura=True)
+
+    @app.cli.command("migrar-fotos-productos")
+    def migrar_fotos_productos():
+        """Mueve las fotos data URI guardadas en productos.foto a fotos_producto."""
+        migrados = 0
+        ids = [
+            pid
+            for (pid,) in db.session.query(Producto.id)
+            .filter(Producto.foto.like("data:%"))
+            .all()
+        ]
+        for producto_id in ids:
+            producto = Producto.query.get(producto_id)
+            try:
+                _asignar_foto_producto(producto, producto.foto)
+            except ValueError as exc:
+                click.echo(f"Producto {producto.codigo}: {exc}")
+                continue
+            db.session.commit()
+            db.session.expunge_all()
+            migrados += 1
+        click.echo(f"Fotos migradas: {migrados}")
+
     @app.route("/productos/<int:producto_id>", methods=["DELETE"])
     def eliminar_producto(producto_id: int):
         producto = Producto.query.get_or_404(producto_id)
@@ -457,8 +1255,10 @@ def create_app():
 
     @app.route("/clientes", methods=["GET"])
     def listar_clientes():
-        clientes = Cliente.query.order_by(Cliente.id).all()
-        return jsonify([cliente_to_dict(c) for c in clientes])
+        return _respuesta_condicional(
+            _etag_catalogo(Cliente),
+            lambda: [cliente_to_dict(c) for c in Cliente.query.order_by(Cliente.id).all()],
+        )
 
     @app.route("/clientes/<int:cliente_id>", methods=["GET"])
     def obtener_cliente(cliente_id: int):
@@ -587,6 +1387,453 @@ def create_app():
         db.session.commit()
         return jsonify({"message": "Cliente eliminado"})
 
+    # ---------- LISTAS DE PRECIOS ----------
+
+    CLASIFICACIONES_PRECIO = ("cf", "minorista", "mayorista")
+    # Listas activas y sus precios en memoria. Se recargan cuando cambia la
+    # version de listas_precio o lista_precio_items (ver _version_tabla).
+    _cache_listas_precio = {}
+
+    def _listas_precio_en_memoria() -> dict:
+        version = (_version_tabla(ListaPrecio), _version_tabla(ListaPrecioItem))
+        cache = _cache_listas_precio.get("actual")
+        if cache and cache["version"] == version:
+            return cache
+
+        listas = (
+            db.session.query(
+                ListaPrecio.id,
+                ListaPrecio.clasificacion,
+                ListaPrecio.cliente_id,
+                ListaPrecio.vigente_desde,
+                ListaPrecio.vigente_hasta,
+            )
+            .filter(ListaPrecio.activo.is_(True))
+            .order_by(ListaPrecio.vigente_desde.desc(), ListaPrecio.id.desc())
+            .all()
+        )
+        precios = {}
+        filas = (
+            db.session.query(
+                ListaPrecioItem.lista_id,
+                ListaPrecioItem.producto_id,
+                ListaPrecioItem.precio,
+            )
+            .join(ListaPrecio, ListaPrecio.id == ListaPrecioItem.lista_id)
+            .filter(ListaPrecio.activo.is_(True))
+        )
+        for lista_id, producto_id, precio in filas:
+            precios.setdefault(lista_id, {})[producto_id] = Decimal(str(precio))
+
+        cache = {"version": version, "listas": listas, "precios": precios}
+        _cache_listas_precio["actual"] = cache
+        return cache
+
+    def _resolver_precios(cliente: Cliente, productos, fecha=None) -> dict:
+        """{producto_id: (precio, lista_id)} de los productos para el cliente.
+
+        Prioridad: lista vigente del cliente, lista vigente de su clasificacion
+        y por ultimo Producto.precio_<clasificacion> (lista_id None). Entre
+        listas del mismo nivel gana la de vigente_desde mas reciente.
+        """
+        fecha = fecha or date.today()
+        clasificacion = cliente.clasificacion_precio
+        if clasificacion not in CLASIFICACIONES_PRECIO:
+            clasificacion = "cf"
+        cache = _listas_precio_en_memoria()
+        vigentes = [
+            lista
+            for lista in cache["listas"]
+            if lista.vigente_desde <= fecha
+            and (lista.vigente_hasta is None or lista.vigente_hasta >= fecha)
+        ]
+        propias = [lista.id for lista in vigentes if lista.cliente_id == cliente.id]
+        de_clasificacion = [
+            lista.id
+            for lista in vigentes
+            if lista.cliente_id is None and lista.clasificacion == clasificacion
+        ]
+        candidatas = [
+            (lista_id, cache["precios"].get(lista_id, {}))
+            for lista_id in propias + de_clasificacion
+        ]
+
+        resultado = {}
+        for producto in productos:
+            for lista_id, precios in candidatas:
+                if producto.id in precios:
+                    resultado[producto.id] = (precios[producto.id], lista_id)
+                    break
+            else:
+                base = getattr(producto, f"precio_{clasificacion}")
+                resultado[producto.id] = (Decimal(str(base or 0)), None)
+        return resultado
+
+    def lista_precio_to_dict(lista: ListaPrecio, items=None) -> dict:
+        data = {
+            "id": lista.id,
+            "nombre": lista.nombre,
+            "clasificacion": lista.clasificacion,
+            "cliente_id": lista.cliente_id,
+            "vigente_desde": lista.vigente_desde.isoformat()
+            if lista.vigente_desde
+            else None,
+            "vigente_hasta": lista.vigente_hasta.isoformat()
+            if lista.vigente_hasta
+            else None,
+            "activo": lista.activo,
+            "creado_en": lista.creado_en.isoformat() if lista.creado_en else None,
+            "actualizado_en": lista.actualizado_en.isoformat()
+            if lista.actualizado_en
+            else None,
+        }
+        if items is not None:
+            data["items"] = [
+                {"producto_id": item.producto_id, "precio": float(item.precio)}
+                for item in items
+            ]
+        return data
+
+    def _aplicar_datos_lista_precio(lista: ListaPrecio, data: dict) -> None:
+        """Valida y asigna los campos enviados (ValueError 400, LookupError 404)."""
+        if "nombre" in data or lista.nombre is None:
+            nombre = (data.get("nombre") or "").strip()
+            if not nombre:
+                raise ValueError("El nombre es requerido")
+            lista.nombre = nombre
+        if "clasificacion" in data:
+            clasificacion = (data.get("clasificacion") or "").strip().lower() or None
+            if clasificacion and clasificacion not in CLASIFICACIONES_PRECIO:
+                raise ValueError("clasificacion debe ser cf, minorista o mayorista")
+            lista.clasificacion = clasificacion
+        if "cliente_id" in data:
+            cliente_id = data.get("cliente_id")
+            if cliente_id is not None:
+                _validate_fk(Cliente, cliente_id, "cliente_id")
+            lista.cliente_id = cliente_id
+        if (lista.clasificacion is None) == (lista.cliente_id is None):
+            raise ValueError("Indica clasificacion o cliente_id (solo uno)")
+        if "vigente_desde" in data:
+            lista.vigente_desde = _parse_fecha(data.get("vigente_desde"))
+        if lista.vigente_desde is None:
+            lista.vigente_desde = date.today()
+        if "vigente_hasta" in data:
+            lista.vigente_hasta = _parse_fecha(data.get("vigente_hasta"))
+        if lista.vigente_hasta and lista.vigente_hasta < lista.vigente_desde:
+            raise ValueError("vigente_hasta no puede ser anterior a vigente_desde")
+        if "activo" in data:
+            lista.activo = _parse_bool(data.get("activo"), default=True)
+
+    def _parse_items_lista_precio(items_payload) -> dict:
+        """{producto_id: precio} validando todos los productos con una consulta."""
+        if not isinstance(items_payload, list):
+            raise ValueError("items debe ser una lista")
+        precios = {}
+        for item in items_payload:
+            if not isinstance(item, dict):
+                raise ValueError("Cada item debe ser un objeto")
+            producto_id = _id_entero(item.get("producto_id"))
+            if producto_id is None:
+                raise ValueError("producto_id debe ser entero")
+            if producto_id in precios:
+                raise ValueError(f"producto_id {producto_id} repetido")
+            precio = _parse_decimal(item.get("precio"), "precio")
+            if precio is None or precio < 0:
+                raise ValueError("precio es requerido y no puede ser negativo")
+            precios[producto_id] = precio
+        existentes = {
+            fila[0]
+            for fila in db.session.query(Producto.id).filter(
+                Producto.id.in_(list(precios))
+            )
+        }
+        faltantes = sorted(set(precios) - existentes)
+        if faltantes:
+            raise LookupError(f"productos no encontrados: {faltantes}")
+        return precios
+
+    def _reemplazar_items_lista_precio(lista: ListaPrecio, precios: dict) -> None:
+        ListaPrecioItem.query.filter_by(lista_id=lista.id).delete()
+        if precios:
+            ahora = datetime.utcnow()
+            db.session.execute(
+                insert(ListaPrecioItem),
+                [
+                    {
+                        "lista_id": lista.id,
+                        "producto_id": producto_id,
+                        "precio": precio,
+                        "creado_en": ahora,
+                        "actualizado_en": ahora,
+                    }
+                    for producto_id, precio in precios.items()
+                ],
+            )
+
+    @app.route("/listas-precio", methods=["GET"])
+    def listar_listas_precio():
+        q = ListaPrecio.query
+        cliente_id = request.args.get("cliente_id", type=int)
+        if cliente_id is not None:
+            q = q.filter(ListaPrecio.cliente_id == cliente_id)
+        clasificacion = request.args.get("clasificacion")
+        if clasificacion:
+            q = q.filter(ListaPrecio.clasificacion == clasificacion.strip().lower())
+        listas = q.order_by(ListaPrecio.vigente_desde.desc(), ListaPrecio.id).all()
+        return jsonify([lista_precio_to_dict(lista) for lista in listas])
+
+    @app.route("/listas-precio/<int:lista_id>", methods=["GET"])
+    def obtener_lista_precio(lista_id: int):
+        lista = ListaPrecio.query.get_or_404(lista_id)
+        items = lista.items.order_by(ListaPrecioItem.producto_id).all()
+        return jsonify(lista_precio_to_dict(lista, items))
+
+    @app.route("/listas-precio", methods=["POST"])
+    def crear_lista_precio():
+        data = request.get_json(silent=True) or {}
+        lista = ListaPrecio()
+        try:
+            _aplicar_datos_lista_precio(lista, data)
+            precios = _parse_items_lista_precio(data.get("items") or [])
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+        except LookupError as exc:
+            return jsonify({"error": str(exc)}), 404
+        db.session.add(lista)
+        db.session.flush()
+        _reemplazar_items_lista_precio(lista, precios)
+        db.session.commit()
+        items = lista.items.order_by(ListaPrecioItem.producto_id).all()
+        return jsonify(lista_precio_to_dict(lista, items)), 201
+
+    @app.route("/listas-precio/<int:lista_id>", methods=["PUT", "PATCH"])
+    def actualizar_lista_precio(lista_id: int):
+        """Actualiza la lista; si se envian items reemplazan a los actuales."""
+        lista = ListaPrecio.query.get_or_404(lista_id)
+        data = request.get_json(silent=True) or {}
+        try:
+            _aplicar_datos_lista_precio(lista, data)
+            precios = None
+            if "items" in data:
+                precios = _parse_items_lista_precio(data.get("items"))
+        except ValueError as exc:
+            db.session.rollback()
+            return jsonify({"error": str(exc)}), 400
+        except LookupError as exc:
+            db.session.rollback()
+            return jsonify({"error": str(exc)}), 404
+        if precios is not None:
+            _reemplazar_items_lista_precio(lista, precios)
+        db.session.commit()
+        items = lista.items.order_by(ListaPrecioItem.producto_id).all()
+        return jsonify(lista_precio_to_dict(lista, items))
+
+    @app.route("/listas-precio/<int:lista_id>", methods=["DELETE"])
+    def eliminar_lista_precio(lista_id: int):
+        lista = ListaPrecio.query.get_or_404(lista_id)
+        ListaPrecioItem.query.filter_by(lista_id=lista.id).delete()
+        db.session.delete(lista)
+        db.session.commit()
+        return jsonify({"message": "Lista de precios eliminada"})
+
+    @app.route("/clientes/<int:cliente_id>/precios", methods=["GET"])
+    def precios_cliente(cliente_id: int):
+        """Precios resueltos para el cliente (?producto_ids=1,2&fecha=)."""
+        cliente = Cliente.query.get_or_404(cliente_id)
+        try:
+            fecha = _parse_fecha(request.args.get("fecha"))
+            ids = [
+                int(valor)
+                for valor in (request.args.get("producto_ids") or "").split(",")
+                if valor.strip()
+            ]
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+
+        q = Producto.query.filter(Producto.es_producto_final.is_(True))
+        if ids:
+            q = q.filter(Producto.id.in_(ids))
+        else:
+            q = q.filter(Producto.activo.is_(True))
+        productos = q.order_by(Producto.id).all()
+        precios = _resolver_precios(cliente, productos, fecha)
+        return jsonify(
+            [
+                {
+                    "producto_id": producto.id,
+                    "codigo": producto.codigo,
+                    "precio": float(precios[producto.id][0]),
+                    "lista_id": precios[producto.id][1],
+                }
+                for producto in productos
+            ]
+        )
+
+    # ---------- BUSQUEDA ----------
+
+    # Respaldo en memoria para motores sin pg_trgm (SQLite en pruebas).
+    # Se reconstruye cuando cambia la version de la tabla (ver _version_tabla).
+    _indices_busqueda = {}
+    UMBRAL_SIMILITUD = 0.3
+
+    def _trigramas(texto: str) -> set:
+        """Trigramas al estilo pg_trgm: por palabra, con relleno de espacios."""
+        trigramas = set()
+        for palabra in re.findall(r"\w+", (texto or "").lower()):
+            relleno = f"  {palabra} "
+            trigramas.update(relleno[i : i + 3] for i in range(len(relleno) - 2))
+        return trigramas
+
+    def _similitud(a: set, b: set) -> float:
+        if not a or not b:
+            return 0.0
+        return len(a & b) / len(a | b)
+
+    def _indice_busqueda(model) -> dict:
+        version = _version_tabla(model)
+        indice = _indices_busqueda.get(model.__tablename__)
+        if indice and indice["version"] == version:
+            return indice
+
+        textos = {}
+        invertido = {}
+        filas = db.session.query(model.id, model.nombre, model.codigo).all()
+        for fila_id, nombre, codigo in filas:
+            tri_nombre = _trigramas(nombre)
+            tri_codigo = _trigramas(codigo)
+            textos[fila_id] = (
+                (nombre or "").lower(),
+                (codigo or "").lower(),
+                tri_nombre,
+                tri_codigo,
+            )
+            for trigrama in tri_nombre | tri_codigo:
+                invertido.setdefault(trigrama, set()).add(fila_id)
+
+        indice = {"version": version, "textos": textos, "invertido": invertido}
+        _indices_busqueda[model.__tablename__] = indice
+        return indice
+
+    def _buscar_ids_memoria(model, termino: str) -> list:
+        indice = _indice_busqueda(model)
+        termino_lower = termino.lower()
+        tri_termino = _trigramas(termino)
+        candidatos = set()
+        for trigrama in tri_termino:
+            candidatos.update(indice["invertido"].get(trigrama, ()))
+
+        puntuados = []
+        for fila_id in candidatos:
+            nombre, codigo, tri_nombre, tri_codigo = indice["textos"][fila_id]
+            score = max(
+                _similitud(tri_termino, tri_nombre), _similitud(tri_termino, tri_codigo)
+            )
+            contiene = termino_lower in nombre or codigo.startswith(termino_lower)
+            if score < UMBRAL_SIMILITUD and not contiene:
+                continue
+            puntuados.append((codigo == termino_lower, score, -fila_id, fila_id))
+        puntuados.sort(reverse=True)
+        return [(fila_id, score) for _, score, _, fila_id in puntuados]
+
+    def _buscar_ids_postgres(model, termino: str, filtros, offset: int, limite: int):
+        patron = termino.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        score = func.greatest(
+            func.similarity(model.nombre, termino), func.similarity(model.codigo, termino)
+        )
+        exacto = case((func.lower(model.codigo) == termino.lower(), 1), else_=0)
+        q = (
+            db.session.query(model.id, score)
+            .filter(
+                or_(
+                    model.nombre.op("%")(termino),
+                    model.codigo.op("%")(termino),
+                    model.nombre.ilike(f"%{patron}%"),
+                    model.codigo.ilike(f"{patron}%"),
+                )
+            )
+            .filter(*filtros)
+            .order_by(exacto.desc(), score.desc(), model.id)
+        )
+        return [(fila_id, float(s or 0)) for fila_id, s in q.offset(offset).limit(limite)]
+
+    def _parse_paginacion(por_pagina_default: int = 20, por_pagina_max: int = 200):
+        try:
+            pagina = int(request.args.get("pagina", 1))
+            por_pagina = int(request.args.get("por_pagina", por_pagina_default))
+        except (TypeError, ValueError):
+            raise ValueError("pagina y por_pagina deben ser enteros")
+        if pagina < 1 or por_pagina < 1:
+            raise ValueError("pagina y por_pagina deben ser mayores que cero")
+        return pagina, min(por_pagina, por_pagina_max)
+
+    def _buscar(model, to_dict, filtros):
+        termino = (request.args.get("q") or "").strip()
+        if not termino:
+            return jsonify({"error": "q es requerido"}), 400
+        try:
+            pagina, por_pagina = _parse_paginacion(por_pagina_default=10, por_pagina_max=50)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+        offset = (pagina - 1) * por_pagina
+
+        # Se pide un registro extra para saber si hay otra pagina sin contar todo.
+        if db.engine.dialect.name == "postgresql":
+            encontrados = _buscar_ids_postgres(
+                model, termino, filtros, offset, por_pagina + 1
+            )
+        else:
+            encontrados = _buscar_ids_memoria(model, termino)
+            if filtros:
+                permitidos = {
+                    fila_id
+                    for (fila_id,) in db.session.query(model.id)
+                    .filter(model.id.in_([fila_id for fila_id, _ in encontrados]))
+                    .filter(*filtros)
+                }
+                encontrados = [e for e in encontrados if e[0] in permitidos]
+            encontrados = encontrados[offset : offset + por_pagina + 1]
+
+        hay_mas = len(encontrados) > por_pagina
+        encontrados = encontrados[:por_pagina]
+        registros = {
+            r.id: r
+            for r in model.query.filter(
+                model.id.in_([fila_id for fila_id, _ in encontrados])
+            )
+        }
+        resultados = []
+        for fila_id, score in encontrados:
+            data = to_dict(registros[fila_id])
+            data["score"] = round(score, 4)
+            resultados.append(data)
+        return jsonify(
+            {
+                "resultados": resultados,
+                "pagina": pagina,
+                "por_pagina": por_pagina,
+                "hay_mas": hay_mas,
+            }
+        )
+
+    @app.route("/productos/buscar", methods=["GET"])
+    def buscar_productos():
+        filtros = []
+        activo = _parse_bool(request.args.get("activo"), default=None)
+        if activo is not None:
+            filtros.append(Producto.activo == activo)
+        es_final = _parse_bool(request.args.get("es_producto_final"), default=None)
+        if es_final is not None:
+            filtros.append(Producto.es_producto_final == es_final)
+        return _buscar(Producto, producto_to_dict, filtros)
+
+    @app.route("/clientes/buscar", methods=["GET"])
+    def buscar_clientes():
+        filtros = []
+        activo = _parse_bool(request.args.get("activo"), default=None)
+        if activo is not None:
+            filtros.append(Cliente.activo == activo)
+        return _buscar(Cliente, cliente_to_dict, filtros)
+
     def _parse_fecha(value):
         if value is None:
             return None
@@ -625,26 +1872,7 @@ def create_app():
         return bool(value)
 
     def _dias_credito_from_tipo_pago(tipo_pago: TipoPago) -> int:
-        if not tipo_pago or not tipo_pago.nombre:
-            return 0
-        match = re.search(r"\d+", tipo_pago.nombre)
-        return int(match.group()) if match else 0
-
-    def _ordenes_ordenadas_para_abono(ordenes, today: date):
-        def _dias_restantes(orden: Orden) -> int:
-            dias_credito = _dias_credito_from_tipo_pago(orden.tipo_pago)
-            fecha_base = orden.fecha_envio or orden.fecha or today
-            vencimiento = fecha_base + timedelta(days=dias_credito)
-            return (vencimiento - today).days
-
-        return sorted(
-            ordenes,
-            key=lambda orden: (
-                _dias_restantes(orden),
-                orden.fecha_envio or orden.fecha or date.min,
-                orden.id,
-            ),
-        )
+        return cartera.dias_credito(tipo_pago.nombre if tipo_pago else None)
 
     def _es_contado(tipo_pago: TipoPago) -> bool:
         if not tipo_pago or not tipo_pago.nombre:
@@ -695,9 +1923,22 @@ def create_app():
             "estado_pago": estado_pago,
         }
 
+    def _instantanea_cartera(orden: Orden) -> dict:
+        return {
+            "id": orden.id,
+            "total": orden.total,
+            "saldo": orden.saldo,
+            "estado_id": orden.estado_id,
+            "fecha": orden.fecha,
+            "fecha_envio": orden.fecha_envio,
+            "fecha_pago": orden.fecha_pago,
+            "dias_credito": _dias_credito_from_tipo_pago(orden.tipo_pago),
+        }
+
     def _recalcular_cartera_cliente(cliente_id: int) -> None:
         """Reaplica bancos asignados a las ordenes del cliente.
 
+        La regla de asignacion vive en cartera.asignar_pagos.
         Nota: intencionalmente NO modifica Cliente.saldo.
         """
 
@@ -709,75 +1950,635 @@ def create_app():
 
         ordenes = Orden.query.filter_by(cliente_id=cliente_id).order_by(Orden.id).all()
 
-        estado_anterior = {o.id: o.estado_id for o in ordenes}
-        fecha_pago_anterior = {o.id: o.fecha_pago for o in ordenes}
-
+        resultado = cartera.asignar_pagos(
+            [_instantanea_cartera(o) for o in ordenes],
+            [{"monto": b.monto, "fecha": b.fecha} for b in bancos],
+            date.today(),
+        )
         for orden in ordenes:
-            orden.saldo = Decimal(str(orden.total or 0))
-            if orden.estado_id == 4:
-                orden.estado_id = 3
-            orden.fecha_pago = None
+            for campo, valor in resultado[orden.id].items():
+                setattr(orden, campo, valor)
 
-        today = date.today()
+        # Intencionalmente no se toca cliente.saldo; el saldo se refleja en las ordenes.
 
-        for banco in bancos:
-            restante = Decimal(str(banco.monto or 0))
-            if restante <= 0:
-                continue
+    @app.route("/clientes/<int:cliente_id>/recalcular-cartera", methods=["POST"])
+    def recalcular_cartera_cliente_endpoint(cliente_id: int):
+        cliente = Cliente.query.get_or_404(cliente_id)
+        if _parse_bool(request.args.get("dry_run"), default=False):
+            return jsonify(_simular_cartera_cliente(cliente))
+        if _parse_bool(request.args.get("asincrono"), default=False):
+            trabajo = cola_trabajos.encolar(
+                "recalcular-cartera", {"cliente_id": cliente.id}
+            )
+            return respuesta_encolado(trabajo)
+        return jsonify(_recalcular_cartera_y_resumir(cliente))
+
+    def _recalcular_cartera_y_resumir(cliente: Cliente) -> dict:
+        _recalcular_cartera_cliente(cliente.id)
+        _refrescar_antiguedad_clientes([cliente.id])
+        db.session.commit()
+
+        ordenes = (
+            Orden.query.filter_by(cliente_id=cliente.id)
+            .order_by(Orden.id)
+            .all()
+        )
+        return {
+            "cliente_id": cliente.id,
+            "cliente_saldo": float(cliente.saldo or 0),
+            "ordenes": [orden_to_dict(o) for o in ordenes],
+        }
+
+    def _simular_cartera_cliente(cliente: Cliente) -> dict:
+        """Aplica la asignacion sobre copias de solo lectura y devuelve el diff.
+
+        Se consultan columnas (no entidades), asi que la sesion no queda con
+        cambios pendientes ni se serializa el historial completo del cliente.
+        """
+        filas = (
+            db.session.query(
+                Orden.id,
+                Orden.codigo_orden,
+                Orden.total,
+                Orden.saldo,
+                Orden.estado_id,
+                Orden.fecha,
+                Orden.fecha_envio,
+                Orden.fecha_pago,
+                TipoPago.nombre.label("tipo_pago"),
+            )
+            .outerjoin(TipoPago, TipoPago.id == Orden.tipo_pago_id)
+            .filter(Orden.cliente_id == cliente.id)
+            .order_by(Orden.id)
+            .all()
+        )
+        codigos = {fila.id: fila.codigo_orden for fila in filas}
+        ordenes = []
+        for fila in filas:
+            orden = fila._asdict()
+            orden.pop("codigo_orden")
+            orden["dias_credito"] = cartera.dias_credito(orden.pop("tipo_pago"))
+            ordenes.append(orden)
+        bancos = [
+            {"monto": fila.monto, "fecha": fila.fecha}
+            for fila in db.session.query(Bancos.monto, Bancos.fecha)
+            .filter(Bancos.cliente_id == cliente.id, Bancos.asignado.is_(True))
+            .order_by(Bancos.fecha, Bancos.id)
+        ]
+
+        cambios = cartera.diferencias(
+            ordenes, cartera.asignar_pagos(ordenes, bancos, date.today())
+        )
+
+        def _estado(valores: dict) -> dict:
+            return {
+                "saldo": float(valores["saldo"]),
+                "estado_id": valores["estado_id"],
+                "fecha_pago": valores["fecha_pago"].isoformat()
+                if valores["fecha_pago"]
+                else None,
+            }
+
+        return {
+            "cliente_id": cliente.id,
+            "dry_run": True,
+            "ordenes_con_cambios": len(cambios),
+            "saldo_antes": float(sum(c["antes"]["saldo"] for c in cambios)),
+            "saldo_despues": float(sum(c["despues"]["saldo"] for c in cambios)),
+            "cambios": [
+                {
+                    "orden_id": c["orden_id"],
+                    "codigo_orden": codigos[c["orden_id"]],
+                    "antes": _estado(c["antes"]),
+                    "despues": _estado(c["despues"]),
+                }
+                for c in cambios
+            ],
+        }
 
-            fecha_aplicacion = banco.fecha or today
+    @cola_trabajos.tarea("recalcular-cartera")
+    def _trabajo_recalcular_cartera(parametros: dict) -> dict:
+        cliente = Cliente.query.get(parametros.get("cliente_id"))
+        if not cliente:
+            raise LookupError("Cliente no encontrado")
+        return _recalcular_cartera_y_resumir(cliente)
 
-            pendientes = [
-                o
-                for o in ordenes
-                if Decimal(str(o.saldo or 0)) > 0 and o.estado_id != 4
+    @app.cli.command("recalcular-cartera-global")
+    @click.option(
+        "--procesos", default=os.cpu_count() or 1, show_default=True, type=int
+    )
+    @click.option(
+        "--lote", default=200, show_default=True, help="Clientes por particion."
+    )
+    @click.option("--simular", is_flag=True, help="Solo reporta, no escribe.")
+    @click.option("--detalle", is_flag=True, help="Muestra cada orden que cambia.")
+    def recalcular_cartera_global(procesos, lote, simular, detalle):
+        """Recalcula la cartera de todos los clientes en paralelo.
+
+        Cada particion de clientes se procesa en otro proceso con su propia
+        conexion (cartera.recalcular_particion). Conviene ejecutarlo sin
+        trafico de abonos, ya que no bloquea las ordenes mientras calcula.
+        """
+        url = db.engine.url
+        en_memoria = url.database in (None, "", ":memory:")
+        if url.get_backend_name() == "sqlite" and en_memoria:
+            raise click.ClickException(
+                "El recalculo en paralelo requiere una base de datos compartida"
+            )
+        ids = [
+            cliente_id
+            for (cliente_id,) in db.session.query(Cliente.id).order_by(Cliente.id)
+        ]
+        particiones = [ids[i : i + lote] for i in range(0, len(ids), lote)]
+        uri = url.render_as_string(hide_password=False)
+        hoy = date.today().isoformat()
+
+        afectados = set()
+        ordenes_cambiadas = 0
+        contexto = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=procesos, mp_context=contexto) as pool:
+            futuros = {
+                pool.submit(
+                    cartera.recalcular_particion, uri, particion, hoy, not simular
+                ): particion
+                for particion in particiones
+            }
+            for n, futuro in enumerate(as_completed(futuros), start=1):
+                cambios = futuro.result()
+                click.echo(
+                    f"[{n}/{len(particiones)}] {len(futuros[futuro])} clientes, "
+                    f"{len(cambios)} con cambios"
+                )
+                for cliente_id, lista in sorted(cambios.items()):
+                    antes = sum(c["antes"]["saldo"] for c in lista)
+                    despues = sum(c["despues"]["saldo"] for c in lista)
+                    click.echo(
+                        f"  cliente {cliente_id}: {len(lista)} ordenes, "
+                        f"saldo {antes:.2f} -> {despues:.2f}"
+                    )
+                    if detalle:
+                        for c in lista:
+                            click.echo(
+                                f"    orden {c['orden_id']}: "
+                                f"{c['antes']} -> {c['despues']}"
+                            )
+                afectados.update(cambios)
+                ordenes_cambiadas += sum(len(lista) for lista in cambios.values())
+
+        if not simular:
+            afectados = sorted(afectados)
+            for i in range(0, len(afectados), lote):
+                _refrescar_antiguedad_clientes(afectados[i : i + lote])
+                db.session.commit()
+        accion = "por cambiar" if simular else "actualizadas"
+        click.echo(
+            f"{len(ids)} clientes, {len(afectados)} con cambios, "
+            f"{ordenes_cambiadas} ordenes {accion}"
+        )
+
+    # ---------- CONCILIACION DE SALDOS ----------
+
+    def _diferencias_saldo_clientes(tolerancia=Decimal("0.01")):
+        """Clientes cuyo Cliente.saldo no coincide con el saldo de sus ordenes.
+
+        Saldo esperado = saldo de ordenes en estado 3 menos el saldo a favor
+        (bancos asignados que exceden lo aplicado a ordenes enviadas o pagadas).
+        """
+        ordenes = (
+            db.session.query(
+                Orden.cliente_id.label("cliente_id"),
+                func.sum(case((Orden.estado_id == 3, Orden.saldo), else_=0)).label(
+                    "pendiente"
+                ),
+                func.sum(Orden.total - Orden.saldo).label("aplicado"),
+            )
+            .filter(Orden.estado_id.in_((3, 4)))
+            .group_by(Orden.cliente_id)
+            .subquery()
+        )
+        pagos = (
+            db.session.query(
+                Bancos.cliente_id.label("cliente_id"),
+                func.sum(Bancos.monto).label("pagado"),
+            )
+            .filter(Bancos.asignado.is_(True), Bancos.cliente_id.isnot(None))
+            .group_by(Bancos.cliente_id)
+            .subquery()
+        )
+        pendiente = func.coalesce(ordenes.c.pendiente, 0)
+        a_favor = func.coalesce(pagos.c.pagado, 0) - func.coalesce(
+            ordenes.c.aplicado, 0
+        )
+        esperado = pendiente - case((a_favor > 0, a_favor), else_=0)
+        filas = (
+            db.session.query(
+                Cliente.id,
+                Cliente.codigo,
+                Cliente.nombre,
+                Cliente.saldo,
+                esperado.label("esperado"),
+            )
+            .outerjoin(ordenes, ordenes.c.cliente_id == Cliente.id)
+            .outerjoin(pagos, pagos.c.cliente_id == Cliente.id)
+            .filter(func.abs(Cliente.saldo - esperado) >= tolerancia)
+            .order_by(Cliente.id)
+            .all()
+        )
+        return [
+            {
+                "cliente_id": fila.id,
+                "codigo": fila.codigo,
+                "nombre": fila.nombre,
+                "saldo_actual": Decimal(str(fila.saldo or 0)),
+                "saldo_esperado": Decimal(str(fila.esperado or 0)).quantize(
+                    Decimal("0.01")
+                ),
+            }
+            for fila in filas
+        ]
+
+    def _conciliar_saldos_clientes(aplicar: bool) -> dict:
+        diferencias = _diferencias_saldo_clientes()
+        if aplicar and diferencias:
+            db.session.execute(
+                db.update(Cliente),
+                [
+                    {"id": d["cliente_id"], "saldo": d["saldo_esperado"]}
+                    for d in diferencias
+                ],
+            )
+            db.session.commit()
+        return {
+            "aplicado": bool(aplicar),
+            "clientes_con_diferencia": len(diferencias),
+            "diferencia_total": float(
+                sum(d["saldo_esperado"] - d["saldo_actual"] for d in diferencias)
+            ),
+            "diferencias": [
+                {
+                    **d,
+                    "saldo_actual": float(d["saldo_actual"]),
+                    "saldo_esperado": float(d["saldo_esperado"]),
+                    "diferencia": float(d["saldo_esperado"] - d["saldo_actual"]),
+                }
+                for d in diferencias
+            ],
+        }
+
+    @app.route("/clientes/conciliar-saldos", methods=["GET", "POST"])
+    def conciliar_saldos_clientes():
+        """GET solo reporta las diferencias; POST ademas corrige Cliente.saldo."""
+        return jsonify(_conciliar_saldos_clientes(aplicar=request.method == "POST"))
+
+    @app.cli.command("conciliar-saldos-clientes")
+    @click.option("--aplicar", is_flag=True, help="Corrige Cliente.saldo en bloque.")
+    def conciliar_saldos_clientes_cli(aplicar):
+        """Compara Cliente.saldo con el saldo de sus ordenes y bancos."""
+        resultado = _conciliar_saldos_clientes(aplicar)
+        for d in resultado["diferencias"]:
+            click.echo(
+                f"{d['codigo']}: actual {d['saldo_actual']:.2f} "
+                f"esperado {d['saldo_esperado']:.2f} "
+                f"diferencia {d['diferencia']:.2f}"
+            )
+        accion = "corregidos" if aplicar else "con diferencia"
+        click.echo(f"{resultado['clientes_con_diferencia']} clientes {accion}")
+
+    @app.cli.command("calcular-anticipos-ordenes")
+    def calcular_anticipos_ordenes():
+        """Rellena Orden.anticipo en ordenes enviadas antes de que existiera.
+
+        Los bancos asignados de cada cliente se reaplican con
+        cartera.asignar_pagos sobre sus ordenes enviadas o pagadas, partiendo
+        del total; lo que el saldo real quede por debajo de esa simulacion se
+        pago antes del envio, sin pasar de lo abonado que los bancos no
+        explican. Solo toca ordenes con anticipo 0.
+        """
+        cliente_ids = [
+            cliente_id
+            for (cliente_id,) in db.session.query(Orden.cliente_id)
+            .filter(Orden.estado_id.in_((3, 4)), Orden.anticipo == 0)
+            .distinct()
+        ]
+        actualizadas = 0
+        for cliente_id in cliente_ids:
+            filas = (
+                db.session.query(
+                    Orden.id,
+                    Orden.total,
+                    Orden.saldo,
+                    Orden.anticipo,
+                    Orden.estado_id,
+                    Orden.fecha,
+                    Orden.fecha_envio,
+                    Orden.fecha_pago,
+                    TipoPago.nombre.label("tipo_pago"),
+                )
+                .outerjoin(TipoPago, TipoPago.id == Orden.tipo_pago_id)
+                .filter(Orden.cliente_id == cliente_id, Orden.estado_id.in_((3, 4)))
+                .order_by(Orden.id)
+            )
+            ordenes = []
+            for fila in filas:
+                orden = fila._asdict()
+                orden["dias_credito"] = cartera.dias_credito(orden.pop("tipo_pago"))
+                ordenes.append(orden)
+            bancos = [
+                {"monto": fila.monto, "fecha": fila.fecha}
+                for fila in db.session.query(Bancos.monto, Bancos.fecha)
+                .filter(Bancos.cliente_id == cliente_id, Bancos.asignado.is_(True))
+                .order_by(Bancos.fecha, Bancos.id)
             ]
-            if not pendientes:
-                break
+            simulado = cartera.asignar_pagos(ordenes, bancos, date.today())
+            # Lo abonado que los bancos no explican; acota la simulacion.
+            disponible = sum(
+                (
+                    Decimal(str(o["total"] or 0)) - Decimal(str(o["saldo"] or 0))
+                    - Decimal(str(o["anticipo"] or 0))
+                    for o in ordenes
+                ),
+                Decimal("0"),
+            ) - sum((Decimal(str(b["monto"] or 0)) for b in bancos), Decimal("0"))
+            anticipos = []
+            for orden in ordenes:
+                if orden["anticipo"] or disponible <= 0:
+                    continue
+                anticipo = simulado[orden["id"]]["saldo"] - Decimal(
+                    str(orden["saldo"] or 0)
+                )
+                if anticipo > 0:
+                    anticipo = min(anticipo, disponible)
+                    disponible -= anticipo
+                    anticipos.append({"id": orden["id"], "anticipo": anticipo})
+            if anticipos:
+                db.session.execute(update(Orden), anticipos)
+                db.session.commit()
+                actualizadas += len(anticipos)
+        click.echo(f"Ordenes con anticipo calculado: {actualizadas}")
+
+    # ---------- ANTIGUEDAD DE SALDOS ----------
+
+    def _refrescar_antiguedad_clientes(cliente_ids) -> None:
+        """Recalcula cartera_vencimientos de los clientes indicados.
+
+        Debe llamarse antes del commit cuando cambian saldo, estado_id,
+        fecha_envio, fecha, tipo_pago_id o cliente_id de sus ordenes. Las filas
+        de los clientes se bloquean (en orden de id) para que dos refrescos
+        concurrentes no choquen en uq_cartera_vencimiento_cliente_fecha.
+        """
+        ids = {cliente_id for cliente_id in cliente_ids if cliente_id}
+        if not ids:
+            return
+        db.session.query(Cliente.id).filter(Cliente.id.in_(ids)).order_by(
+            Cliente.id
+        ).with_for_update().all()
+        gracia = {tp.id: _dias_gracia(tp) for tp in TipoPago.query.all()}
+        fecha_base = func.coalesce(Orden.fecha_envio, Orden.fecha)
+        q = (
+            db.session.query(
+                Orden.cliente_id,
+                Orden.tipo_pago_id,
+                fecha_base.label("fecha_base"),
+                func.sum(Orden.saldo).label("saldo"),
+                func.count(Orden.id).label("ordenes"),
+            )
+            .filter(Orden.cliente_id.in_(ids), Orden.estado_id == 3, Orden.saldo > 0)
+            .group_by(Orden.cliente_id, Orden.tipo_pago_id, fecha_base)
+        )
+        vencimientos = {}
+        for fila in q:
+            fecha_limite = _a_fecha(fila.fecha_base) + timedelta(
+                days=gracia.get(fila.tipo_pago_id, 0)
+            )
+            acumulado = vencimientos.setdefault(
+                (fila.cliente_id, fecha_limite), [Decimal("0"), 0]
+            )
+            acumulado[0] += Decimal(str(fila.saldo))
+            acumulado[1] += fila.ordenes
+
+        CarteraVencimiento.query.filter(CarteraVencimiento.cliente_id.in_(ids)).delete(
+            synchronize_session=False
+        )
+        if vencimientos:
+            db.session.execute(
+                db.insert(CarteraVencimiento),
+                [
+                    {
+                        "cliente_id": cliente_id,
+                        "fecha_limite": fecha_limite,
+                        "saldo": saldo,
+                        "ordenes": ordenes,
+                    }
+                    for (cliente_id, fecha_limite), (saldo, ordenes) in (
+                        vencimientos.items()
+                    )
+                ],
+            )
+
+    @app.cli.command("reconstruir-antiguedad-saldos")
+    @click.option("--lote", default=500, show_default=True, help="Clientes por lote.")
+    def reconstruir_antiguedad_saldos(lote):
+        """Recalcula cartera_vencimientos para todos los clientes."""
+        ids = [
+            cliente_id
+            for (cliente_id,) in db.session.query(Cliente.id).order_by(Cliente.id)
+        ]
+        for inicio in range(0, len(ids), lote):
+            _refrescar_antiguedad_clientes(ids[inicio : inicio + lote])
+            db.session.commit()
+        click.echo(f"Antiguedad de saldos reconstruida para {len(ids)} clientes")
+
+    TRAMOS_ANTIGUEDAD = (
+        ("corriente", None, 0),
+        ("dias_1_30", 1, 30),
+        ("dias_31_60", 31, 60),
+        ("dias_61_90", 61, 90),
+        ("dias_90_mas", 91, None),
+    )
+
+    def _columnas_antiguedad(hoy: date):
+        """Sumas de saldo por tramo de dias vencidos (hoy - fecha_limite)."""
+        columnas = []
+        for nombre, dias_min, dias_max in TRAMOS_ANTIGUEDAD:
+            condiciones = []
+            if dias_min is not None:
+                condiciones.append(
+                    CarteraVencimiento.fecha_limite <= hoy - timedelta(days=dias_min)
+                )
+            if dias_max is not None:
+                condiciones.append(
+                    CarteraVencimiento.fecha_limite >= hoy - timedelta(days=dias_max)
+                )
+            saldo_tramo = case(
+                (and_(*condiciones), CarteraVencimiento.saldo), else_=0
+            )
+            columnas.append(func.coalesce(func.sum(saldo_tramo), 0).label(nombre))
+        columnas.append(
+            func.coalesce(func.sum(CarteraVencimiento.saldo), 0).label("total")
+        )
+        columnas.append(
+            func.coalesce(func.sum(CarteraVencimiento.ordenes), 0).label("ordenes")
+        )
+        return columnas
+
+    def _antiguedad_to_dict(fila) -> dict:
+        data = {
+            nombre: float(getattr(fila, nombre)) for nombre, _, _ in TRAMOS_ANTIGUEDAD
+        }
+        data["total"] = float(fila.total)
+        data["vencido"] = data["total"] - data["corriente"]
+        data["ordenes"] = int(fila.ordenes)
+        return data
+
+    @app.route("/clientes/<int:cliente_id>/antiguedad-saldos", methods=["GET"])
+    def antiguedad_saldos_cliente(cliente_id: int):
+        cliente = Cliente.query.get_or_404(cliente_id)
+        hoy = date.today()
+        fila = (
+            db.session.query(*_columnas_antiguedad(hoy))
+            .filter(CarteraVencimiento.cliente_id == cliente.id)
+            .one()
+        )
+        vencimientos = (
+            CarteraVencimiento.query.filter_by(cliente_id=cliente.id)
+            .order_by(CarteraVencimiento.fecha_limite)
+            .all()
+        )
+        data = {
+            "cliente_id": cliente.id,
+            "codigo": cliente.codigo,
+            "nombre": cliente.nombre,
+        }
+        data.update(_antiguedad_to_dict(fila))
+        data["vencimientos"] = [
+            {
+                "fecha_limite": v.fecha_limite.isoformat(),
+                "dias_vencido": max((hoy - v.fecha_limite).days, 0),
+                "saldo": float(v.saldo),
+                "ordenes": v.ordenes,
+            }
+            for v in vencimientos
+        ]
+        return jsonify(data)
+
+    @app.route("/reportes/antiguedad-saldos", methods=["GET"])
+    def reporte_antiguedad_saldos():
+        try:
+            paginacion = _paginacion_opcional()
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+        hoy = date.today()
+        q = (
+            db.session.query(
+                Cliente.id, Cliente.codigo, Cliente.nombre, *_columnas_antiguedad(hoy)
+            )
+            .join(CarteraVencimiento, CarteraVencimiento.cliente_id == Cliente.id)
+            .group_by(Cliente.id, Cliente.codigo, Cliente.nombre)
+        )
+        if _parse_bool(request.args.get("solo_vencidos"), default=False):
+            q = q.having(func.min(CarteraVencimiento.fecha_limite) < hoy)
+        q = q.order_by(Cliente.id)
+
+        def to_dict(fila):
+            data = {"cliente_id": fila.id, "codigo": fila.codigo, "nombre": fila.nombre}
+            data.update(_antiguedad_to_dict(fila))
+            return data
 
-            ordenes_ordenadas = _ordenes_ordenadas_para_abono(pendientes, today)
-            for orden in ordenes_ordenadas:
-                if restante <= 0:
-                    break
-                saldo_actual = Decimal(str(orden.saldo or 0))
-                if saldo_actual <= 0:
-                    continue
-                aplicar = saldo_actual if saldo_actual <= restante else restante
-                nuevo_saldo = saldo_actual - aplicar
-                if nuevo_saldo <= 0:
-                    orden.saldo = Decimal("0.00")
-                    orden.estado_id = 4
-                    if (
-                        estado_anterior.get(orden.id) == 4
-                        and fecha_pago_anterior.get(orden.id) is not None
-                    ):
-                        orden.fecha_pago = fecha_pago_anterior.get(orden.id)
-                    else:
-                        orden.fecha_pago = fecha_aplicacion
-                else:
-                    orden.saldo = nuevo_saldo
-                restante -= aplicar
+        return _respuesta_paginada(q, to_dict, paginacion)
 
-        # Intencionalmente no se toca cliente.saldo; el saldo se refleja en las ordenes.
+    # ---------- ESTADO DE CUENTA ----------
 
-    @app.route("/clientes/<int:cliente_id>/recalcular-cartera", methods=["POST"])
-    def recalcular_cartera_cliente_endpoint(cliente_id: int):
+    def _movimientos_cliente(cliente_id: int):
+        """Cargos (ordenes enviadas o pagadas) UNION ALL abonos (bancos asignados).
+
+        La fila de cada orden abona su anticipo (lo pagado antes del envio), asi
+        el neto coincide con lo que _registrar_envio_completo sumo a Cliente.saldo.
+        """
+        cargos = db.session.query(
+            literal("orden", db.String).label("tipo"),
+            Orden.id.label("id"),
+            func.coalesce(Orden.fecha_envio, Orden.fecha).label("fecha"),
+            Orden.codigo_orden.label("referencia"),
+            Orden.total.label("cargo"),
+            Orden.anticipo.label("abono"),
+        ).filter(Orden.cliente_id == cliente_id, Orden.estado_id.in_((3, 4)))
+        abonos = db.session.query(
+            literal("pago", db.String).label("tipo"),
+            Bancos.id.label("id"),
+            Bancos.fecha.label("fecha"),
+            Bancos.referencia.label("referencia"),
+            literal(0, Numeric(12, 2)).label("cargo"),
+            Bancos.monto.label("abono"),
+        ).filter(Bancos.cliente_id == cliente_id, Bancos.asignado.is_(True))
+        return cargos.union_all(abonos).subquery()
+
+    @app.route("/clientes/<int:cliente_id>/estado-cuenta", methods=["GET"])
+    def estado_cuenta_cliente(cliente_id: int):
         cliente = Cliente.query.get_or_404(cliente_id)
-        _recalcular_cartera_cliente(cliente.id)
-        db.session.commit()
+        try:
+            desde = _parse_fecha(request.args.get("desde"))
+            hasta = _parse_fecha(request.args.get("hasta"))
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
 
-        ordenes = (
-            Orden.query.filter_by(cliente_id=cliente.id)
-            .order_by(Orden.id)
-            .all()
-        )
-        return jsonify(
-            {
-                "cliente_id": cliente.id,
-                "cliente_saldo": float(cliente.saldo or 0),
-                "ordenes": [orden_to_dict(o) for o in ordenes],
-            }
+        movimientos = _movimientos_cliente(cliente.id)
+        saldo_inicial = Decimal("0")
+        if desde:
+            saldo_inicial = Decimal(
+                str(
+                    db.session.query(
+                        func.coalesce(
+                            func.sum(movimientos.c.cargo - movimientos.c.abono), 0
+                        )
+                    )
+                    .filter(movimientos.c.fecha < desde)
+                    .scalar()
+                )
+            )
+
+        # En un mismo dia las ordenes ("orden") van antes que los pagos ("pago").
+        orden = (movimientos.c.fecha, movimientos.c.tipo, movimientos.c.id)
+        q = db.session.query(
+            movimientos,
+            func.sum(movimientos.c.cargo - movimientos.c.abono)
+            .over(order_by=orden, rows=(None, 0))
+            .label("acumulado"),
         )
+        if desde:
+            q = q.filter(movimientos.c.fecha >= desde)
+        if hasta:
+            q = q.filter(movimientos.c.fecha <= hasta)
+        q = q.order_by(*orden).execution_options(yield_per=500)
+
+        encabezado = {
+            "cliente_id": cliente.id,
+            "codigo": cliente.codigo,
+            "nombre": cliente.nombre,
+            "desde": desde.isoformat() if desde else None,
+            "hasta": hasta.isoformat() if hasta else None,
+            "saldo_inicial": float(saldo_inicial),
+        }
+
+        def generar():
+            # Se emite el JSON por partes para no armar historiales largos en memoria.
+            yield json.dumps(encabezado)[:-1] + ', "movimientos": ['
+            saldo = saldo_inicial
+            for i, fila in enumerate(q):
+                saldo = saldo_inicial + Decimal(str(fila.acumulado))
+                fecha = _a_fecha(fila.fecha)
+                movimiento = {
+                    "tipo": fila.tipo,
+                    "id": fila.id,
+                    "fecha": fecha.isoformat() if fecha else None,
+                    "referencia": fila.referencia,
+                    "cargo": float(fila.cargo or 0),
+                    "abono": float(fila.abono or 0),
+                    "saldo": float(saldo),
+                }
+                yield ("," if i else "") + json.dumps(movimiento)
+            yield '], "saldo_final": ' + json.dumps(float(saldo)) + "}"
+
+        return Response(stream_with_context(generar()), mimetype="application/json")
 
     def banco_to_dict(banco: Bancos) -> dict:
         return {
@@ -806,6 +2607,7 @@ def create_app():
         return jsonify(banco_to_dict(pago))
 
     @app.route("/bancos", methods=["POST"])
+    @idempotencia.idempotente
     def crear_banco():
         data = request.get_json(silent=True) or {}
 
@@ -943,12 +2745,14 @@ def create_app():
                 restante -= revertir
 
             cliente.saldo = (cliente.saldo or 0) + Decimal(pago.monto)
+            _refrescar_antiguedad_clientes([cliente.id])
 
         db.session.delete(pago)
         db.session.commit()
         return jsonify({"message": "Pago eliminado"})
 
     @app.route("/ordenes/abonos", methods=["POST"])
+    @idempotencia.idempotente
     def crear_abono_orden():
         data = request.get_json(silent=True) or {}
         cliente_id = data.get("cliente_id")
@@ -1027,6 +2831,7 @@ def create_app():
         banco.cliente_id = cliente_id
         # Permite saldo a favor en el mismo campo cuando el abono excede el saldo total.
         cliente.saldo = (cliente.saldo or 0) - Decimal(banco.monto)
+        _refrescar_antiguedad_clientes([cliente.id])
 
         db.session.commit()
         return (
@@ -1232,8 +3037,12 @@ def create_app():
 
     @app.route("/tipos_pago", methods=["GET"])
     def listar_tipos_pago():
-        tipos = TipoPago.query.order_by(TipoPago.id).all()
-        return jsonify([tipopago_to_dict(t) for t in tipos])
+        return _respuesta_condicional(
+            _etag_catalogo(TipoPago),
+            lambda: [
+                tipopago_to_dict(t) for t in TipoPago.query.order_by(TipoPago.id).all()
+            ],
+        )
 
     @app.route("/tipos_pago/<int:tipopago_id>", methods=["GET"])
     def obtener_tipo_pago(tipopago_id: int):
@@ -1301,8 +3110,13 @@ def create_app():
 
     @app.route("/estados_orden", methods=["GET"])
     def listar_estados_orden():
-        estados = EstadoOrden.query.order_by(EstadoOrden.id).all()
-        return jsonify([estadoorden_to_dict(e) for e in estados])
+        return _respuesta_condicional(
+            _etag_catalogo(EstadoOrden),
+            lambda: [
+                estadoorden_to_dict(e)
+                for e in EstadoOrden.query.order_by(EstadoOrden.id).all()
+            ],
+        )
 
     @app.route("/estados_orden/<int:estado_id>", methods=["GET"])
     def obtener_estado_orden(estado_id: int):
@@ -1395,19 +3209,43 @@ def create_app():
             raise LookupError(f"{field_name} no encontrado")
         return obj
 
-    def _parse_items(items_payload):
+    def _id_entero(valor):
+        """Id entero o texto numerico ("1") como int; None si no es un id."""
+        if isinstance(valor, bool):
+            return None
+        if isinstance(valor, int):
+            return valor
+        if isinstance(valor, str) and valor.strip().isdigit():
+            return int(valor)
+        return None
+
+    def _parse_items(items_payload, productos=None, cliente=None, fecha=None):
+        """Valida los items de una orden.
+
+        productos: mapa {id: Producto} ya precargado (lotes); si se omite se
+        cargan con una sola consulta. Con cliente, los items sin precio toman
+        el precio resuelto para ese cliente y fecha (_resolver_precios).
+        """
         if items_payload is None:
             return []
         if not isinstance(items_payload, list) or not items_payload:
             raise ValueError("items debe ser una lista no vacía")
+        if productos is None:
+            ids = {
+                _id_entero(item.get("producto_id"))
+                for item in items_payload
+                if isinstance(item, dict)
+            }
+            productos = _precargar(Producto, ids - {None})
         parsed_items = []
+        sin_precio = []
         for item in items_payload:
             if not isinstance(item, dict):
                 raise ValueError("Cada item debe ser un objeto")
-            producto_id = item.get("producto_id")
+            producto_id = _id_entero(item.get("producto_id"))
             cantidad = item.get("cantidad", 1)
             precio = item.get("precio")
-            producto = Producto.query.get(producto_id)
+            producto = productos.get(producto_id)
             if not producto:
                 raise LookupError("producto_id no encontrado")
             if not producto.es_producto_final:
@@ -1423,7 +3261,9 @@ def create_app():
             except ValueError as exc:
                 raise ValueError(str(exc))
             if precio_val is None:
-                raise ValueError("precio es requerido")
+                if cliente is None:
+                    raise ValueError("precio es requerido")
+                sin_precio.append(len(parsed_items))
             parsed_items.append(
                 {
                     "producto_id": producto_id,
@@ -1431,6 +3271,17 @@ def create_app():
                     "precio": precio_val,
                 }
             )
+
+        if sin_precio:
+            precios = _resolver_precios(
+                cliente,
+                {productos[parsed_items[i]["producto_id"]] for i in sin_precio},
+                fecha,
+            )
+            for i in sin_precio:
+                parsed_items[i]["precio"] = float(
+                    precios[parsed_items[i]["producto_id"]][0]
+                )
         return parsed_items
 
     def _generar_codigo_orden(cliente_codigo: str) -> str:
@@ -1441,6 +3292,34 @@ def create_app():
             codigo = f"{cliente_codigo}-{ts}"
         return codigo
 
+    def _generar_codigos_orden(cliente_codigos) -> list:
+        """Version por lote de _generar_codigo_orden: un codigo por elemento.
+
+        Los codigos repetidos de un mismo cliente avanzan el timestamp y los
+        choques con ordenes existentes se resuelven con una consulta IN por
+        ronda en lugar de una por codigo.
+        """
+        ts = int(datetime.utcnow().timestamp())
+        siguiente = {}
+        codigos = []
+        for cliente_codigo in cliente_codigos:
+            siguiente[cliente_codigo] = siguiente.get(cliente_codigo, ts - 1) + 1
+            codigos.append(f"{cliente_codigo}-{siguiente[cliente_codigo]}")
+        while True:
+            ocupados = {
+                fila[0]
+                for fila in db.session.query(Orden.codigo_orden).filter(
+                    Orden.codigo_orden.in_(codigos)
+                )
+            }
+            if not ocupados:
+                return codigos
+            for i, codigo in enumerate(codigos):
+                if codigo in ocupados:
+                    cliente_codigo = cliente_codigos[i]
+                    siguiente[cliente_codigo] += 1
+                    codigos[i] = f"{cliente_codigo}-{siguiente[cliente_codigo]}"
+
     @app.route("/ordenes", methods=["GET"])
     def listar_ordenes():
         inicio = request.args.get('inicio')
@@ -1459,6 +3338,7 @@ def create_app():
         return jsonify(orden_to_dict(orden))
 
     @app.route("/ordenes", methods=["POST"])
+    @idempotencia.idempotente
     def crear_orden():
         data = request.get_json(silent=True) or {}
         try:
@@ -1486,7 +3366,7 @@ def create_app():
             return jsonify({"error": str(exc)}), 404
 
         try:
-            items = _parse_items(data.get("items"))
+            items = _parse_items(data.get("items"), cliente=cliente, fecha=fecha)
         except ValueError as exc:
             return jsonify({"error": str(exc)}), 400
         except LookupError as exc:
@@ -1524,14 +3404,287 @@ def create_app():
             )
             db.session.add(orden_item)
 
+        _refrescar_antiguedad_clientes([orden.cliente_id])
         db.session.commit()
         return jsonify(orden_to_dict(orden)), 201
 
+    LOTE_ORDENES_MAX = 500
+
+    def _ids_lote(ordenes_payload, campo: str, items: bool = False) -> set:
+        fuentes = ordenes_payload
+        if items:
+            fuentes = [
+                item
+                for orden in ordenes_payload
+                if isinstance(orden, dict) and isinstance(orden.get("items"), list)
+                for item in orden["items"]
+            ]
+        ids = {
+            _id_entero(fuente.get(campo))
+            for fuente in fuentes
+            if isinstance(fuente, dict)
+        }
+        return ids - {None}
+
+    def _precargar(model, ids) -> dict:
+        if not ids:
+            return {}
+        return {obj.id: obj for obj in model.query.filter(model.id.in_(ids))}
+
+    def _validar_orden_lote(data, catalogos) -> dict:
+        """Mismas reglas que crear_orden contra catalogos precargados.
+
+        Lanza ValueError (400) o LookupError (404) como _validate_fk.
+        """
+        if not isinstance(data, dict):
+            raise ValueError("Cada orden debe ser un objeto")
+        fecha = _parse_fecha(data.get("fecha"))
+        fecha_envio = _parse_fecha(data.get("fecha_envio"))
+        fecha_pago = _parse_fecha(data.get("fecha_pago"))
+
+        ids = {"usuario_id": None}
+        for campo, requerido in (
+            ("usuario_id", False),
+            ("tipo_pago_id", True),
+            ("estado_id", True),
+            ("cliente_id", True),
+        ):
+            valor = data.get(campo)
+            if valor is None:
+                if requerido:
+                    raise ValueError(f"El campo {campo} es requerido")
+                continue
+            if not isinstance(valor, (int, str)) or isinstance(valor, bool):
+                raise ValueError(f"El campo {campo} debe ser entero")
+            ids[campo] = _id_entero(valor)
+            if ids[campo] not in catalogos[campo]:
+                raise LookupError(f"{campo} no encontrado")
+
+        items = _parse_items(
+            data.get("items"),
+            productos=catalogos["producto_id"],
+            cliente=catalogos["cliente_id"][ids["cliente_id"]],
+            fecha=fecha,
+        )
+        total = sum(item["precio"] * item["cantidad"] for item in items)
+        saldo = _parse_precio(data.get("saldo"), "saldo") if "saldo" in data else None
+        if saldo is None:
+            saldo = total
+        return {
+            "fecha": fecha or datetime.utcnow().date(),
+            "fecha_envio": fecha_envio,
+            "fecha_pago": fecha_pago,
+            **ids,
+            "total": total,
+            "saldo": saldo,
+            "items": items,
+        }
+
+    @app.route("/ordenes/lote", methods=["POST"])
+    @idempotencia.idempotente
+    def crear_ordenes_lote():
+        """Crea varias ordenes (sincronizacion de tablets) en una transaccion.
+
+        Los catalogos se validan con una consulta IN por tabla y las ordenes e
+        items se insertan por lote. Las ordenes invalidas se reportan por
+        indice sin impedir que se creen las demas.
+        """
+        data = request.get_json(silent=True) or {}
+        ordenes_payload = data.get("ordenes")
+        if not isinstance(ordenes_payload, list) or not ordenes_payload:
+            return jsonify({"error": "ordenes debe ser una lista no vacía"}), 400
+        if len(ordenes_payload) > LOTE_ORDENES_MAX:
+            return (
+                jsonify({"error": f"Máximo {LOTE_ORDENES_MAX} ordenes por lote"}),
+                400,
+            )
+
+        catalogos = {
+            "usuario_id": _precargar(Usuario, _ids_lote(ordenes_payload, "usuario_id")),
+            "tipo_pago_id": _precargar(
+                TipoPago, _ids_lote(ordenes_payload, "tipo_pago_id")
+            ),
+            "estado_id": _precargar(
+                EstadoOrden, _ids_lote(ordenes_payload, "estado_id")
+            ),
+            "cliente_id": _precargar(Cliente, _ids_lote(ordenes_payload, "cliente_id")),
+            "producto_id": _precargar(
+                Producto, _ids_lote(ordenes_payload, "producto_id", items=True)
+            ),
+        }
+
+        resultados = [None] * len(ordenes_payload)
+        validas = []
+        for indice, orden_data in enumerate(ordenes_payload):
+            try:
+                validas.append((indice, _validar_orden_lote(orden_data, catalogos)))
+            except ValueError as exc:
+                resultados[indice] = {
+                    "indice": indice,
+                    "ok": False,
+                    "status": 400,
+                    "error": str(exc),
+                }
+            except LookupError as exc:
+                resultados[indice] = {
+                    "indice": indice,
+                    "ok": False,
+                    "status": 404,
+                    "error": str(exc),
+                }
+
+        if validas:
+            codigos = _generar_codigos_orden(
+                [
+                    catalogos["cliente_id"][orden["cliente_id"]].codigo.strip()
+                    for _, orden in validas
+                ]
+            )
+            ahora = datetime.utcnow()
+            filas_orden = []
+            for (_, orden), codigo in zip(validas, codigos):
+                fila = {k: v for k, v in orden.items() if k != "items"}
+                fila.update(codigo_orden=codigo, creado_en=ahora, actualizado_en=ahora)
+                filas_orden.append(fila)
+            ids = db.session.scalars(
+                insert(Orden).returning(Orden.id, sort_by_parameter_order=True),
+                filas_orden,
+            ).all()
+
+            filas_item = [
+                {
+                    "orden_id": orden_id,
+                    "producto_id": item["producto_id"],
+                    "precio": item["precio"],
+                    "cantidad": item["cantidad"],
+                    "creado_en": ahora,
+                    "actualizado_en": ahora,
+                }
+                for orden_id, (_, orden) in zip(ids, validas)
+                for item in orden["items"]
+            ]
+            if filas_item:
+                db.session.execute(insert(OrdenItem), filas_item)
+
+            for orden_id, fila, (indice, orden) in zip(ids, filas_orden, validas):
+                resultados[indice] = {
+                    "indice": indice,
+                    "ok": True,
+                    "status": 201,
+                    "orden": {
+                        "id": orden_id,
+                        "codigo_orden": fila["codigo_orden"],
+                        "cliente_id": fila["cliente_id"],
+                        "total": float(fila["total"]),
+                        "saldo": float(fila["saldo"]),
+                        "items": len(orden["items"]),
+                    },
+                }
+
+            _refrescar_antiguedad_clientes({fila["cliente_id"] for fila in filas_orden})
+            db.session.commit()
+
+        creadas = len(validas)
+        fallidas = len(ordenes_payload) - creadas
+        if not fallidas:
+            status = 201
+        elif creadas:
+            status = 207
+        else:
+            status = 400
+        resumen = {"creadas": creadas, "fallidas": fallidas, "resultados": resultados}
+        return jsonify(resumen), status
+
+    def _sincronizar_items_orden(orden: Orden, nuevos_items, ids_items) -> Decimal:
+        """Aplica la lista de items recibida como diff sobre los items actuales.
+
+        Cada item se empareja por id (entero o texto numerico, si viene) o por
+        producto_id con un item existente aun no emparejado. Solo se actualizan
+        las filas que cambian, se insertan las nuevas y las sobrantes se borran
+        con un DELETE. Devuelve el total de la orden calculado con los items
+        resultantes.
+        """
+        actuales = OrdenItem.query.filter_by(orden_id=orden.id).order_by(OrdenItem.id)
+        por_id = {item.id: item for item in actuales}
+        libres_por_producto = {}
+        for item in por_id.values():
+            libres_por_producto.setdefault(item.producto_id, []).append(item)
+
+        emparejados = []
+        ids_vistos = set()
+        for item, valor_id in zip(nuevos_items, ids_items):
+            existente = None
+            if valor_id is not None:
+                item_id = _id_entero(valor_id)
+                if item_id is None:
+                    raise ValueError("item id debe ser entero")
+                existente = por_id.get(item_id)
+                if existente is None:
+                    raise ValueError(f"item id {item_id} no pertenece a la orden")
+                if item_id in ids_vistos:
+                    raise ValueError(f"item id {item_id} repetido")
+                ids_vistos.add(item_id)
+                libres = libres_por_producto.get(existente.producto_id, [])
+                if existente in libres:
+                    libres.remove(existente)
+            emparejados.append((existente, item))
+        for i, (existente, item) in enumerate(emparejados):
+            if existente is None:
+                libres = libres_por_producto.get(item["producto_id"])
+                if libres:
+                    emparejados[i] = (libres.pop(0), item)
+
+        usados = {existente.id for existente, _ in emparejados if existente is not None}
+        eliminados = [item_id for item_id in por_id if item_id not in usados]
+
+        enviados = _cantidades_enviadas(orden.id)
+        for item_id in eliminados:
+            if enviados.get(item_id):
+                raise ValueError(f"item id {item_id} tiene envios registrados")
+        for existente, item in emparejados:
+            if existente is None or not enviados.get(existente.id):
+                continue
+            if existente.producto_id != item["producto_id"]:
+                raise ValueError(f"item id {existente.id} tiene envios registrados")
+            if item["cantidad"] < enviados[existente.id]:
+                raise ValueError(
+                    f"item id {existente.id}: cantidad menor que lo ya enviado "
+                    f"({enviados[existente.id]})"
+                )
+        if eliminados:
+            OrdenItem.query.filter(OrdenItem.id.in_(eliminados)).delete(
+                synchronize_session=False
+            )
+
+        total = Decimal("0")
+        for existente, item in emparejados:
+            precio = Decimal(str(item["precio"])).quantize(Decimal("0.01"))
+            cantidad = item["cantidad"]
+            total += precio * cantidad
+            if existente is None:
+                db.session.add(
+                    OrdenItem(
+                        orden_id=orden.id,
+                        producto_id=item["producto_id"],
+                        precio=precio,
+                        cantidad=cantidad,
+                    )
+                )
+                continue
+            if existente.producto_id != item["producto_id"]:
+                existente.producto_id = item["producto_id"]
+            if Decimal(str(existente.precio)) != precio:
+                existente.precio = precio
+            if existente.cantidad != cantidad:
+                existente.cantidad = cantidad
+        return total
+
     @app.route("/ordenes/<int:orden_id>", methods=["PUT", "PATCH"])
     def actualizar_orden(orden_id: int):
         orden = Orden.query.get_or_404(orden_id)
         data = request.get_json(silent=True) or {}
         estado_anterior_id = orden.estado_id
+        cliente_anterior_id = orden.cliente_id
 
         if "fecha" in data:
             try:
@@ -1603,25 +3756,21 @@ def create_app():
 
         if "items" in data:
             try:
-                nuevos_items = _parse_items(data.get("items"))
+                nuevos_items = _parse_items(
+                    data.get("items"),
+                    cliente=Cliente.query.get(orden.cliente_id),
+                    fecha=orden.fecha,
+                )
             except ValueError as exc:
                 return jsonify({"error": str(exc)}), 400
             except LookupError as exc:
                 return jsonify({"error": str(exc)}), 404
 
-            OrdenItem.query.filter_by(orden_id=orden.id).delete()
-            for item in nuevos_items:
-                db.session.add(
-                    OrdenItem(
-                        orden_id=orden.id,
-                        producto_id=item["producto_id"],
-                        precio=item["precio"],
-                        cantidad=item["cantidad"],
-                    )
-                )
-            orden.total = sum(
-                item["precio"] * item["cantidad"] for item in nuevos_items
-            )
+            ids_items = [item.get("id") for item in data.get("items") or []]
+            try:
+                orden.total = _sincronizar_items_orden(orden, nuevos_items, ids_items)
+            except ValueError as exc:
+                return jsonify({"error": str(exc)}), 400
 
         if "saldo" in data:
             try:
@@ -1631,38 +3780,265 @@ def create_app():
 
         if "estado_id" in data and data.get("estado_id") == 3:
             if estado_anterior_id != 3:
-                items = OrdenItem.query.filter_by(orden_id=orden.id).all()
-                for item in items:
-                    producto = Producto.query.get(item.producto_id)
-                    if not producto:
-                        return jsonify({"error": "Producto no encontrado"}), 404
-                    disponible = Decimal(str(producto.stock_actual or 0))
-                    cantidad = Decimal(str(item.cantidad or 0))
-                    if disponible < cantidad:
-                        return (
-                            jsonify(
-                                {
-                                    "error": f"Stock insuficiente para {producto.codigo}"
-                                }
-                            ),
-                            400,
+                # Lo ya despachado en envios parciales descontó su stock.
+                enviados = _cantidades_enviadas(orden.id)
+                pendientes = {}
+                for item in OrdenItem.query.filter_by(orden_id=orden.id):
+                    cantidad = int(item.cantidad or 0) - enviados.get(item.id, 0)
+                    if cantidad > 0:
+                        pendientes[item.producto_id] = (
+                            pendientes.get(item.producto_id, 0) + cantidad
                         )
-                    producto.stock_actual = disponible - cantidad
-            cliente = Cliente.query.get(orden.cliente_id)
-            tenia_saldo_a_favor = False
-            if cliente:
-                tenia_saldo_a_favor = Decimal(str(cliente.saldo or 0)) < 0
-                cliente.saldo = (cliente.saldo or 0) + Decimal(orden.saldo)
-            orden.fecha_envio = date.today()
-            if tenia_saldo_a_favor:
-                _recalcular_cartera_cliente(orden.cliente_id)
+                try:
+                    _descontar_stock(pendientes)
+                except ValueError as exc:
+                    return jsonify({"error": str(exc)}), 400
+                except LookupError as exc:
+                    return jsonify({"error": str(exc)}), 404
+            _registrar_envio_completo(
+                orden, date.today(), primer_envio=estado_anterior_id != 3
+            )
 
+        _refrescar_antiguedad_clientes({cliente_anterior_id, orden.cliente_id})
         db.session.commit()
         return jsonify(orden_to_dict(orden))
 
+    # ---------- ENVIOS PARCIALES ----------
+    def _cantidades_enviadas(orden_id: int) -> dict:
+        """{orden_item_id: unidades ya enviadas} de una orden."""
+        filas = (
+            db.session.query(
+                EnvioOrdenItem.orden_item_id, func.sum(EnvioOrdenItem.cantidad)
+            )
+            .join(EnvioOrden, EnvioOrden.id == EnvioOrdenItem.envio_id)
+            .filter(EnvioOrden.orden_id == orden_id)
+            .group_by(EnvioOrdenItem.orden_item_id)
+        )
+        return {item_id: int(total or 0) for item_id, total in filas}
+
+    def _descontar_stock(cantidades: dict) -> None:
+        """Descuenta {producto_id: cantidad} del stock con un solo UPDATE.
+
+        Valida antes todo el lote (filas bloqueadas en Postgres); lanza
+        LookupError si falta un producto y ValueError si no alcanza el stock.
+        """
+        if not cantidades:
+            return
+        filas = (
+            db.session.query(Producto.id, Producto.codigo, Producto.stock_actual)
+            .filter(Producto.id.in_(list(cantidades)))
+            .with_for_update()
+        )
+        disponibles = {fila.id: fila for fila in filas}
+        for producto_id, cantidad in cantidades.items():
+            fila = disponibles.get(producto_id)
+            if fila is None:
+                raise LookupError("Producto no encontrado")
+            if Decimal(str(fila.stock_actual or 0)) < cantidad:
+                raise ValueError(f"Stock insuficiente para {fila.codigo}")
+        _ajustar_stock({pid: -cantidad for pid, cantidad in cantidades.items()})
+
+    def _ajustar_stock(deltas: dict) -> None:
+        if not deltas:
+            return
+        delta = case(deltas, value=Producto.id)
+        db.session.execute(
+            update(Producto)
+            .where(Producto.id.in_(list(deltas)))
+            .values(stock_actual=Producto.stock_actual + delta)
+        )
+
+    def _registrar_envio_completo(
+        orden: Orden, fecha: date, primer_envio: bool = True
+    ) -> None:
+        """Efectos de pasar una orden a estado 3: entra a la cartera del cliente.
+
+        El anticipo solo se fija en el primer paso a estado 3; despues el saldo
+        ya puede incluir bancos aplicados.
+        """
+        cliente = Cliente.query.get(orden.cliente_id)
+        tenia_saldo_a_favor = False
+        if cliente:
+            tenia_saldo_a_favor = Decimal(str(cliente.saldo or 0)) < 0
+            cliente.saldo = (cliente.saldo or 0) + Decimal(orden.saldo)
+            if primer_envio:
+                orden.anticipo = Decimal(str(orden.total or 0)) - Decimal(orden.saldo)
+        orden.fecha_envio = fecha
+        if tenia_saldo_a_favor:
+            _recalcular_cartera_cliente(orden.cliente_id)
+
+    def _envios_orden_dict(orden: Orden) -> dict:
+        envios = EnvioOrden.query.filter_by(orden_id=orden.id).order_by(EnvioOrden.id)
+        envios = envios.all()
+        items_envio = {}
+        if envios:
+            filas = EnvioOrdenItem.query.filter(
+                EnvioOrdenItem.envio_id.in_([envio.id for envio in envios])
+            ).order_by(EnvioOrdenItem.id)
+            for fila in filas:
+                items_envio.setdefault(fila.envio_id, []).append(
+                    {
+                        "id": fila.id,
+                        "orden_item_id": fila.orden_item_id,
+                        "cantidad": fila.cantidad,
+                    }
+                )
+
+        enviados = _cantidades_enviadas(orden.id)
+        items = []
+        for item in OrdenItem.query.filter_by(orden_id=orden.id).order_by(OrdenItem.id):
+            enviado = enviados.get(item.id, 0)
+            items.append(
+                {
+                    "orden_item_id": item.id,
+                    "producto_id": item.producto_id,
+                    "cantidad": item.cantidad,
+                    "enviado": enviado,
+                    "pendiente": max(int(item.cantidad or 0) - enviado, 0),
+                }
+            )
+        return {
+            "orden_id": orden.id,
+            "estado_id": orden.estado_id,
+            "fecha_envio": orden.fecha_envio.isoformat() if orden.fecha_envio else None,
+            "envios": [
+                {
+                    "id": envio.id,
+                    "fecha": envio.fecha.isoformat() if envio.fecha else None,
+                    "usuario_id": envio.usuario_id,
+                    "creado_en": (
+                        envio.creado_en.isoformat() if envio.creado_en else None
+                    ),
+                    "items": items_envio.get(envio.id, []),
+                }
+                for envio in envios
+            ],
+            "items": items,
+        }
+
+    @app.route("/ordenes/<int:orden_id>/envios", methods=["GET"])
+    def listar_envios_orden(orden_id: int):
+        orden = Orden.query.get_or_404(orden_id)
+        return jsonify(_envios_orden_dict(orden))
+
+    @app.route("/ordenes/<int:orden_id>/envios", methods=["POST"])
+    @idempotencia.idempotente
+    def crear_envio_orden(orden_id: int):
+        """Registra un envio parcial de una orden confirmada en bodega (estado 2).
+
+        Solo se envian los items incluidos, hasta su cantidad pendiente. El
+        stock se descuenta por envio; cuando no queda nada pendiente la orden
+        pasa a estado 3 y entra a la cartera del cliente por su total. La orden
+        se bloquea antes de leer lo ya enviado para que dos envios simultaneos
+        no despachen el mismo pendiente.
+        """
+        orden = (
+            Orden.query.filter_by(id=orden_id)
+            .populate_existing()
+            .with_for_update()
+            .first_or_404()
+        )
+        if orden.estado_id != 2:
+            mensaje = "Solo se pueden enviar órdenes confirmadas en bodega"
+            return jsonify({"error": mensaje}), 400
+
+        data = request.get_json(silent=True) or {}
+        try:
+            fecha = _parse_fecha(data.get("fecha")) or date.today()
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+        usuario_id = data.get("usuario_id")
+        if usuario_id is not None:
+            try:
+                _validate_fk(Usuario, usuario_id, "usuario_id")
+            except LookupError as exc:
+                return jsonify({"error": str(exc)}), 404
+
+        payload_items = data.get("items")
+        if not isinstance(payload_items, list) or not payload_items:
+            return jsonify({"error": "items debe ser una lista no vacía"}), 400
+
+        items_por_id = {
+            item.id: item for item in OrdenItem.query.filter_by(orden_id=orden.id)
+        }
+        enviados = _cantidades_enviadas(orden.id)
+        cantidades = {}
+        for entry in payload_items:
+            if not isinstance(entry, dict):
+                return jsonify({"error": "Cada item debe ser un objeto"}), 400
+            item_id = _id_entero(entry.get("id"))
+            if item_id is None:
+                return jsonify({"error": "item id debe ser entero"}), 400
+            if item_id not in items_por_id:
+                mensaje = f"item id {item_id} no pertenece a la orden"
+                return jsonify({"error": mensaje}), 400
+            if item_id in cantidades:
+                return jsonify({"error": f"item id {item_id} duplicado"}), 400
+            try:
+                cantidad = int(entry.get("cantidad"))
+            except (TypeError, ValueError):
+                return jsonify({"error": "cantidad debe ser un entero"}), 400
+            if cantidad <= 0:
+                return jsonify({"error": "cantidad debe ser mayor que cero"}), 400
+            pendiente = int(items_por_id[item_id].cantidad or 0) - enviados.get(
+                item_id, 0
+            )
+            if cantidad > pendiente:
+                mensaje = (
+                    f"item id {item_id}: cantidad ({cantidad}) mayor que lo "
+                    f"pendiente ({pendiente})"
+                )
+                return jsonify({"error": mensaje}), 400
+            cantidades[item_id] = cantidad
+
+        por_producto = {}
+        for item_id, cantidad in cantidades.items():
+            producto_id = items_por_id[item_id].producto_id
+            por_producto[producto_id] = por_producto.get(producto_id, 0) + cantidad
+        try:
+            _descontar_stock(por_producto)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+        except LookupError as exc:
+            return jsonify({"error": str(exc)}), 404
+
+        envio = EnvioOrden(orden_id=orden.id, fecha=fecha, usuario_id=usuario_id)
+        db.session.add(envio)
+        db.session.flush()
+        db.session.execute(
+            insert(EnvioOrdenItem),
+            [
+                {"envio_id": envio.id, "orden_item_id": item_id, "cantidad": cantidad}
+                for item_id, cantidad in cantidades.items()
+            ],
+        )
+
+        completa = all(
+            enviados.get(item_id, 0) + cantidades.get(item_id, 0)
+            >= int(item.cantidad or 0)
+            for item_id, item in items_por_id.items()
+        )
+        if completa:
+            orden.estado_id = 3
+            _registrar_envio_completo(orden, fecha)
+            _refrescar_antiguedad_clientes([orden.cliente_id])
+
+        db.session.commit()
+        respuesta = _envios_orden_dict(orden)
+        respuesta["envio_id"] = envio.id
+        respuesta["orden_completa"] = completa
+        return jsonify(respuesta), 201
+
     @app.route("/ordenes/<int:orden_id>/split", methods=["POST"])
     def dividir_orden(orden_id: int):
         orden = Orden.query.get_or_404(orden_id)
+        if _cantidades_enviadas(orden.id):
+            return (
+                jsonify(
+                    {"error": "La orden tiene envios parciales, usa /envios"}
+                ),
+                400,
+            )
 
         if orden.estado_id != 2:
             return (
@@ -1853,11 +4229,27 @@ def create_app():
                     producto.stock_actual = Decimal(
                         str(producto.stock_actual or 0)
                     ) + Decimal(str(item.cantidad or 0))
+        else:
+            # Envios parciales de una orden que no llego a completarse.
+            enviados = _cantidades_enviadas(orden.id)
+            if enviados:
+                reponer = {}
+                for item in OrdenItem.query.filter(OrdenItem.id.in_(list(enviados))):
+                    reponer[item.producto_id] = (
+                        reponer.get(item.producto_id, 0) + enviados[item.id]
+                    )
+                _ajustar_stock(reponer)
 
+        envio_ids = select(EnvioOrden.id).where(EnvioOrden.orden_id == orden.id)
+        EnvioOrdenItem.query.filter(EnvioOrdenItem.envio_id.in_(envio_ids)).delete(
+            synchronize_session=False
+        )
+        EnvioOrden.query.filter_by(orden_id=orden.id).delete()
         OrdenItem.query.filter_by(orden_id=orden.id).delete()
         db.session.delete(orden)
 
         _recalcular_cartera_cliente(cliente_id)
+        _refrescar_antiguedad_clientes([cliente_id])
 
         db.session.commit()
         return jsonify(
@@ -2578,8 +4970,10 @@ def create_app():
 
     @app.route("/procesos", methods=["GET"])
     def listar_procesos():
-        procesos = Proceso.query.order_by(Proceso.id).all()
-        return jsonify([proceso_to_dict(p) for p in procesos])
+        return _respuesta_condicional(
+            _etag_catalogo(Proceso),
+            lambda: [proceso_to_dict(p) for p in Proceso.query.order_by(Proceso.id).all()],
+        )
 
     @app.route("/procesos/<int:proceso_id>", methods=["GET"])
     def obtener_proceso(proceso_id: int):
@@ -2720,23 +5114,409 @@ def create_app():
         if "tiempo_objetivo_min" in data:
             item.tiempo_objetivo_min = data.get("tiempo_objetivo_min")
 
-        if "activo" in data:
-            item.activo = _parse_bool(data.get("activo"), default=item.activo)
+        if "activo" in data:
+            item.activo = _parse_bool(data.get("activo"), default=item.activo)
+
+        db.session.commit()
+        return jsonify(producto_proceso_to_dict(item))
+
+    @app.route(
+        "/productos/<int:producto_id>/ruta-procesos/<int:item_id>",
+        methods=["DELETE"],
+    )
+    def eliminar_ruta_proceso(producto_id: int, item_id: int):
+        item = ProductoProceso.query.filter_by(
+            id=item_id, producto_id=producto_id
+        ).first_or_404()
+        db.session.delete(item)
+        db.session.commit()
+        return jsonify({"message": "Ruta de proceso eliminada"})
+
+    # ---------- DEFINICION DE PRODUCTO (RUTA, BOM, COMPONENTES) ----------
+
+    # Seccion -> (modelo, hoja del xlsx de definiciones).
+    SECCIONES_DEFINICION = {
+        "ruta": (ProductoProceso, "ruta"),
+        "bom": (ProductoMateriaPrima, "bom"),
+        "componentes": (ProductoComponente, "componentes"),
+    }
+
+    def _ref_definicion(entrada: dict, campo: str):
+        """Referencia por id (campo_id) o por codigo/nombre (campo).
+
+        campo_id debe ser un id entero (o texto numerico); ValueError si no.
+        """
+        for clave in (f"{campo}_id", campo):
+            valor = entrada.get(clave)
+            if isinstance(valor, float) and valor.is_integer():
+                valor = int(valor)
+            if isinstance(valor, str):
+                valor = valor.strip() or None
+            if valor is None:
+                continue
+            if clave == campo:
+                return valor
+            referencia = _id_entero(valor)
+            if referencia is None:
+                raise ValueError(f"{clave} debe ser entero")
+            return referencia
+        return None
+
+    def _mapa_referencias(model, columna_clave, valores) -> dict:
+        """{id: id, clave: id} de los valores pedidos, con una sola consulta."""
+        ids = {v for v in valores if isinstance(v, int) and not isinstance(v, bool)}
+        claves = {v for v in valores if isinstance(v, str)}
+        if not ids and not claves:
+            return {}
+        columna = getattr(model, columna_clave)
+        mapa = {}
+        filas = db.session.query(model.id, columna).filter(
+            or_(model.id.in_(ids), columna.in_(claves))
+        )
+        for fila_id, clave in filas:
+            mapa[fila_id] = fila_id
+            mapa[clave] = fila_id
+        return mapa
+
+    def _resolver_ref(mapa: dict, valor, campo: str) -> int:
+        if valor is None:
+            raise ValueError(f"{campo} es requerido")
+        if (
+            not isinstance(valor, (int, str))
+            or isinstance(valor, bool)
+            or valor not in mapa
+        ):
+            raise ValueError(f"{campo} no encontrado: {valor}")
+        return mapa[valor]
+
+    def _entero(valor, campo: str, requerido: bool = True):
+        if valor is None or (isinstance(valor, str) and not valor.strip()):
+            if requerido:
+                raise ValueError(f"{campo} es requerido")
+            return None
+        try:
+            numero = Decimal(str(valor))
+        except InvalidOperation:
+            raise ValueError(f"{campo} debe ser entero")
+        if not numero.is_finite() or numero != numero.to_integral_value():
+            raise ValueError(f"{campo} debe ser entero")
+        return int(numero)
+
+    def _entradas(definicion: dict, seccion: str) -> list:
+        entradas = definicion.get(seccion)
+        if entradas is None:
+            return []
+        if not isinstance(entradas, list):
+            raise ValueError(f"{seccion} debe ser una lista")
+        return entradas
+
+    def _fila_material(entrada, producto_id, mapa, campo, procesos, en_ruta) -> dict:
+        """Fila de BOM (materia_prima) o de componentes (componente)."""
+        referencia = _resolver_ref(mapa, _ref_definicion(entrada, campo), campo)
+        if campo == "componente" and referencia == producto_id:
+            raise ValueError("El componente no puede ser el mismo producto")
+        proceso_id = None
+        proceso = _ref_definicion(entrada, "proceso")
+        if proceso is not None:
+            proceso_id = _resolver_ref(procesos, proceso, "proceso")
+            if proceso_id not in en_ruta:
+                raise ValueError("proceso no pertenece a la ruta del producto")
+        cantidad = _parse_decimal(
+            entrada.get("cantidad_necesaria"), "cantidad_necesaria"
+        )
+        if cantidad is None:
+            raise ValueError("cantidad_necesaria es requerida")
+        merma = _parse_decimal(
+            entrada.get("merma_estandar"), "merma_estandar", default=Decimal("0")
+        )
+        notas = entrada.get("notas")
+        if notas is not None:
+            notas = str(notas).strip() or None
+        return {
+            "producto_id": producto_id,
+            f"{campo}_id": referencia,
+            "proceso_id": proceso_id,
+            "cantidad_necesaria": cantidad,
+            "merma_estandar": merma,
+            "notas": notas,
+        }
+
+    def _reemplazar_definiciones(definiciones: list, aplicar: bool = True):
+        """Valida y reemplaza ruta, BOM y componentes de varios productos.
+
+        Cada definicion es {producto, ruta?, bom?, componentes?}; solo se
+        reemplazan las secciones presentes (una lista vacia las borra). Las
+        referencias (producto, proceso, materia_prima, componente) aceptan id o
+        codigo/nombre y se resuelven con mapas precargados. Devuelve
+        (resumen, errores); si hay errores no se escribe nada. No hace commit.
+        """
+        valores = {"producto": set(), "proceso": set(), "materia_prima": set()}
+        for definicion in definiciones:
+            if not isinstance(definicion, dict):
+                continue
+            try:
+                valores["producto"].add(_ref_definicion(definicion, "producto"))
+            except ValueError:
+                pass
+            for seccion, campos in (
+                ("ruta", ("proceso",)),
+                ("bom", ("materia_prima", "proceso")),
+                ("componentes", ("componente", "proceso")),
+            ):
+                entradas = definicion.get(seccion)
+                if not isinstance(entradas, list):
+                    continue
+                for entrada in entradas:
+                    if not isinstance(entrada, dict):
+                        continue
+                    for campo in campos:
+                        clave = "producto" if campo == "componente" else campo
+                        try:
+                            valor = _ref_definicion(entrada, campo)
+                        except ValueError:
+                            continue
+                        if isinstance(valor, (int, str)):
+                            valores[clave].add(valor)
+        productos = _mapa_referencias(Producto, "codigo", valores["producto"])
+        materias = _mapa_referencias(MateriaPrima, "codigo", valores["materia_prima"])
+        procesos = _mapa_referencias(Proceso, "nombre", valores["proceso"])
+
+        errores = []
+        resueltas = []
+        vistos = set()
+        for indice, definicion in enumerate(definiciones):
+            if not isinstance(definicion, dict):
+                errores.append({"indice": indice, "error": "Debe ser un objeto"})
+                continue
+            referencia = definicion.get("producto_id", definicion.get("producto"))
+            try:
+                referencia = _ref_definicion(definicion, "producto")
+                producto_id = _resolver_ref(productos, referencia, "producto")
+            except ValueError as exc:
+                errores.append({"producto": referencia, "error": str(exc)})
+                continue
+            if producto_id in vistos:
+                errores.append({"producto": referencia, "error": "producto repetido"})
+                continue
+            vistos.add(producto_id)
+            resueltas.append((producto_id, referencia, definicion))
+
+        sin_ruta = [pid for pid, _, d in resueltas if "ruta" not in d]
+        rutas = {}
+        if sin_ruta:
+            filas = db.session.query(
+                ProductoProceso.producto_id, ProductoProceso.proceso_id
+            ).filter(
+                ProductoProceso.producto_id.in_(sin_ruta),
+                ProductoProceso.activo.is_(True),
+            )
+            for producto_id, proceso_id in filas:
+                rutas.setdefault(producto_id, set()).add(proceso_id)
+
+        filas_por_seccion = {seccion: [] for seccion in SECCIONES_DEFINICION}
+        reemplazos = {seccion: [] for seccion in SECCIONES_DEFINICION}
+
+        def _error(referencia, seccion, i, entrada, mensaje):
+            error = {"producto": referencia, "seccion": seccion, "error": mensaje}
+            if isinstance(entrada, dict) and "_fila" in entrada:
+                error["fila"] = entrada["_fila"]
+            else:
+                error["indice"] = i
+            errores.append(error)
+
+        for producto_id, referencia, definicion in resueltas:
+            en_ruta = rutas.get(producto_id, set())
+            if "ruta" in definicion:
+                en_ruta = set()
+                ordenes = set()
+                asignados = set()
+                try:
+                    entradas = _entradas(definicion, "ruta")
+                except ValueError as exc:
+                    _error(referencia, "ruta", None, None, str(exc))
+                    entradas = []
+                for i, entrada in enumerate(entradas):
+                    try:
+                        if not isinstance(entrada, dict):
+                            raise ValueError("Cada elemento debe ser un objeto")
+                        proceso_id = _resolver_ref(
+                            procesos, _ref_definicion(entrada, "proceso"), "proceso"
+                        )
+                        orden = _entero(entrada.get("orden"), "orden")
+                        if orden in ordenes:
+                            raise ValueError("Ya existe un proceso con ese orden")
+                        if proceso_id in asignados:
+                            raise ValueError("El proceso ya está asignado al producto")
+                        activo = _parse_bool(entrada.get("activo"), default=True)
+                        fila = {
+                            "producto_id": producto_id,
+                            "proceso_id": proceso_id,
+                            "orden": orden,
+                            "tiempo_objetivo_min": _entero(
+                                entrada.get("tiempo_objetivo_min"),
+                                "tiempo_objetivo_min",
+                                requerido=False,
+                            ),
+                            "activo": activo,
+                        }
+                    except ValueError as exc:
+                        _error(referencia, "ruta", i, entrada, str(exc))
+                        continue
+                    ordenes.add(orden)
+                    asignados.add(proceso_id)
+                    if activo:
+                        en_ruta.add(proceso_id)
+                    filas_por_seccion["ruta"].append(fila)
+                reemplazos["ruta"].append(producto_id)
+
+            for seccion, campo, mapa in (
+                ("bom", "materia_prima", materias),
+                ("componentes", "componente", productos),
+            ):
+                if seccion not in definicion:
+                    continue
+                try:
+                    entradas = _entradas(definicion, seccion)
+                except ValueError as exc:
+                    _error(referencia, seccion, None, None, str(exc))
+                    entradas = []
+                usados = set()
+                for i, entrada in enumerate(entradas):
+                    try:
+                        if not isinstance(entrada, dict):
+                            raise ValueError("Cada elemento debe ser un objeto")
+                        fila = _fila_material(
+                            entrada, producto_id, mapa, campo, procesos, en_ruta
+                        )
+                        if fila[f"{campo}_id"] in usados:
+                            raise ValueError(f"{campo} repetido en el producto")
+                    except ValueError as exc:
+                        _error(referencia, seccion, i, entrada, str(exc))
+                        continue
+                    usados.add(fila[f"{campo}_id"])
+                    filas_por_seccion[seccion].append(fila)
+                reemplazos[seccion].append(producto_id)
+
+        resumen = {
+            "productos": len(resueltas),
+            **{seccion: len(filas) for seccion, filas in filas_por_seccion.items()},
+        }
+        if errores or not aplicar:
+            return resumen, errores
+
+        ahora = datetime.utcnow()
+        for seccion, (model, _) in SECCIONES_DEFINICION.items():
+            if reemplazos[seccion]:
+                model.query.filter(model.producto_id.in_(reemplazos[seccion])).delete(
+                    synchronize_session=False
+                )
+        for seccion, (model, _) in SECCIONES_DEFINICION.items():
+            filas = filas_por_seccion[seccion]
+            if filas:
+                for fila in filas:
+                    fila.update(creado_en=ahora, actualizado_en=ahora)
+                db.session.execute(insert(model), filas)
+        return resumen, errores
+
+    def _definicion_producto_dict(producto_id: int) -> dict:
+        ruta = ProductoProceso.query.filter_by(producto_id=producto_id).order_by(
+            ProductoProceso.orden
+        )
+        bom = ProductoMateriaPrima.query.filter_by(producto_id=producto_id).order_by(
+            ProductoMateriaPrima.id
+        )
+        componentes = ProductoComponente.query.filter_by(
+            producto_id=producto_id
+        ).order_by(ProductoComponente.id)
+        return {
+            "producto_id": producto_id,
+            "ruta": [producto_proceso_to_dict(i) for i in ruta],
+            "bom": [producto_materia_prima_to_dict(i) for i in bom],
+            "componentes": [producto_componente_to_dict(i) for i in componentes],
+        }
 
-        db.session.commit()
-        return jsonify(producto_proceso_to_dict(item))
+    @app.route("/productos/<int:producto_id>/definicion", methods=["GET"])
+    def obtener_definicion_producto(producto_id: int):
+        Producto.query.get_or_404(producto_id)
+        return jsonify(_definicion_producto_dict(producto_id))
 
-    @app.route(
-        "/productos/<int:producto_id>/ruta-procesos/<int:item_id>",
-        methods=["DELETE"],
-    )
-    def eliminar_ruta_proceso(producto_id: int, item_id: int):
-        item = ProductoProceso.query.filter_by(
-            id=item_id, producto_id=producto_id
-        ).first_or_404()
-        db.session.delete(item)
+    @app.route("/productos/<int:producto_id>/definicion", methods=["PUT"])
+    def reemplazar_definicion_producto(producto_id: int):
+        """Reemplaza en una transaccion las secciones enviadas del producto."""
+        Producto.query.get_or_404(producto_id)
+        data = request.get_json(silent=True) or {}
+        definicion = {
+            seccion: data[seccion]
+            for seccion in SECCIONES_DEFINICION
+            if seccion in data
+        }
+        if not definicion:
+            return jsonify({"error": "Envía ruta, bom y/o componentes"}), 400
+        definicion["producto_id"] = producto_id
+        _, errores = _reemplazar_definiciones([definicion])
+        if errores:
+            db.session.rollback()
+            return jsonify({"error": errores[0]["error"], "errores": errores}), 400
         db.session.commit()
-        return jsonify({"message": "Ruta de proceso eliminada"})
+        return jsonify(_definicion_producto_dict(producto_id))
+
+    def _definiciones_desde_xlsx(hojas: dict) -> list:
+        """Agrupa las filas de las hojas Ruta, BOM y Componentes por producto.
+
+        Las referencias de texto se toman como codigo (producto, materia_prima,
+        componente) o nombre (proceso), aunque Excel las lea como numeros.
+        """
+        definiciones = {}
+        for seccion, (_, hoja) in SECCIONES_DEFINICION.items():
+            for fila in hojas.get(hoja, []):
+                for campo in ("producto", "proceso", "materia_prima", "componente"):
+                    valor = fila.get(campo)
+                    if isinstance(valor, float) and valor.is_integer():
+                        valor = int(valor)
+                    if valor is not None:
+                        fila[campo] = str(valor).strip()
+                producto = fila.get("producto") or ""
+                definicion = definiciones.setdefault(producto, {"producto": producto})
+                definicion.setdefault(seccion, []).append(fila)
+        return list(definiciones.values())
+
+    @app.route("/productos/definiciones", methods=["POST"])
+    def importar_definiciones_productos():
+        """Reemplaza ruta, BOM y componentes de varios productos a la vez.
+
+        JSON {"productos": [{producto_id|producto, ruta?, bom?, componentes?}]}
+        o un xlsx (multipart, campo "archivo") con hojas Ruta, BOM y
+        Componentes y una columna producto (codigo) en cada una. Todo se valida
+        antes de escribir y se aplica en una transaccion; validar=true solo
+        valida.
+        """
+        archivo = request.files.get("archivo")
+        if archivo:
+            opciones = request.form
+            try:
+                definiciones = _definiciones_desde_xlsx(_hojas_xlsx(archivo.stream))
+            except ValueError as exc:
+                return jsonify({"error": str(exc)}), 400
+        else:
+            opciones = request.get_json(silent=True) or {}
+            definiciones = opciones.get("productos")
+            if not isinstance(definiciones, list):
+                return jsonify({"error": "productos debe ser una lista"}), 400
+        if not definiciones:
+            return jsonify({"error": "No hay definiciones para importar"}), 400
+        solo_validar = _parse_bool(opciones.get("validar"), default=False)
+
+        resumen, errores = _reemplazar_definiciones(
+            definiciones, aplicar=not solo_validar
+        )
+        resumen.update(errores=errores[:200], total_errores=len(errores))
+        if errores:
+            db.session.rollback()
+            return jsonify(resumen), 400
+        if not solo_validar:
+            db.session.commit()
+        resumen["validar"] = solo_validar
+        return jsonify(resumen)
 
     @app.route("/ordenes-produccion", methods=["GET"])
     def listar_ordenes_produccion():
@@ -2930,8 +5710,18 @@ def create_app():
         ConsumoProductoComponente.query.filter_by(
             orden_produccion_id=orden.id
         ).delete()
+        # Los procesos completados de una orden cancelada cuentan en
+        # kpi_proceso_diario; se recalculan sus dias tras borrarlos.
+        buckets = {
+            (proceso.fin.date(), proceso.proceso_id)
+            for proceso in orden.procesos.filter(
+                ProcesoOrden.estado == "COMPLETADO", ProcesoOrden.fin.isnot(None)
+            )
+        }
         ProcesoOrden.query.filter_by(orden_produccion_id=orden.id).delete()
         db.session.delete(orden)
+        for dia, proceso_id in buckets:
+            _refrescar_kpi_procesos(dia, dia, proceso_id, orden.producto_id)
         db.session.commit()
         return jsonify({"message": "Orden de producción eliminada"})
 
@@ -2960,6 +5750,7 @@ def create_app():
         orden = OrdenProduccion.query.get_or_404(orden_id)
         if orden.estado == "CANCELADA":
             return jsonify({"error": "La orden ya está cancelada"}), 400
+        estado_previo = orden.estado
         orden.estado = "CANCELADA"
         if not orden.fecha_fin:
             orden.fecha_fin = datetime.utcnow()
@@ -2982,6 +5773,10 @@ def create_app():
                     Decimal(str(componente.stock_reservado or 0)) - restante,
                     Decimal("0"),
                 )
+        if estado_previo == "COMPLETADA":
+            # La orden deja de contar como cerrada en los KPIs de su dia.
+            dia = orden.fecha_fin.date()
+            _refrescar_kpi_productos(dia, dia, orden.producto_id)
         db.session.commit()
         return jsonify(orden_produccion_to_dict(orden, include_detalle=True))
 
@@ -3012,6 +5807,8 @@ def create_app():
                 orden.cantidad_final_buena = ultimo.cantidad_salida
         if estado_previo != "COMPLETADA":
             _incrementar_stock_producto(orden, orden.cantidad_final_buena)
+        dia = orden.fecha_fin.date()
+        _refrescar_kpi_productos(dia, dia, orden.producto_id)
         db.session.commit()
         return jsonify(orden_produccion_to_dict(orden, include_detalle=True))
 
@@ -3182,6 +5979,12 @@ def create_app():
                 orden.cantidad_final_buena = proceso_orden.cantidad_salida
             _incrementar_stock_producto(orden, orden.cantidad_final_buena)
 
+        if orden:
+            dia = proceso_orden.fin.date()
+            _refrescar_kpi_procesos(dia, dia, proceso_orden.proceso_id, orden.producto_id)
+            if orden.estado == "COMPLETADA":
+                dia = orden.fecha_fin.date()
+                _refrescar_kpi_productos(dia, dia, orden.producto_id)
         db.session.commit()
         return jsonify(proceso_orden_to_dict(proceso_orden))
 
@@ -3555,117 +6358,881 @@ def create_app():
 
     # ---------- REPORTES ----------
 
+    def _minutos_entre(inicio, fin):
+        """Expresion SQL con los minutos transcurridos entre dos datetime."""
+        if db.engine.dialect.name == "postgresql":
+            return func.extract("epoch", fin - inicio) / 60
+        # SQLite: segundos epoch (strftime devuelve texto, SQLite lo convierte).
+        return (func.strftime("%s", fin) - func.strftime("%s", inicio)) / 60.0
+
+    def _paginacion_opcional():
+        """Los reportes solo paginan si se pide; sin parametros devuelven todo."""
+        if "pagina" not in request.args and "por_pagina" not in request.args:
+            return None
+        return _parse_paginacion(por_pagina_default=100, por_pagina_max=1000)
+
+    def _respuesta_paginada(q, to_dict, paginacion):
+        if paginacion is None:
+            return jsonify([to_dict(fila) for fila in q.all()])
+        pagina, por_pagina = paginacion
+        total = q.order_by(None).count()
+        filas = q.offset((pagina - 1) * por_pagina).limit(por_pagina).all()
+        resp = jsonify([to_dict(fila) for fila in filas])
+        resp.headers["X-Total-Count"] = str(total)
+        return resp
+
+    def _float_o_none(valor):
+        return float(valor) if valor is not None else None
+
     @app.route("/reportes/tiempo-total-orden", methods=["GET"])
     def reporte_tiempo_total_orden():
         desde = request.args.get("desde")
         hasta = request.args.get("hasta")
+        agrupar = (request.args.get("agrupar") or "").strip().lower() or None
         try:
             desde_dt = _parse_datetime(desde, "desde") if desde else None
             hasta_dt = _parse_datetime(hasta, "hasta") if hasta else None
+            paginacion = _paginacion_opcional()
         except ValueError as exc:
             return jsonify({"error": str(exc)}), 400
+        if agrupar not in (None, "producto", "estado"):
+            return jsonify({"error": "agrupar debe ser producto o estado"}), 400
 
-        ordenes = OrdenProduccion.query.all()
-        resultados = []
-        now = datetime.utcnow()
-        for orden in ordenes:
-            if desde_dt and orden.fecha_inicio and orden.fecha_inicio < desde_dt:
-                continue
-            if hasta_dt and orden.fecha_inicio and orden.fecha_inicio > hasta_dt:
-                continue
-            if not orden.fecha_inicio:
-                duracion_min = None
-            else:
-                fin = orden.fecha_fin or now
-                duracion_min = (fin - orden.fecha_inicio).total_seconds() / 60
-            resultados.append(
-                {
-                    "orden_id": orden.id,
-                    "codigo": orden.codigo,
-                    "duracion_min": duracion_min,
-                }
+        duracion = _minutos_entre(
+            OrdenProduccion.fecha_inicio,
+            func.coalesce(OrdenProduccion.fecha_fin, datetime.utcnow()),
+        )
+        filtros = []
+        # Las ordenes sin fecha_inicio no tienen ventana y siempre se listan.
+        if desde_dt:
+            filtros.append(
+                or_(
+                    OrdenProduccion.fecha_inicio.is_(None),
+                    OrdenProduccion.fecha_inicio >= desde_dt,
+                )
             )
-        return jsonify(resultados)
+        if hasta_dt:
+            filtros.append(
+                or_(
+                    OrdenProduccion.fecha_inicio.is_(None),
+                    OrdenProduccion.fecha_inicio <= hasta_dt,
+                )
+            )
+
+        if agrupar is None:
+            q = (
+                db.session.query(
+                    OrdenProduccion.id, OrdenProduccion.codigo, duracion.label("duracion")
+                )
+                .filter(*filtros)
+                .order_by(OrdenProduccion.id)
+            )
+            return _respuesta_paginada(
+                q,
+                lambda fila: {
+                    "orden_id": fila.id,
+                    "codigo": fila.codigo,
+                    "duracion_min": _float_o_none(fila.duracion),
+                },
+                paginacion,
+            )
+
+        clave = (
+            OrdenProduccion.producto_id
+            if agrupar == "producto"
+            else OrdenProduccion.estado
+        )
+        q = (
+            db.session.query(
+                clave.label("clave"),
+                func.count(OrdenProduccion.id).label("ordenes"),
+                func.count(OrdenProduccion.fecha_inicio).label("iniciadas"),
+                func.avg(duracion).label("promedio"),
+                func.sum(duracion).label("total"),
+                func.max(duracion).label("maximo"),
+            )
+            .filter(*filtros)
+            .group_by(clave)
+            .order_by(clave)
+        )
+        campo = "producto_id" if agrupar == "producto" else "estado"
+        return _respuesta_paginada(
+            q,
+            lambda fila: {
+                campo: fila.clave,
+                "ordenes": fila.ordenes,
+                "ordenes_iniciadas": fila.iniciadas,
+                "duracion_promedio_min": _float_o_none(fila.promedio),
+                "duracion_total_min": _float_o_none(fila.total),
+                "duracion_max_min": _float_o_none(fila.maximo),
+            },
+            paginacion,
+        )
+
+    PERCENTILES_PROCESO = (("p50_min", 0.5), ("p90_min", 0.9), ("p99_min", 0.99))
+
+    def _percentiles_por_grupo(clave, valor, filtros, percentiles):
+        """Percentiles (interpolacion lineal) por grupo sin traer todas las filas.
+
+        Una ventana numera los valores ordenados de cada grupo y solo se leen
+        las filas vecinas a la posicion de cada percentil.
+        """
+        sub = (
+            db.session.query(
+                clave.label("clave"),
+                valor.label("valor"),
+                func.row_number()
+                .over(partition_by=clave, order_by=valor)
+                .label("rn"),
+                func.count().over(partition_by=clave).label("n"),
+            )
+            .filter(*filtros)
+            .subquery()
+        )
+        # Posicion 0-based del percentil p: p * (n - 1); se necesitan floor y ceil.
+        condiciones = [
+            func.abs(sub.c.rn - 1 - p * (sub.c.n - 1)) < 1 for _, p in percentiles
+        ]
+        valores = {}
+        for fila in db.session.query(sub.c.clave, sub.c.rn, sub.c.n, sub.c.valor).filter(
+            or_(*condiciones)
+        ):
+            grupo = valores.setdefault(fila.clave, {"n": fila.n, "rn": {}})
+            grupo["rn"][fila.rn - 1] = float(fila.valor)
+
+        resultado = {}
+        for clave_grupo, grupo in valores.items():
+            calculados = {}
+            for nombre, p in percentiles:
+                pos = p * (grupo["n"] - 1)
+                bajo = int(pos)
+                alto = min(bajo + 1, grupo["n"] - 1)
+                v_bajo = grupo["rn"][bajo]
+                v_alto = grupo["rn"].get(alto, v_bajo)
+                calculados[nombre] = v_bajo + (v_alto - v_bajo) * (pos - bajo)
+            resultado[clave_grupo] = calculados
+        return resultado
 
     @app.route("/reportes/tiempo-por-proceso", methods=["GET"])
     def reporte_tiempo_por_proceso():
-        procesos = Proceso.query.all()
-        proceso_map = {p.id: p.nombre for p in procesos}
-        items = ProcesoOrden.query.filter(
-            ProcesoOrden.inicio.isnot(None), ProcesoOrden.fin.isnot(None)
-        ).all()
-        detalle = []
-        agregados = {}
-        for item in items:
-            duracion = (item.fin - item.inicio).total_seconds() / 60
-            detalle.append(
-                {
-                    "orden_produccion_id": item.orden_produccion_id,
-                    "proceso_id": item.proceso_id,
-                    "proceso_nombre": proceso_map.get(item.proceso_id),
-                    "duracion_min": duracion,
-                }
+        desde = request.args.get("desde")
+        hasta = request.args.get("hasta")
+        producto_id = request.args.get("producto_id")
+        incluir_detalle = _parse_bool(request.args.get("incluir_detalle"), default=False)
+        try:
+            producto_id = int(producto_id) if producto_id else None
+        except (TypeError, ValueError):
+            return jsonify({"error": "producto_id debe ser entero"}), 400
+        try:
+            desde_dt = _parse_datetime(desde, "desde") if desde else None
+            hasta_dt = _parse_datetime(hasta, "hasta") if hasta else None
+            paginacion = (
+                _parse_paginacion(por_pagina_default=100, por_pagina_max=1000)
+                if incluir_detalle
+                else None
+            )
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+
+        duracion = _minutos_entre(ProcesoOrden.inicio, ProcesoOrden.fin)
+        filtros = [ProcesoOrden.inicio.isnot(None), ProcesoOrden.fin.isnot(None)]
+        if desde_dt:
+            filtros.append(ProcesoOrden.inicio >= desde_dt)
+        if hasta_dt:
+            filtros.append(ProcesoOrden.inicio <= hasta_dt)
+        if producto_id:
+            filtros.append(
+                ProcesoOrden.orden_produccion_id.in_(
+                    db.session.query(OrdenProduccion.id).filter(
+                        OrdenProduccion.producto_id == producto_id
+                    )
+                )
+            )
+
+        proceso_map = dict(db.session.query(Proceso.id, Proceso.nombre))
+        agregados = (
+            db.session.query(
+                ProcesoOrden.proceso_id,
+                func.count(ProcesoOrden.id).label("registros"),
+                func.avg(duracion).label("promedio"),
+                func.sum(duracion).label("suma"),
+                func.sum(duracion * duracion).label("suma_cuadrados"),
+                func.min(duracion).label("minimo"),
+                func.max(duracion).label("maximo"),
             )
-            agg = agregados.setdefault(item.proceso_id, {"total": 0, "count": 0})
-            agg["total"] += duracion
-            agg["count"] += 1
+            .filter(*filtros)
+            .group_by(ProcesoOrden.proceso_id)
+            .order_by(ProcesoOrden.proceso_id)
+            .all()
+        )
+        percentiles = _percentiles_por_grupo(
+            ProcesoOrden.proceso_id, duracion, filtros, PERCENTILES_PROCESO
+        )
 
         promedios = []
-        for proceso_id, agg in agregados.items():
-            promedios.append(
+        for fila in agregados:
+            n = fila.registros
+            desviacion = None
+            if n > 1:
+                suma = float(fila.suma)
+                # Varianza muestral a partir de suma y suma de cuadrados.
+                varianza = (float(fila.suma_cuadrados) - suma * suma / n) / (n - 1)
+                desviacion = max(varianza, 0.0) ** 0.5
+            data = {
+                "proceso_id": fila.proceso_id,
+                "proceso_nombre": proceso_map.get(fila.proceso_id),
+                "promedio_min": _float_o_none(fila.promedio),
+                "total_registros": n,
+                "desviacion_min": desviacion,
+                "minimo_min": _float_o_none(fila.minimo),
+                "maximo_min": _float_o_none(fila.maximo),
+            }
+            data.update(
+                percentiles.get(
+                    fila.proceso_id, {nombre: None for nombre, _ in PERCENTILES_PROCESO}
+                )
+            )
+            promedios.append(data)
+
+        respuesta = {"promedios": promedios}
+        if incluir_detalle:
+            pagina, por_pagina = paginacion
+            q = (
+                db.session.query(
+                    ProcesoOrden.orden_produccion_id,
+                    ProcesoOrden.proceso_id,
+                    duracion.label("duracion"),
+                )
+                .filter(*filtros)
+                .order_by(ProcesoOrden.id)
+            )
+            respuesta["detalle"] = [
                 {
-                    "proceso_id": proceso_id,
-                    "proceso_nombre": proceso_map.get(proceso_id),
-                    "promedio_min": agg["total"] / agg["count"]
-                    if agg["count"]
-                    else None,
-                    "total_registros": agg["count"],
+                    "orden_produccion_id": fila.orden_produccion_id,
+                    "proceso_id": fila.proceso_id,
+                    "proceso_nombre": proceso_map.get(fila.proceso_id),
+                    "duracion_min": _float_o_none(fila.duracion),
                 }
-            )
-        return jsonify({"promedios": promedios, "detalle": detalle})
+                for fila in q.offset((pagina - 1) * por_pagina).limit(por_pagina)
+            ]
+            respuesta["detalle_paginacion"] = {
+                "pagina": pagina,
+                "por_pagina": por_pagina,
+                "total": q.order_by(None).count(),
+            }
+        return jsonify(respuesta)
+
+    def _bucket_fecha(fecha, unidad):
+        """Expresion SQL que trunca un datetime al dia o al lunes de su semana."""
+        if db.engine.dialect.name == "postgresql":
+            return cast(func.date_trunc(unidad, fecha), db.Date)
+        if unidad == "week":
+            return func.date(fecha, "-6 days", "weekday 1")
+        return func.date(fecha)
+
+    DIMENSIONES_PERDIDA = ("producto", "motivo", "dia", "semana")
 
     @app.route("/reportes/perdidas-por-proceso", methods=["GET"])
     def reporte_perdidas_por_proceso():
-        procesos = Proceso.query.all()
-        proceso_map = {p.id: p.nombre for p in procesos}
-        items = ProcesoOrden.query.all()
-        acumulado = {}
-        for item in items:
-            perdida = Decimal(str(item.cantidad_perdida or 0))
-            acumulado[item.proceso_id] = acumulado.get(item.proceso_id, Decimal("0")) + perdida
-        respuesta = [
-            {
-                "proceso_id": pid,
-                "proceso_nombre": proceso_map.get(pid),
-                "cantidad_perdida": float(total),
-            }
-            for pid, total in acumulado.items()
+        agrupar_por = [
+            d.strip().lower()
+            for d in (request.args.get("agrupar_por") or "").split(",")
+            if d.strip()
         ]
+        invalidas = [d for d in agrupar_por if d not in DIMENSIONES_PERDIDA]
+        if invalidas:
+            mensaje = "agrupar_por acepta: " + ", ".join(DIMENSIONES_PERDIDA)
+            return jsonify({"error": mensaje}), 400
+        if "dia" in agrupar_por and "semana" in agrupar_por:
+            return jsonify({"error": "agrupar_por no admite dia y semana a la vez"}), 400
+        try:
+            desde = _parse_datetime(request.args.get("desde"), "desde")
+            hasta = _parse_datetime(request.args.get("hasta"), "hasta")
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+        enteros = {}
+        for campo in ("proceso_id", "producto_id"):
+            valor = request.args.get(campo)
+            try:
+                enteros[campo] = int(valor) if valor else None
+            except (TypeError, ValueError):
+                return jsonify({"error": f"{campo} debe ser entero"}), 400
+
+        # La perdida se registra al cerrar el proceso; si aun no cierra se usa el inicio.
+        fecha = func.coalesce(ProcesoOrden.fin, ProcesoOrden.inicio)
+        dimensiones = [("proceso_id", ProcesoOrden.proceso_id)]
+        if "producto" in agrupar_por:
+            dimensiones.append(("producto_id", OrdenProduccion.producto_id))
+        if "motivo" in agrupar_por:
+            dimensiones.append(("motivo_perdida", ProcesoOrden.motivo_perdida))
+        if "dia" in agrupar_por:
+            dimensiones.append(("dia", _bucket_fecha(fecha, "day")))
+        if "semana" in agrupar_por:
+            dimensiones.append(("semana", _bucket_fecha(fecha, "week")))
+        columnas = [expr.label(nombre) for nombre, expr in dimensiones]
+
+        perdida = func.coalesce(func.sum(ProcesoOrden.cantidad_perdida), 0)
+        entrada = func.coalesce(func.sum(ProcesoOrden.cantidad_entrada), 0)
+        q = db.session.query(
+            *columnas,
+            perdida.label("perdida"),
+            entrada.label("entrada"),
+            func.count(ProcesoOrden.id).label("registros"),
+        )
+        if "producto" in agrupar_por or enteros["producto_id"]:
+            q = q.join(
+                OrdenProduccion, OrdenProduccion.id == ProcesoOrden.orden_produccion_id
+            )
+        if enteros["producto_id"]:
+            q = q.filter(OrdenProduccion.producto_id == enteros["producto_id"])
+        if enteros["proceso_id"]:
+            q = q.filter(ProcesoOrden.proceso_id == enteros["proceso_id"])
+        if desde:
+            q = q.filter(fecha >= desde)
+        if hasta:
+            q = q.filter(fecha <= hasta)
+        q = q.group_by(*[expr for _, expr in dimensiones]).order_by(
+            *[expr for _, expr in dimensiones]
+        )
+        filas = q.all()
+
+        proceso_map = dict(db.session.query(Proceso.id, Proceso.nombre))
+        producto_map = {}
+        if "producto" in agrupar_por:
+            producto_map = dict(
+                db.session.query(Producto.id, Producto.nombre).filter(
+                    Producto.id.in_({fila.producto_id for fila in filas})
+                )
+            )
+
+        respuesta = []
+        for fila in filas:
+            data = {
+                "proceso_id": fila.proceso_id,
+                "proceso_nombre": proceso_map.get(fila.proceso_id),
+                "cantidad_perdida": float(fila.perdida),
+                "cantidad_entrada": float(fila.entrada),
+                "tasa_perdida": float(fila.perdida) / float(fila.entrada)
+                if fila.entrada
+                else None,
+                "registros": fila.registros,
+            }
+            if "producto" in agrupar_por:
+                data["producto_id"] = fila.producto_id
+                data["producto_nombre"] = producto_map.get(fila.producto_id)
+            if "motivo" in agrupar_por:
+                data["motivo_perdida"] = fila.motivo_perdida
+            for bucket in ("dia", "semana"):
+                if bucket in agrupar_por:
+                    valor = getattr(fila, bucket)
+                    data[bucket] = (
+                        valor.isoformat() if hasattr(valor, "isoformat") else valor
+                    )
+            respuesta.append(data)
         return jsonify(respuesta)
 
+    def _costo_estimado_componentes():
+        """Subquery con el costo por unidad de cada componente segun su receta.
+
+        Los componentes no tienen costo propio; se estima con las materias
+        primas de su receta directa a costo_unitario vigente.
+        """
+        return (
+            db.session.query(
+                ProductoMateriaPrima.producto_id.label("producto_id"),
+                func.sum(
+                    ProductoMateriaPrima.cantidad_necesaria * MateriaPrima.costo_unitario
+                ).label("costo"),
+            )
+            .join(MateriaPrima, MateriaPrima.id == ProductoMateriaPrima.materia_prima_id)
+            .group_by(ProductoMateriaPrima.producto_id)
+            .subquery()
+        )
+
+    def _fuentes_consumo():
+        """(tipo, modelo, columna material, costo unitario, join del costo)."""
+        costo_comp = _costo_estimado_componentes()
+        return (
+            (
+                "materia_prima",
+                ConsumoMateriaPrima,
+                ConsumoMateriaPrima.materia_prima_id,
+                MateriaPrima.costo_unitario,
+                lambda q: q.join(
+                    MateriaPrima, MateriaPrima.id == ConsumoMateriaPrima.materia_prima_id
+                ),
+            ),
+            (
+                "componente",
+                ConsumoProductoComponente,
+                ConsumoProductoComponente.componente_id,
+                func.coalesce(costo_comp.c.costo, 0),
+                lambda q: q.outerjoin(
+                    costo_comp,
+                    costo_comp.c.producto_id == ConsumoProductoComponente.componente_id,
+                ),
+            ),
+        )
+
+    def _varianza_consumos(filtro_orden, agrupar_por):
+        """Suma teorico, real y costos de consumos agrupando por orden o material.
+
+        Devuelve filas (tipo, clave, teorico, real, costo_teorico, costo_real)
+        para materias primas y componentes.
+        """
+        filas = []
+        for tipo, modelo, material, costo, unir in _fuentes_consumo():
+            clave = modelo.orden_produccion_id if agrupar_por == "orden" else material
+            real = func.coalesce(modelo.cantidad_real, 0)
+            q = db.session.query(
+                clave.label("clave"),
+                func.sum(modelo.cantidad_teorica).label("teorico"),
+                func.sum(real).label("real"),
+                func.sum(modelo.cantidad_teorica * costo).label("costo_teorico"),
+                func.sum(real * costo).label("costo_real"),
+            )
+            q = unir(q).filter(filtro_orden(modelo.orden_produccion_id))
+            filas.extend((tipo, fila) for fila in q.group_by(clave))
+        return filas
+
+    def _bloque_varianza(teorico, real, costo_teorico=None, costo_real=None):
+        data = {
+            "teorico": float(teorico or 0),
+            "real": float(real or 0),
+            "delta": float((real or 0) - (teorico or 0)),
+        }
+        if costo_teorico is not None or costo_real is not None:
+            data["costo_teorico"] = float(costo_teorico or 0)
+            data["costo_real"] = float(costo_real or 0)
+            data["impacto_costo"] = float((costo_real or 0) - (costo_teorico or 0))
+        return data
+
+    CONSUMO_VACIO = {"teorico": 0, "real": 0, "costo_teorico": 0, "costo_real": 0}
+
+    def _varianza_por_orden(filtro_orden):
+        por_orden = {}
+        for tipo, fila in _varianza_consumos(filtro_orden, "orden"):
+            acumulado = por_orden.setdefault(
+                fila.clave,
+                {"materia_prima": CONSUMO_VACIO, "componente": CONSUMO_VACIO},
+            )
+            acumulado[tipo] = {
+                "teorico": fila.teorico or 0,
+                "real": fila.real or 0,
+                "costo_teorico": fila.costo_teorico or 0,
+                "costo_real": fila.costo_real or 0,
+            }
+        return por_orden
+
+    def _resumen_orden_consumo(orden_id, codigo, producto_id, agregados):
+        agregados = agregados or {
+            "materia_prima": CONSUMO_VACIO,
+            "componente": CONSUMO_VACIO,
+        }
+        mp, comp = agregados["materia_prima"], agregados["componente"]
+        costo_teorico = mp["costo_teorico"] + comp["costo_teorico"]
+        costo_real = mp["costo_real"] + comp["costo_real"]
+        return {
+            "orden_id": orden_id,
+            "codigo": codigo,
+            "producto_id": producto_id,
+            # Totales historicos: solo materias primas.
+            "total_teorico": float(mp["teorico"]),
+            "total_real": float(mp["real"]),
+            "delta": float(mp["real"] - mp["teorico"]),
+            "componentes": _bloque_varianza(comp["teorico"], comp["real"]),
+            "costo_teorico": float(costo_teorico),
+            "costo_real": float(costo_real),
+            "impacto_costo": float(costo_real - costo_teorico),
+        }
+
+    def _varianza_por_material(filtro_orden):
+        filas = _varianza_consumos(filtro_orden, "material")
+        ids_mp = [fila.clave for tipo, fila in filas if tipo == "materia_prima"]
+        ids_comp = [fila.clave for tipo, fila in filas if tipo == "componente"]
+        nombres = {
+            ("materia_prima", m.id): (m.nombre, m.codigo)
+            for m in db.session.query(
+                MateriaPrima.id, MateriaPrima.nombre, MateriaPrima.codigo
+            ).filter(MateriaPrima.id.in_(ids_mp))
+        }
+        nombres.update(
+            {
+                ("componente", p.id): (p.nombre, p.codigo)
+                for p in db.session.query(
+                    Producto.id, Producto.nombre, Producto.codigo
+                ).filter(Producto.id.in_(ids_comp))
+            }
+        )
+        materiales = []
+        for tipo, fila in filas:
+            nombre, codigo = nombres.get((tipo, fila.clave), (None, None))
+            data = {"tipo": tipo, "id": fila.clave, "nombre": nombre, "codigo": codigo}
+            data.update(
+                _bloque_varianza(
+                    fila.teorico, fila.real, fila.costo_teorico, fila.costo_real
+                )
+            )
+            data["delta_pct"] = (
+                data["delta"] / data["teorico"] * 100 if data["teorico"] else None
+            )
+            materiales.append(data)
+        materiales.sort(key=lambda m: abs(m["impacto_costo"]), reverse=True)
+        return materiales
+
     @app.route("/reportes/consumo-teorico-vs-real", methods=["GET"])
     def reporte_consumo_teorico_vs_real():
-        orden_id = request.args.get("orden_id")
-        if not orden_id:
-            return jsonify({"error": "orden_id es requerido"}), 400
-        orden = OrdenProduccion.query.get(orden_id)
-        if not orden:
-            return jsonify({"error": "Orden no encontrada"}), 404
-        consumos = ConsumoMateriaPrima.query.filter_by(
-            orden_produccion_id=orden_id
-        ).all()
-        total_teorico = sum(Decimal(str(c.cantidad_teorica or 0)) for c in consumos)
-        total_real = sum(Decimal(str(c.cantidad_real or 0)) for c in consumos)
+        enteros = {}
+        for campo in ("orden_id", "producto_id"):
+            valor = request.args.get(campo)
+            try:
+                enteros[campo] = int(valor) if valor else None
+            except (TypeError, ValueError):
+                return jsonify({"error": f"{campo} debe ser entero"}), 400
+
+        if enteros["orden_id"] is not None:
+            orden = OrdenProduccion.query.get(enteros["orden_id"])
+            if not orden:
+                return jsonify({"error": "Orden no encontrada"}), 404
+
+            def filtro(columna):
+                return columna == orden.id
+
+            respuesta = _resumen_orden_consumo(
+                orden.id,
+                orden.codigo,
+                orden.producto_id,
+                _varianza_por_orden(filtro).get(orden.id),
+            )
+            respuesta["materiales"] = _varianza_por_material(filtro)
+            return jsonify(respuesta)
+
+        orden_ids_raw = request.args.get("orden_ids")
+        desde = request.args.get("desde")
+        hasta = request.args.get("hasta")
+        if not orden_ids_raw and not desde and not hasta:
+            return jsonify({"error": "orden_id, orden_ids o desde/hasta es requerido"}), 400
+        try:
+            desde_dt = _parse_datetime(desde, "desde") if desde else None
+            hasta_dt = _parse_datetime(hasta, "hasta") if hasta else None
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+
+        ordenes_q = db.session.query(
+            OrdenProduccion.id, OrdenProduccion.codigo, OrdenProduccion.producto_id
+        )
+        if orden_ids_raw:
+            try:
+                orden_ids = [int(x) for x in orden_ids_raw.split(",") if x.strip()]
+            except ValueError:
+                return jsonify({"error": "orden_ids debe ser lista de enteros"}), 400
+            ordenes_q = ordenes_q.filter(OrdenProduccion.id.in_(orden_ids))
+        # Las ordenes sin iniciar se ubican por su fecha de creacion.
+        fecha_orden = func.coalesce(OrdenProduccion.fecha_inicio, OrdenProduccion.creado_en)
+        if desde_dt:
+            ordenes_q = ordenes_q.filter(fecha_orden >= desde_dt)
+        if hasta_dt:
+            ordenes_q = ordenes_q.filter(fecha_orden <= hasta_dt)
+        if enteros["producto_id"] is not None:
+            ordenes_q = ordenes_q.filter(
+                OrdenProduccion.producto_id == enteros["producto_id"]
+            )
+
+        ids_subq = ordenes_q.with_entities(OrdenProduccion.id).scalar_subquery()
+
+        def filtro(columna):
+            return columna.in_(ids_subq)
+
+        por_orden = _varianza_por_orden(filtro)
+        ordenes = [
+            _resumen_orden_consumo(o.id, o.codigo, o.producto_id, por_orden.get(o.id))
+            for o in ordenes_q.order_by(OrdenProduccion.id)
+        ]
+        totales = {
+            "ordenes": len(ordenes),
+            "costo_teorico": sum(o["costo_teorico"] for o in ordenes),
+            "costo_real": sum(o["costo_real"] for o in ordenes),
+        }
+        totales["impacto_costo"] = totales["costo_real"] - totales["costo_teorico"]
         return jsonify(
             {
-                "orden_id": orden.id,
-                "codigo": orden.codigo,
-                "total_teorico": float(total_teorico),
-                "total_real": float(total_real),
-                "delta": float(total_real - total_teorico),
+                "ordenes": ordenes,
+                "materiales": _varianza_por_material(filtro),
+                "totales": totales,
             }
         )
 
+    # ---------- KPIs DIARIOS ----------
+
+    def _a_fecha(valor):
+        """Normaliza el bucket de dia (date en Postgres, texto en SQLite)."""
+        if isinstance(valor, datetime):
+            return valor.date()
+        if isinstance(valor, str):
+            return date.fromisoformat(valor[:10])
+        return valor
+
+    def _filtros_dias(columna, desde, hasta):
+        filtros = []
+        if desde:
+            filtros.append(columna >= datetime.combine(desde, datetime.min.time()))
+        if hasta:
+            siguiente = hasta + timedelta(days=1)
+            filtros.append(columna < datetime.combine(siguiente, datetime.min.time()))
+        return filtros
+
+    def _costos_kpi(claves, unir_base, filtros):
+        """Costo teorico y real de consumos agrupado por las claves del KPI."""
+        costos = {}
+        for _, modelo, _, costo, unir in _fuentes_consumo():
+            real = func.coalesce(modelo.cantidad_real, 0)
+            q = db.session.query(
+                *claves,
+                func.sum(modelo.cantidad_teorica * costo).label("costo_teorico"),
+                func.sum(real * costo).label("costo_real"),
+            ).select_from(modelo)
+            q = unir(unir_base(q, modelo)).filter(*filtros).group_by(*claves)
+            for fila in q:
+                clave = (_a_fecha(fila[0]),) + tuple(fila[1 : len(claves)])
+                acumulado = costos.setdefault(clave, [Decimal("0"), Decimal("0")])
+                acumulado[0] += Decimal(str(fila.costo_teorico or 0))
+                acumulado[1] += Decimal(str(fila.costo_real or 0))
+        return costos
+
+    def _reemplazar_kpis(modelo, desde, hasta, filtros, filas):
+        q = modelo.query.filter(*filtros)
+        if desde:
+            q = q.filter(modelo.fecha >= desde)
+        if hasta:
+            q = q.filter(modelo.fecha <= hasta)
+        q.delete(synchronize_session=False)
+        if filas:
+            # Upsert sobre la restriccion unica: dos refrescos concurrentes del
+            # mismo bucket (p. ej. dos procesos completados) no chocan.
+            unica = next(
+                restriccion
+                for restriccion in modelo.__table__.constraints
+                if isinstance(restriccion, db.UniqueConstraint)
+            )
+            claves = [columna.name for columna in unica.columns]
+            stmt = _insert_upsert(modelo)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=claves,
+                set_={
+                    campo: getattr(stmt.excluded, campo)
+                    for campo in filas[0]
+                    if campo not in claves
+                },
+            )
+            db.session.execute(stmt, filas)
+        return len(filas)
+
+    def _refrescar_kpi_procesos(desde=None, hasta=None, proceso_id=None, producto_id=None):
+        """Recalcula kpi_proceso_diario para el rango de dias indicado.
+
+        Al completar un proceso se recalcula solo su dia/proceso/producto; sin
+        argumentos reconstruye toda la tabla.
+        """
+        dia = _bucket_fecha(ProcesoOrden.fin, "day")
+        claves = (dia, ProcesoOrden.proceso_id, OrdenProduccion.producto_id)
+        filtros = [ProcesoOrden.estado == "COMPLETADO", ProcesoOrden.fin.isnot(None)]
+        filtros += _filtros_dias(ProcesoOrden.fin, desde, hasta)
+        filtros_kpi = []
+        if proceso_id:
+            filtros.append(ProcesoOrden.proceso_id == proceso_id)
+            filtros_kpi.append(KpiProcesoDiario.proceso_id == proceso_id)
+        if producto_id:
+            filtros.append(OrdenProduccion.producto_id == producto_id)
+            filtros_kpi.append(KpiProcesoDiario.producto_id == producto_id)
+
+        duracion = _minutos_entre(ProcesoOrden.inicio, ProcesoOrden.fin)
+        q = (
+            db.session.query(
+                *claves,
+                func.count(ProcesoOrden.id).label("completados"),
+                func.sum(duracion).label("duracion_total"),
+                func.max(duracion).label("duracion_max"),
+                func.sum(ProcesoOrden.cantidad_entrada).label("entrada"),
+                func.sum(ProcesoOrden.cantidad_salida).label("salida"),
+                func.sum(ProcesoOrden.cantidad_perdida).label("perdida"),
+            )
+            .join(OrdenProduccion, OrdenProduccion.id == ProcesoOrden.orden_produccion_id)
+            .filter(*filtros)
+            .group_by(*claves)
+        )
+        costos = _costos_kpi(
+            claves,
+            lambda q, modelo: q.join(
+                ProcesoOrden, ProcesoOrden.id == modelo.proceso_orden_id
+            ).join(OrdenProduccion, OrdenProduccion.id == ProcesoOrden.orden_produccion_id),
+            filtros,
+        )
+        filas = []
+        for fila in q:
+            fecha = _a_fecha(fila[0])
+            costo_teorico, costo_real = costos.get(
+                (fecha, fila.proceso_id, fila.producto_id), (0, 0)
+            )
+            filas.append(
+                {
+                    "fecha": fecha,
+                    "proceso_id": fila.proceso_id,
+                    "producto_id": fila.producto_id,
+                    "procesos_completados": fila.completados,
+                    "duracion_total_min": fila.duracion_total or 0,
+                    "duracion_max_min": fila.duracion_max,
+                    "cantidad_entrada": fila.entrada or 0,
+                    "cantidad_salida": fila.salida or 0,
+                    "cantidad_perdida": fila.perdida or 0,
+                    "costo_teorico": costo_teorico,
+                    "costo_real": costo_real,
+                }
+            )
+        return _reemplazar_kpis(KpiProcesoDiario, desde, hasta, filtros_kpi, filas)
+
+    def _refrescar_kpi_productos(desde=None, hasta=None, producto_id=None):
+        """Recalcula kpi_producto_diario (ordenes COMPLETADAS por dia de cierre)."""
+        dia = _bucket_fecha(OrdenProduccion.fecha_fin, "day")
+        claves = (dia, OrdenProduccion.producto_id)
+        filtros = [
+            OrdenProduccion.estado == "COMPLETADA",
+            OrdenProduccion.fecha_fin.isnot(None),
+        ]
+        filtros += _filtros_dias(OrdenProduccion.fecha_fin, desde, hasta)
+        filtros_kpi = []
+        if producto_id:
+            filtros.append(OrdenProduccion.producto_id == producto_id)
+            filtros_kpi.append(KpiProductoDiario.producto_id == producto_id)
+
+        duracion = _minutos_entre(OrdenProduccion.fecha_inicio, OrdenProduccion.fecha_fin)
+        q = (
+            db.session.query(
+                *claves,
+                func.count(OrdenProduccion.id).label("cerradas"),
+                func.sum(OrdenProduccion.cantidad_planeada).label("planeada"),
+                func.sum(OrdenProduccion.cantidad_final_buena).label("final_buena"),
+                func.sum(duracion).label("duracion_total"),
+            )
+            .filter(*filtros)
+            .group_by(*claves)
+        )
+        costos = _costos_kpi(
+            claves,
+            lambda q, modelo: q.join(
+                OrdenProduccion, OrdenProduccion.id == modelo.orden_produccion_id
+            ),
+            filtros,
+        )
+        filas = []
+        for fila in q:
+            fecha = _a_fecha(fila[0])
+            costo_teorico, costo_real = costos.get((fecha, fila.producto_id), (0, 0))
+            filas.append(
+                {
+                    "fecha": fecha,
+                    "producto_id": fila.producto_id,
+                    "ordenes_cerradas": fila.cerradas,
+                    "cantidad_planeada": fila.planeada or 0,
+                    "cantidad_final_buena": fila.final_buena or 0,
+                    "duracion_total_min": fila.duracion_total or 0,
+                    "costo_teorico": costo_teorico,
+                    "costo_real": costo_real,
+                }
+            )
+        return _reemplazar_kpis(KpiProductoDiario, desde, hasta, filtros_kpi, filas)
+
+    @app.cli.command("reconstruir-kpis")
+    @click.option("--desde", help="Primer dia (YYYY-MM-DD); por defecto todo.")
+    @click.option("--hasta", help="Ultimo dia (YYYY-MM-DD); por defecto todo.")
+    def reconstruir_kpis(desde, hasta):
+        """Recalcula las tablas de KPIs diarios desde los datos de produccion."""
+        try:
+            desde = _parse_fecha(desde)
+            hasta = _parse_fecha(hasta)
+        except ValueError as exc:
+            raise click.BadParameter(str(exc))
+        procesos = _refrescar_kpi_procesos(desde, hasta)
+        productos = _refrescar_kpi_productos(desde, hasta)
+        db.session.commit()
+        click.echo(
+            f"KPIs reconstruidos: {procesos} filas por proceso, "
+            f"{productos} filas por producto"
+        )
+
+    def kpi_proceso_to_dict(kpi: KpiProcesoDiario):
+        n = kpi.procesos_completados or 0
+        entrada = float(kpi.cantidad_entrada or 0)
+        return {
+            "fecha": kpi.fecha.isoformat(),
+            "proceso_id": kpi.proceso_id,
+            "producto_id": kpi.producto_id,
+            "procesos_completados": n,
+            "duracion_total_min": float(kpi.duracion_total_min or 0),
+            "duracion_promedio_min": float(kpi.duracion_total_min or 0) / n if n else None,
+            "duracion_max_min": _float_o_none(kpi.duracion_max_min),
+            "cantidad_entrada": entrada,
+            "cantidad_salida": float(kpi.cantidad_salida or 0),
+            "cantidad_perdida": float(kpi.cantidad_perdida or 0),
+            "tasa_perdida": float(kpi.cantidad_perdida or 0) / entrada if entrada else None,
+            "costo_teorico": float(kpi.costo_teorico or 0),
+            "costo_real": float(kpi.costo_real or 0),
+            "impacto_costo": float((kpi.costo_real or 0) - (kpi.costo_teorico or 0)),
+        }
+
+    def kpi_producto_to_dict(kpi: KpiProductoDiario):
+        n = kpi.ordenes_cerradas or 0
+        planeada = float(kpi.cantidad_planeada or 0)
+        return {
+            "fecha": kpi.fecha.isoformat(),
+            "producto_id": kpi.producto_id,
+            "ordenes_cerradas": n,
+            "cantidad_planeada": planeada,
+            "cantidad_final_buena": float(kpi.cantidad_final_buena or 0),
+            "rendimiento": float(kpi.cantidad_final_buena or 0) / planeada
+            if planeada
+            else None,
+            "duracion_total_min": float(kpi.duracion_total_min or 0),
+            "duracion_promedio_min": float(kpi.duracion_total_min or 0) / n if n else None,
+            "costo_teorico": float(kpi.costo_teorico or 0),
+            "costo_real": float(kpi.costo_real or 0),
+            "impacto_costo": float((kpi.costo_real or 0) - (kpi.costo_teorico or 0)),
+        }
+
+    @app.route("/reportes/kpis-diarios", methods=["GET"])
+    def reporte_kpis_diarios():
+        nivel = (request.args.get("nivel") or "proceso").strip().lower()
+        if nivel not in ("proceso", "producto"):
+            return jsonify({"error": "nivel debe ser proceso o producto"}), 400
+        try:
+            desde = _parse_fecha(request.args.get("desde"))
+            hasta = _parse_fecha(request.args.get("hasta"))
+            paginacion = _paginacion_opcional()
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+        enteros = {}
+        for campo in ("proceso_id", "producto_id"):
+            valor = request.args.get(campo)
+            try:
+                enteros[campo] = int(valor) if valor else None
+            except (TypeError, ValueError):
+                return jsonify({"error": f"{campo} debe ser entero"}), 400
+
+        modelo = KpiProcesoDiario if nivel == "proceso" else KpiProductoDiario
+        q = modelo.query
+        if desde:
+            q = q.filter(modelo.fecha >= desde)
+        if hasta:
+            q = q.filter(modelo.fecha <= hasta)
+        if enteros["producto_id"]:
+            q = q.filter(modelo.producto_id == enteros["producto_id"])
+        if enteros["proceso_id"] and nivel == "proceso":
+            q = q.filter(KpiProcesoDiario.proceso_id == enteros["proceso_id"])
+        orden = [modelo.fecha, modelo.producto_id]
+        if nivel == "proceso":
+            orden.insert(1, KpiProcesoDiario.proceso_id)
+        to_dict = kpi_proceso_to_dict if nivel == "proceso" else kpi_producto_to_dict
+        return _respuesta_paginada(q.order_by(*orden), to_dict, paginacion)
+
     @app.route("/reportes/ordenes-atascadas", methods=["GET"])
     def reporte_ordenes_atascadas():
         minutos = request.args.get("minutos", 120)
@@ -3688,13 +7255,12 @@ def create_app():
         ]
         return jsonify(respuesta)
 
-    @app.route("/reportes/ordenes/excel", methods=["GET"])
-    def reporte_ordenes_excel():
-        inicio = request.args.get("inicio")
-        fin = request.args.get("fin")
-        estado_ids_raw = request.args.get("estado_ids")
-        cliente_id = request.args.get("cliente_id")
-        usuario_id = request.args.get("usuario_id")
+    def _consulta_ordenes_excel(parametros: dict):
+        inicio = parametros.get("inicio")
+        fin = parametros.get("fin")
+        estado_ids_raw = parametros.get("estado_ids")
+        cliente_id = parametros.get("cliente_id")
+        usuario_id = parametros.get("usuario_id")
 
         q = Orden.query
         if inicio:
@@ -3707,24 +7273,29 @@ def create_app():
                     int(x) for x in estado_ids_raw.split(",") if x.strip()
                 ]
             except ValueError:
-                return jsonify({"error": "estado_ids inválido"}), 400
+                raise ValueError("estado_ids inválido")
             if estado_ids:
                 q = q.filter(Orden.estado_id.in_(estado_ids))
         if cliente_id:
             try:
                 q = q.filter(Orden.cliente_id == int(cliente_id))
             except ValueError:
-                return jsonify({"error": "cliente_id inválido"}), 400
+                raise ValueError("cliente_id inválido")
         if usuario_id:
             try:
                 uid = int(usuario_id)
             except ValueError:
-                return jsonify({"error": "usuario_id inválido"}), 400
+                raise ValueError("usuario_id inválido")
             q = q.join(Cliente, Orden.cliente_id == Cliente.id).filter(
                 Cliente.usuario_id == uid
             )
+        return q
 
-        ordenes = q.order_by(Orden.fecha, Orden.id).all()
+    @cola_trabajos.tarea("reporte-ordenes-excel")
+    def _generar_excel_ordenes(parametros: dict) -> ArchivoTrabajo:
+        ordenes = (
+            _consulta_ordenes_excel(parametros).order_by(Orden.fecha, Orden.id).all()
+        )
         today = date.today()
 
         wb = Workbook()
@@ -3899,17 +7470,37 @@ def create_app():
 
         buffer = BytesIO()
         wb.save(buffer)
-        buffer.seek(0)
 
         filename = f"reporte_ordenes_{today.isoformat()}.xlsx"
+        return ArchivoTrabajo(
+            buffer.getvalue(),
+            filename,
+            "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )
+
+    @app.route("/reportes/ordenes/excel", methods=["GET"])
+    def reporte_ordenes_excel():
+        parametros = {
+            campo: request.args.get(campo)
+            for campo in ("inicio", "fin", "estado_ids", "cliente_id", "usuario_id")
+            if request.args.get(campo)
+        }
+        try:
+            # Valida los filtros antes de encolar o generar.
+            _consulta_ordenes_excel(parametros)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+        if _parse_bool(request.args.get("asincrono"), default=False):
+            return respuesta_encolado(
+                cola_trabajos.encolar("reporte-ordenes-excel", parametros)
+            )
+
+        archivo = _generar_excel_ordenes(parametros)
         return send_file(
-            buffer,
-            mimetype=(
-                "application/vnd.openxmlformats-officedocument"
-                ".spreadsheetml.sheet"
-            ),
+            BytesIO(archivo.contenido),
+            mimetype=archivo.mimetype,
             as_attachment=True,
-            download_name=filename,
+            download_name=archivo.nombre,
         )
 
     prefix = app.config.get("URL_PREFIX", "/coproda")
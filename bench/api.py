@@ -0,0 +1,257 @@
+"""Benchmark de la API completa con datos sinteticos.
+
+Siembra una base con bench.seed (SQLite temporal por defecto, o --db con
+una URL de Postgres vacia) y ejecuta el cliente de pruebas de Flask contra
+los endpoints calientes. Reporta percentiles de latencia, consultas SQL por
+request (del header Server-Timing) y memoria pico de Python.
+
+    python -m bench.api --escala 1 --json base.json
+    python -m bench.api --escala 1 --comparar base.json
+"""
+
+import argparse
+from datetime import date, timedelta
+import json
+import os
+import random
+import re
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+
+def _percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p * (len(ordenados) - 1))))]
+
+
+def _consultas(response) -> int:
+    match = re.search(
+        r'desc="(\d+) consultas"', response.headers.get("Server-Timing", "")
+    )
+    return int(match.group(1)) if match else 0
+
+
+def _escenarios(client, prefijo, db, modelos, rnd, hoy):
+    """Cada escenario devuelve (metodo, ruta, json) para una iteracion.
+
+    La preparacion (crear pagos, ordenes de produccion) ocurre aqui y no se
+    mide; solo se mide el request devuelto.
+    """
+    Bancos, Orden, Producto = modelos["Bancos"], modelos["Orden"], modelos["Producto"]
+    ProductoProceso = modelos["ProductoProceso"]
+    desde = (hoy - timedelta(days=30)).isoformat()
+
+    clientes_con_saldo = [
+        cid
+        for (cid,) in db.session.query(Orden.cliente_id)
+        .filter(Orden.estado_id == 3, Orden.saldo > 0)
+        .distinct()
+    ]
+    productos_con_ruta = [
+        pid for (pid,) in db.session.query(ProductoProceso.producto_id).distinct()
+    ]
+    contador = {"op": 0}
+
+    def abono():
+        cliente_id = rnd.choice(clientes_con_saldo)
+        resp = client.post(
+            f"{prefijo}/bancos",
+            json={
+                "referencia": f"BENCH-{rnd.random()}",
+                "banco": "Bench",
+                "monto": round(rnd.uniform(100, 5000), 2),
+            },
+        )
+        return (
+            "POST",
+            "/ordenes/abonos",
+            {"cliente_id": cliente_id, "banco_id": resp.get_json()["id"]},
+        )
+
+    def completar_proceso():
+        contador["op"] += 1
+        resp = client.post(
+            f"{prefijo}/ordenes-produccion",
+            json={
+                "codigo": f"BENCH-OP-{contador['op']}",
+                "producto_id": rnd.choice(productos_con_ruta),
+                "cantidad_planeada": 10,
+            },
+        )
+        orden = resp.get_json()
+        if resp.status_code != 201:
+            raise RuntimeError(f"No se pudo crear la orden de produccion: {orden}")
+        proceso = orden["procesos"][0]
+        ruta = f"/ordenes-produccion/{orden['id']}/procesos/{proceso['id']}"
+        client.post(f"{prefijo}{ruta}/iniciar")
+        return (
+            "POST",
+            f"{ruta}/completar",
+            {"cantidad_entrada": 10, "cantidad_salida": 9, "cantidad_perdida": 1},
+        )
+
+    ultima_op = db.session.query(db.func.max(modelos["OrdenProduccion"].id)).scalar()
+
+    return {
+        "GET /ordenes": lambda: ("GET", "/ordenes", None),
+        "GET /ordenes (30 dias)": lambda: (
+            "GET",
+            f"/ordenes?inicio={desde}&fin={hoy.isoformat()}",
+            None,
+        ),
+        "POST /ordenes/abonos": abono,
+        "GET /ordenes-produccion": lambda: ("GET", "/ordenes-produccion", None),
+        "POST completar proceso": completar_proceso,
+        "GET /reportes/tiempo-total-orden": lambda: (
+            "GET",
+            "/reportes/tiempo-total-orden",
+            None,
+        ),
+        "GET /reportes/tiempo-por-proceso": lambda: (
+            "GET",
+            "/reportes/tiempo-por-proceso",
+            None,
+        ),
+        "GET /reportes/perdidas-por-proceso": lambda: (
+            "GET",
+            "/reportes/perdidas-por-proceso",
+            None,
+        ),
+        "GET /reportes/consumo-teorico-vs-real": lambda: (
+            "GET",
+            f"/reportes/consumo-teorico-vs-real?orden_id={rnd.randint(1, ultima_op)}",
+            None,
+        ),
+        "GET /reportes/ordenes-atascadas": lambda: (
+            "GET",
+            "/reportes/ordenes-atascadas",
+            None,
+        ),
+        "GET /reportes/ordenes/excel": lambda: (
+            "GET",
+            f"/reportes/ordenes/excel?inicio={desde}",
+            None,
+        ),
+    }
+
+
+def _medir(client, prefijo, preparar, iteraciones) -> dict:
+    latencias, consultas = [], []
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    for _ in range(iteraciones):
+        metodo, ruta, payload = preparar()
+        inicio = time.perf_counter()
+        resp = client.open(f"{prefijo}{ruta}", method=metodo, json=payload)
+        latencias.append((time.perf_counter() - inicio) * 1000)
+        if resp.status_code >= 400:
+            raise RuntimeError(
+                f"{metodo} {ruta} -> {resp.status_code}: {resp.data[:200]}"
+            )
+        consultas.append(_consultas(resp))
+    _, pico = tracemalloc.get_traced_memory()
+    return {
+        "iteraciones": iteraciones,
+        "p50_ms": round(statistics.median(latencias), 3),
+        "p90_ms": round(_percentil(latencias, 0.90), 3),
+        "p99_ms": round(_percentil(latencias, 0.99), 3),
+        "max_ms": round(max(latencias), 3),
+        "consultas_promedio": round(statistics.mean(consultas), 1),
+        "consultas_max": max(consultas),
+        "memoria_pico_kb": round((pico - base) / 1024, 1),
+    }
+
+
+def _comparar(actual: dict, base: dict):
+    print(f"\n{'escenario':<42} {'p50 base':>10} {'p50 actual':>11} {'delta':>8}")
+    for nombre, res in actual["escenarios"].items():
+        previo = base.get("escenarios", {}).get(nombre)
+        if not previo:
+            print(f"{nombre:<42} {'-':>10} {res['p50_ms']:>11} {'nuevo':>8}")
+            continue
+        delta = (res["p50_ms"] - previo["p50_ms"]) / previo["p50_ms"] * 100
+        print(
+            f"{nombre:<42} {previo['p50_ms']:>10} {res['p50_ms']:>11} {delta:>+7.1f}%"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", help="URL de una base vacia (default: SQLite temporal)")
+    parser.add_argument("--escala", type=float, default=1.0)
+    parser.add_argument("--iteraciones", type=int, default=20)
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument("--solo", help="Filtra escenarios que contengan este texto")
+    parser.add_argument("--json", dest="salida_json", help="Archivo de salida JSON")
+    parser.add_argument("--comparar", help="JSON de una corrida previa")
+    args = parser.parse_args()
+
+    temporal = None
+    url = args.db
+    if not url:
+        temporal = tempfile.NamedTemporaryFile(suffix=".sqlite", delete=False)
+        url = f"sqlite:///{temporal.name}"
+    # Config lee el entorno al importarse.
+    os.environ["DATABASE_URL"] = url
+    os.environ.setdefault("REQUEST_BUDGET_MS", "1e12")
+    os.environ.setdefault("REQUEST_BUDGET_QUERIES", str(10**9))
+
+    from app import create_app
+    from bench.seed import sembrar
+    import models
+
+    app = create_app()
+    prefijo = app.config.get("URL_PREFIX") or ""
+    hoy = date.today()
+    rnd = random.Random(args.semilla)
+    resultados = {}
+    try:
+        with app.app_context():
+            models.db.create_all()
+            inicio = time.perf_counter()
+            volumenes = sembrar(
+                models.db.session, escala=args.escala, semilla=args.semilla, hoy=hoy
+            )
+            models.db.session.commit()
+            print(
+                f"Datos sembrados en {time.perf_counter() - inicio:.1f} s: {volumenes}"
+            )
+
+            client = app.test_client()
+            escenarios = _escenarios(client, prefijo, models.db, vars(models), rnd, hoy)
+            tracemalloc.start()
+            for nombre, preparar in escenarios.items():
+                if args.solo and args.solo not in nombre:
+                    continue
+                resultados[nombre] = _medir(client, prefijo, preparar, args.iteraciones)
+                r = resultados[nombre]
+                print(
+                    f"{nombre:<42} p50 {r['p50_ms']:>9} ms  p99 {r['p99_ms']:>9} ms  "
+                    f"consultas {r['consultas_promedio']:>8}  pico {r['memoria_pico_kb']:>9} KB"
+                )
+            tracemalloc.stop()
+            models.db.session.remove()
+            models.db.engine.dispose()
+    finally:
+        if temporal:
+            os.unlink(temporal.name)
+
+    salida = {
+        "escala": args.escala,
+        "semilla": args.semilla,
+        "iteraciones": args.iteraciones,
+        "volumenes": volumenes,
+        "escenarios": resultados,
+    }
+    if args.salida_json:
+        with open(args.salida_json, "w") as fh:
+            json.dump(salida, fh, indent=2)
+    if args.comparar:
+        with open(args.comparar) as fh:
+            _comparar(salida, json.load(fh))
+
+
+if __name__ == "__main__":
+    main()
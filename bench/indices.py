@@ -0,0 +1,165 @@
+"""Benchmark de indices sobre los predicados calientes.
+
+Siembra una base (SQLite temporal por defecto, o --db con una URL de
+Postgres vacia), ejecuta las consultas sin los indices compuestos, los
+crea, y repite. Imprime el plan (EXPLAIN) y los tiempos de cada caso.
+
+    python -m bench.indices --escala 2 --json bench_output.txt
+"""
+
+import argparse
+from datetime import date, datetime, timedelta
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.orm import Session
+
+from bench.seed import sembrar
+from models import (
+    Bancos,
+    ConsumoMateriaPrima,
+    ConsumoProductoComponente,
+    Orden,
+    OrdenItem,
+    ProcesoOrden,
+    db,
+)
+
+INDICES = [
+    (Orden, "ix_ordenes_cliente_estado_saldo"),
+    (Orden, "ix_ordenes_fecha_id"),
+    (Bancos, "ix_bancos_cliente_asignado_fecha"),
+    (ConsumoMateriaPrima, "ix_consumos_mp_orden_materia"),
+    (ConsumoProductoComponente, "ix_consumos_comp_orden_componente"),
+    (ProcesoOrden, "ix_procesos_orden_estado_inicio"),
+    (OrdenItem, "ix_orden_items_orden_id"),
+]
+
+
+def _indice(model, nombre):
+    return next(ix for ix in model.__table__.indexes if ix.name == nombre)
+
+
+def _consultas(hoy: date):
+    desde = hoy - timedelta(days=30)
+    limite = datetime.utcnow() - timedelta(minutes=120)
+    return {
+        "abono_ordenes_pendientes": select(Orden).where(
+            Orden.cliente_id == 7, Orden.saldo > 0, Orden.estado_id == 3
+        ),
+        "listar_ordenes_por_fecha": select(Orden)
+        .where(Orden.fecha >= desde, Orden.fecha <= hoy)
+        .order_by(Orden.id),
+        "reporte_excel_por_fecha": select(Orden)
+        .where(Orden.fecha >= desde, Orden.fecha <= hoy)
+        .order_by(Orden.fecha, Orden.id),
+        "cartera_bancos_asignados": select(Bancos)
+        .where(Bancos.cliente_id == 7, Bancos.asignado.is_(True))
+        .order_by(Bancos.fecha, Bancos.id),
+        "consumos_orden_materia": select(ConsumoMateriaPrima).where(
+            ConsumoMateriaPrima.orden_produccion_id == 11,
+            ConsumoMateriaPrima.materia_prima_id == 3,
+        ),
+        "consumos_orden_componente": select(ConsumoProductoComponente).where(
+            ConsumoProductoComponente.orden_produccion_id == 11,
+            ConsumoProductoComponente.componente_id == 3,
+        ),
+        "procesos_atascados": select(ProcesoOrden).where(
+            ProcesoOrden.estado == "EN_PROCESO", ProcesoOrden.inicio < limite
+        ),
+        "items_de_orden": select(OrdenItem).where(OrdenItem.orden_id == 42),
+    }
+
+
+def _explain(conn, stmt) -> list:
+    compilado = stmt.compile(
+        dialect=conn.dialect, compile_kwargs={"literal_binds": True}
+    )
+    prefijo = "EXPLAIN QUERY PLAN" if conn.dialect.name == "sqlite" else "EXPLAIN"
+    filas = conn.execute(text(f"{prefijo} {compilado}")).all()
+    return [" ".join(str(c) for c in fila) for fila in filas]
+
+
+def _medir(conn, stmt, repeticiones: int) -> dict:
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        conn.execute(stmt).all()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    tiempos.sort()
+    return {
+        "p50_ms": round(statistics.median(tiempos), 3),
+        "p90_ms": round(tiempos[int(0.9 * (len(tiempos) - 1))], 3),
+        "min_ms": round(tiempos[0], 3),
+    }
+
+
+def _correr(conn, consultas, repeticiones):
+    return {
+        nombre: {"plan": _explain(conn, stmt), **_medir(conn, stmt, repeticiones)}
+        for nombre, stmt in consultas.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", help="URL de una base vacia (default: SQLite temporal)")
+    parser.add_argument("--escala", type=float, default=1.0)
+    parser.add_argument("--repeticiones", type=int, default=30)
+    parser.add_argument("--json", dest="salida_json", help="Archivo de salida JSON")
+    args = parser.parse_args()
+
+    temporal = None
+    url = args.db
+    if not url:
+        temporal = tempfile.NamedTemporaryFile(suffix=".sqlite", delete=False)
+        url = f"sqlite:///{temporal.name}"
+
+    engine = create_engine(url)
+    hoy = date.today()
+    try:
+        db.metadata.create_all(engine)
+        with Session(engine) as session:
+            volumenes = sembrar(session, escala=args.escala, hoy=hoy)
+            session.commit()
+
+        consultas = _consultas(hoy)
+        with engine.begin() as conn:
+            for model, nombre in INDICES:
+                _indice(model, nombre).drop(bind=conn, checkfirst=True)
+            conn.execute(text("ANALYZE"))
+        with engine.connect() as conn:
+            antes = _correr(conn, consultas, args.repeticiones)
+
+        with engine.begin() as conn:
+            for model, nombre in INDICES:
+                _indice(model, nombre).create(bind=conn, checkfirst=True)
+            conn.execute(text("ANALYZE"))
+        with engine.connect() as conn:
+            despues = _correr(conn, consultas, args.repeticiones)
+    finally:
+        engine.dispose()
+        if temporal:
+            os.unlink(temporal.name)
+
+    for nombre in consultas:
+        a, d = antes[nombre], despues[nombre]
+        print(f"\n== {nombre}: p50 {a['p50_ms']} ms -> {d['p50_ms']} ms")
+        print("   antes:   " + "\n            ".join(a["plan"]))
+        print("   despues: " + "\n            ".join(d["plan"]))
+
+    if args.salida_json:
+        with open(args.salida_json, "w") as fh:
+            json.dump(
+                {"volumenes": volumenes, "antes": antes, "despues": despues},
+                fh,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+"""Generador de datos sinteticos para benchmarks.
+
+Usa los modelos de models.py y escribe con inserts masivos (Core) para que
+sembrar cientos de miles de filas tome segundos. Los ids se asignan aqui
+mismo para no depender de RETURNING y para que la semilla sea reproducible.
+"""
+
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+import random
+
+from sqlalchemy import insert
+
+from models import (
+    Bancos,
+    CategoriaProducto,
+    Cliente,
+    ConsumoMateriaPrima,
+    ConsumoProductoComponente,
+    EstadoOrden,
+    MateriaPrima,
+    Orden,
+    OrdenItem,
+    OrdenProduccion,
+    Proceso,
+    ProcesoOrden,
+    Producto,
+    ProductoComponente,
+    ProductoMateriaPrima,
+    ProductoProceso,
+    TipoPago,
+    Usuario,
+)
+
+VOLUMENES_BASE = {
+    "categorias": 10,
+    "productos": 300,
+    "materias_primas": 80,
+    "clientes": 400,
+    "ordenes": 6000,
+    "bancos": 3000,
+    "ordenes_produccion": 1500,
+}
+
+TIPOS_PAGO = ["Contado", "Credito 15 dias", "Credito 30 dias", "Credito 60 dias"]
+ESTADOS_ORDEN = ["Pendiente", "Bodega", "Enviada", "Pagada"]
+PROCESOS = ["Mezclado", "Coccion", "Enfriado", "Envasado", "Etiquetado", "Empaque"]
+MOTIVOS_PERDIDA = [None, None, "Derrame", "Contaminacion", "Envase defectuoso"]
+
+LOTE = 5000
+
+
+def _insertar(conn, model, filas):
+    # executemany exige las mismas llaves en cada fila.
+    columnas = set().union(*filas) if filas else set()
+    for fila in filas:
+        for columna in columnas - fila.keys():
+            fila[columna] = None
+    for i in range(0, len(filas), LOTE):
+        conn.execute(insert(model.__table__), filas[i : i + LOTE])
+
+
+def _dinero(valor: float) -> Decimal:
+    return Decimal(str(round(valor, 2)))
+
+
+def sembrar(conn, escala: float = 1.0, semilla: int = 42, hoy: date = None) -> dict:
+    """Siembra una base vacia y devuelve los volumenes generados.
+
+    conn puede ser una Connection o una Session de SQLAlchemy.
+    """
+    rnd = random.Random(semilla)
+    hoy = hoy or date.today()
+    ahora = datetime.combine(hoy, datetime.min.time()) + timedelta(hours=12)
+    vol = {k: max(1, int(v * escala)) for k, v in VOLUMENES_BASE.items()}
+
+    _insertar(
+        conn,
+        Usuario,
+        [{"id": 1, "usuario": "bench", "contrasena": "x", "activo": True}],
+    )
+    _insertar(
+        conn,
+        TipoPago,
+        [{"id": i, "nombre": n, "activo": True} for i, n in enumerate(TIPOS_PAGO, 1)],
+    )
+    _insertar(
+        conn,
+        EstadoOrden,
+        [{"id": i, "nombre": n} for i, n in enumerate(ESTADOS_ORDEN, 1)],
+    )
+    _insertar(
+        conn,
+        Proceso,
+        [{"id": i, "nombre": n, "activo": True} for i, n in enumerate(PROCESOS, 1)],
+    )
+    _insertar(
+        conn,
+        CategoriaProducto,
+        [
+            {"id": i, "nombre": f"Categoria {i}"}
+            for i in range(1, vol["categorias"] + 1)
+        ],
+    )
+
+    productos = []
+    finales = []
+    componentes = []
+    for i in range(1, vol["productos"] + 1):
+        es_final = rnd.random() > 0.2
+        base = rnd.uniform(5, 500)
+        productos.append(
+            {
+                "id": i,
+                "nombre": f"Producto {rnd.choice(['Jabon', 'Cloro', 'Suavizante', 'Desinfectante', 'Envase', 'Tapa'])} {i}",
+                "codigo": f"PRD-{i:06d}",
+                "categoria_id": rnd.randint(1, vol["categorias"]),
+                "activo": True,
+                "es_producto_final": es_final,
+                "es_terminado": es_final and rnd.random() > 0.3,
+                "precio_cf": _dinero(base),
+                "precio_minorista": _dinero(base * 0.9),
+                "precio_mayorista": _dinero(base * 0.8),
+                "stock_actual": Decimal(rnd.randint(0, 5000)),
+                "stock_reservado": Decimal("0"),
+                "stock_minimo": Decimal(rnd.randint(0, 100)),
+            }
+        )
+        (finales if es_final else componentes).append(i)
+    _insertar(conn, Producto, productos)
+
+    _insertar(
+        conn,
+        MateriaPrima,
+        [
+            {
+                "id": i,
+                "nombre": f"Materia prima {i}",
+                "codigo": f"MP-{i:05d}",
+                "costo_unitario": Decimal(str(round(rnd.uniform(0.5, 80), 4))),
+                "stock_actual": Decimal(rnd.randint(10000, 100000)),
+                "stock_reservado": Decimal("0"),
+                "stock_minimo": Decimal("100"),
+                "activo": True,
+            }
+            for i in range(1, vol["materias_primas"] + 1)
+        ],
+    )
+
+    # Ruta, BOM y componentes por producto final.
+    rutas = {}
+    ruta_filas, bom_filas, comp_filas = [], [], []
+    for producto_id in finales:
+        pasos = sorted(rnd.sample(range(1, len(PROCESOS) + 1), rnd.randint(2, 4)))
+        rutas[producto_id] = pasos
+        for orden, proceso_id in enumerate(pasos, 1):
+            ruta_filas.append(
+                {
+                    "producto_id": producto_id,
+                    "proceso_id": proceso_id,
+                    "orden": orden,
+                    "tiempo_objetivo_min": rnd.randint(15, 240),
+                    "activo": True,
+                }
+            )
+        for mp_id in rnd.sample(
+            range(1, vol["materias_primas"] + 1), rnd.randint(2, 5)
+        ):
+            bom_filas.append(
+                {
+                    "producto_id": producto_id,
+                    "materia_prima_id": mp_id,
+                    "proceso_id": rnd.choice(pasos),
+                    "cantidad_necesaria": Decimal(str(round(rnd.uniform(0.01, 3), 4))),
+                    "merma_estandar": Decimal(str(round(rnd.uniform(0, 0.05), 4))),
+                }
+            )
+        if componentes:
+            for comp_id in rnd.sample(
+                componentes, min(len(componentes), rnd.randint(0, 2))
+            ):
+                comp_filas.append(
+                    {
+                        "producto_id": producto_id,
+                        "componente_id": comp_id,
+                        "proceso_id": pasos[-1],
+                        "cantidad_necesaria": Decimal("1"),
+                        "merma_estandar": Decimal("0"),
+                    }
+                )
+    _insertar(conn, ProductoProceso, ruta_filas)
+    _insertar(conn, ProductoMateriaPrima, bom_filas)
+    _insertar(conn, ProductoComponente, comp_filas)
+
+    _insertar(
+        conn,
+        Cliente,
+        [
+            {
+                "id": i,
+                "codigo": f"CLI-{i:05d}",
+                "nombre": f"Cliente {rnd.choice(['Abarroteria', 'Tienda', 'Distribuidora', 'Super'])} {i}",
+                "clasificacion_precio": rnd.choice(["cf", "minorista", "mayorista"]),
+                "saldo": Decimal("0"),
+                "activo": True,
+                "usuario_id": 1,
+            }
+            for i in range(1, vol["clientes"] + 1)
+        ],
+    )
+
+    # Ordenes de venta: el 70% enviadas o pagadas, con items y saldos coherentes.
+    ordenes, items = [], []
+    item_id = 1
+    for i in range(1, vol["ordenes"] + 1):
+        fecha = hoy - timedelta(days=rnd.randint(0, 730))
+        estado_id = rnd.choices([1, 2, 3, 4], weights=[10, 20, 30, 40])[0]
+        total = Decimal("0")
+        for _ in range(rnd.randint(1, 8)):
+            precio = _dinero(rnd.uniform(5, 500))
+            cantidad = rnd.randint(1, 50)
+            items.append(
+                {
+                    "id": item_id,
+                    "orden_id": i,
+                    "producto_id": rnd.choice(finales),
+                    "precio": precio,
+                    "cantidad": cantidad,
+                }
+            )
+            item_id += 1
+            total += precio * cantidad
+        fecha_envio = (
+            fecha + timedelta(days=rnd.randint(0, 5)) if estado_id >= 3 else None
+        )
+        ordenes.append(
+            {
+                "id": i,
+                "codigo_orden": f"ORD-{i:07d}",
+                "fecha": fecha,
+                "fecha_envio": fecha_envio,
+                "fecha_pago": (
+                    fecha_envio + timedelta(days=rnd.randint(0, 60))
+                    if estado_id == 4
+                    else None
+                ),
+                "usuario_id": 1,
+                "tipo_pago_id": rnd.randint(1, len(TIPOS_PAGO)),
+                "estado_id": estado_id,
+                "cliente_id": rnd.randint(1, vol["clientes"]),
+                "total": total,
+                "saldo": Decimal("0") if estado_id == 4 else total,
+            }
+        )
+    _insertar(conn, Orden, ordenes)
+    _insertar(conn, OrdenItem, items)
+
+    _insertar(
+        conn,
+        Bancos,
+        [
+            {
+                "id": i,
+                "fecha": hoy - timedelta(days=rnd.randint(0, 730)),
+                "referencia": f"REF-{i:07d}",
+                "banco": rnd.choice(["Industrial", "BAM", "Banrural", "G&T"]),
+                "monto": _dinero(rnd.uniform(100, 20000)),
+                "asignado": rnd.random() < 0.6,
+                "cliente_id": rnd.randint(1, vol["clientes"]),
+            }
+            for i in range(1, vol["bancos"] + 1)
+        ],
+    )
+
+    # Ordenes de produccion con procesos y consumos.
+    bom_por_producto, comp_por_producto = {}, {}
+    for fila in bom_filas:
+        bom_por_producto.setdefault(fila["producto_id"], []).append(fila)
+    for fila in comp_filas:
+        comp_por_producto.setdefault(fila["producto_id"], []).append(fila)
+
+    ops, procesos_orden, consumos, consumos_comp = [], [], [], []
+    proceso_orden_id = 1
+    for i in range(1, vol["ordenes_produccion"] + 1):
+        producto_id = rnd.choice(finales)
+        planeada = Decimal(rnd.randint(50, 2000))
+        inicio = ahora - timedelta(
+            days=rnd.randint(0, 365), minutes=rnd.randint(0, 1440)
+        )
+        estado = rnd.choices(
+            ["PLANIFICADA", "EN_PROCESO", "COMPLETADA", "CANCELADA"],
+            weights=[10, 15, 70, 5],
+        )[0]
+        cursor = inicio
+        completados = 0
+        pasos = rutas[producto_id]
+        if estado == "COMPLETADA":
+            completados = len(pasos)
+        elif estado == "EN_PROCESO":
+            completados = rnd.randint(0, len(pasos) - 1)
+        entrada = planeada
+        for orden, proceso_id in enumerate(pasos, 1):
+            fila = {
+                "id": proceso_orden_id,
+                "orden_produccion_id": i,
+                "proceso_id": proceso_id,
+                "orden": orden,
+                "estado": "PENDIENTE",
+            }
+            if (
+                estado != "PLANIFICADA"
+                and orden <= completados + 1
+                and estado != "CANCELADA"
+            ):
+                duracion = timedelta(minutes=rnd.randint(10, 600))
+                perdida = Decimal(rnd.randint(0, int(entrada * Decimal("0.05")) + 1))
+                fila["inicio"] = cursor
+                if orden <= completados:
+                    fila.update(
+                        estado="COMPLETADO",
+                        fin=cursor + duracion,
+                        cantidad_entrada=entrada,
+                        cantidad_salida=entrada - perdida,
+                        cantidad_perdida=perdida,
+                        motivo_perdida=rnd.choice(MOTIVOS_PERDIDA) if perdida else None,
+                    )
+                    entrada -= perdida
+                else:
+                    fila["estado"] = "EN_PROCESO"
+                cursor += duracion
+            procesos_orden.append(fila)
+            if fila["estado"] == "COMPLETADO":
+                for bom in bom_por_producto.get(producto_id, []):
+                    if bom["proceso_id"] != proceso_id:
+                        continue
+                    teorico = (
+                        bom["cantidad_necesaria"] + bom["merma_estandar"]
+                    ) * planeada
+                    real = teorico * Decimal(str(round(rnd.uniform(0.95, 1.1), 4)))
+                    consumos.append(
+                        {
+                            "orden_produccion_id": i,
+                            "proceso_orden_id": proceso_orden_id,
+                            "materia_prima_id": bom["materia_prima_id"],
+                            "cantidad_teorica": teorico,
+                            "cantidad_real": real,
+                            "desperdicio": real - teorico,
+                        }
+                    )
+                for comp in comp_por_producto.get(producto_id, []):
+                    if comp["proceso_id"] != proceso_id:
+                        continue
+                    teorico = comp["cantidad_necesaria"] * planeada
+                    consumos_comp.append(
+                        {
+                            "orden_produccion_id": i,
+                            "proceso_orden_id": proceso_orden_id,
+                            "componente_id": comp["componente_id"],
+                            "cantidad_teorica": teorico,
+                            "cantidad_real": teorico,
+                            "desperdicio": Decimal("0"),
+                        }
+                    )
+            proceso_orden_id += 1
+        ops.append(
+            {
+                "id": i,
+                "codigo": f"OP-{i:07d}",
+                "producto_id": producto_id,
+                "cantidad_planeada": planeada,
+                "cantidad_final_buena": entrada if estado == "COMPLETADA" else None,
+                "estado": estado,
+                "fecha_inicio": inicio if estado != "PLANIFICADA" else None,
+                "fecha_fin": cursor if estado in ("COMPLETADA", "CANCELADA") else None,
+            }
+        )
+    _insertar(conn, OrdenProduccion, ops)
+    _insertar(conn, ProcesoOrden, procesos_orden)
+    _insertar(conn, ConsumoMateriaPrima, consumos)
+    _insertar(conn, ConsumoProductoComponente, consumos_comp)
+
+    return {
+        **vol,
+        "orden_items": len(items),
+        "procesos_orden": len(procesos_orden),
+        "consumos_materia_prima": len(consumos),
+        "consumos_componentes": len(consumos_comp),
+    }
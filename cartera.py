@@ -0,0 +1,202 @@
+"""Asignacion de bancos (pagos) a ordenes, independiente de Flask.
+
+asignar_pagos es la regla de _recalcular_cartera_cliente aplicada sobre
+instantaneas simples (dicts), de modo que puede ejecutarse sin sesion ORM:
+en la app, en simulaciones (dry run) y en procesos separados para el
+recalculo global (recalcular_particion).
+"""
+
+from datetime import date, timedelta
+from decimal import Decimal
+import re
+
+from sqlalchemy import bindparam, create_engine, select
+
+from models import Bancos, Orden, TipoPago
+
+CAMPOS_CARTERA = ("saldo", "estado_id", "fecha_pago")
+
+_engines = {}
+
+
+def dias_credito(nombre_tipo_pago) -> int:
+    if not nombre_tipo_pago:
+        return 0
+    match = re.search(r"\d+", nombre_tipo_pago)
+    return int(match.group()) if match else 0
+
+
+def _ordenar_para_abono(ordenes, today: date):
+    def _dias_restantes(orden) -> int:
+        fecha_base = orden["fecha_envio"] or orden["fecha"] or today
+        vencimiento = fecha_base + timedelta(days=orden["dias_credito"])
+        return (vencimiento - today).days
+
+    return sorted(
+        ordenes,
+        key=lambda orden: (
+            _dias_restantes(orden),
+            orden["fecha_envio"] or orden["fecha"] or date.min,
+            orden["id"],
+        ),
+    )
+
+
+def asignar_pagos(ordenes, bancos, today: date) -> dict:
+    """Reaplica los bancos a las ordenes de un cliente.
+
+    ordenes: dicts con id, total, saldo, estado_id, fecha, fecha_envio,
+    fecha_pago y dias_credito, ordenados por id. bancos: dicts con monto y
+    fecha, ordenados por fecha e id. Devuelve {orden_id: {saldo, estado_id,
+    fecha_pago}} con el estado resultante de todas las ordenes.
+    """
+    estado_anterior = {o["id"]: o["estado_id"] for o in ordenes}
+    fecha_pago_anterior = {o["id"]: o["fecha_pago"] for o in ordenes}
+
+    trabajo = []
+    for orden in ordenes:
+        copia = dict(orden)
+        copia["saldo"] = Decimal(str(orden["total"] or 0))
+        if copia["estado_id"] == 4:
+            copia["estado_id"] = 3
+        copia["fecha_pago"] = None
+        trabajo.append(copia)
+
+    for banco in bancos:
+        restante = Decimal(str(banco["monto"] or 0))
+        if restante <= 0:
+            continue
+
+        fecha_aplicacion = banco["fecha"] or today
+
+        pendientes = [
+            o
+            for o in trabajo
+            if Decimal(str(o["saldo"] or 0)) > 0 and o["estado_id"] != 4
+        ]
+        if not pendientes:
+            break
+
+        for orden in _ordenar_para_abono(pendientes, today):
+            if restante <= 0:
+                break
+            saldo_actual = Decimal(str(orden["saldo"] or 0))
+            if saldo_actual <= 0:
+                continue
+            aplicar = saldo_actual if saldo_actual <= restante else restante
+            nuevo_saldo = saldo_actual - aplicar
+            if nuevo_saldo <= 0:
+                orden["saldo"] = Decimal("0.00")
+                orden["estado_id"] = 4
+                if (
+                    estado_anterior.get(orden["id"]) == 4
+                    and fecha_pago_anterior.get(orden["id"]) is not None
+                ):
+                    orden["fecha_pago"] = fecha_pago_anterior.get(orden["id"])
+                else:
+                    orden["fecha_pago"] = fecha_aplicacion
+            else:
+                orden["saldo"] = nuevo_saldo
+            restante -= aplicar
+
+    return {o["id"]: {campo: o[campo] for campo in CAMPOS_CARTERA} for o in trabajo}
+
+
+def diferencias(ordenes, resultado) -> list:
+    """Ordenes cuyo saldo, estado_id o fecha_pago cambian con el resultado."""
+    cambios = []
+    for orden in ordenes:
+        nuevo = resultado[orden["id"]]
+        antes = {campo: orden[campo] for campo in CAMPOS_CARTERA}
+        antes["saldo"] = Decimal(str(antes["saldo"] or 0))
+        if antes != nuevo:
+            cambios.append({"orden_id": orden["id"], "antes": antes, "despues": nuevo})
+    return cambios
+
+
+def _engine(database_uri: str):
+    if database_uri not in _engines:
+        _engines[database_uri] = create_engine(database_uri)
+    return _engines[database_uri]
+
+
+def recalcular_particion(database_uri: str, cliente_ids, today_iso: str, aplicar: bool):
+    """Recalcula la cartera de un grupo de clientes en su propia conexion.
+
+    Pensada para ProcessPoolExecutor: carga ordenes y bancos asignados del
+    grupo con dos consultas, aplica asignar_pagos por cliente y, si aplicar,
+    escribe solo las ordenes que cambian con un UPDATE por lote. Devuelve
+    {cliente_id: [diferencias]} para los clientes con cambios.
+    """
+    today = date.fromisoformat(today_iso)
+    ordenes_t = Orden.__table__
+    bancos_t = Bancos.__table__
+    tipos_t = TipoPago.__table__
+
+    with _engine(database_uri).begin() as conn:
+        ordenes = {}
+        filas = conn.execute(
+            select(
+                ordenes_t.c.id,
+                ordenes_t.c.cliente_id,
+                ordenes_t.c.total,
+                ordenes_t.c.saldo,
+                ordenes_t.c.estado_id,
+                ordenes_t.c.fecha,
+                ordenes_t.c.fecha_envio,
+                ordenes_t.c.fecha_pago,
+                tipos_t.c.nombre.label("tipo_pago"),
+            )
+            .select_from(
+                ordenes_t.outerjoin(tipos_t, tipos_t.c.id == ordenes_t.c.tipo_pago_id)
+            )
+            .where(ordenes_t.c.cliente_id.in_(list(cliente_ids)))
+            .order_by(ordenes_t.c.cliente_id, ordenes_t.c.id)
+        )
+        for fila in filas.mappings():
+            orden = dict(fila)
+            orden["dias_credito"] = dias_credito(orden.pop("tipo_pago"))
+            ordenes.setdefault(orden.pop("cliente_id"), []).append(orden)
+
+        bancos = {}
+        filas = conn.execute(
+            select(bancos_t.c.cliente_id, bancos_t.c.monto, bancos_t.c.fecha)
+            .where(
+                bancos_t.c.cliente_id.in_(list(cliente_ids)),
+                bancos_t.c.asignado.is_(True),
+            )
+            .order_by(bancos_t.c.cliente_id, bancos_t.c.fecha, bancos_t.c.id)
+        )
+        for fila in filas.mappings():
+            bancos.setdefault(fila["cliente_id"], []).append(dict(fila))
+
+        cambios_por_cliente = {}
+        for cliente_id, ordenes_cliente in ordenes.items():
+            resultado = asignar_pagos(
+                ordenes_cliente, bancos.get(cliente_id, []), today
+            )
+            cambios = diferencias(ordenes_cliente, resultado)
+            if cambios:
+                cambios_por_cliente[cliente_id] = cambios
+
+        if aplicar and cambios_por_cliente:
+            conn.execute(
+                ordenes_t.update()
+                .where(ordenes_t.c.id == bindparam("b_id"))
+                .values(
+                    saldo=bindparam("b_saldo"),
+                    estado_id=bindparam("b_estado_id"),
+                    fecha_pago=bindparam("b_fecha_pago"),
+                ),
+                [
+                    {
+                        "b_id": cambio["orden_id"],
+                        "b_saldo": cambio["despues"]["saldo"],
+                        "b_estado_id": cambio["despues"]["estado_id"],
+                        "b_fecha_pago": cambio["despues"]["fecha_pago"],
+                    }
+                    for cambios in cambios_por_cliente.values()
+                    for cambio in cambios
+                ],
+            )
+    return cambios_por_cliente
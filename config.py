@@ -10,3 +10,18 @@ class Config:
     JSON_AS_ASCII = False  # para soportar bien acentos en JSON
     SECRET_KEY = os.getenv("SECRET_KEY", "dev_secret_key")
     URL_PREFIX = "/coproda"
+    FOTO_MINIATURA_PX = int(os.getenv("FOTO_MINIATURA_PX", "256"))
+    # Limite de cualquier request (incluye importaciones xlsx) y de cada foto, en bytes.
+    MAX_CONTENT_LENGTH = int(os.getenv("MAX_CONTENT_LENGTH", str(32 * 1024 * 1024)))
+    FOTO_MAX_BYTES = int(os.getenv("FOTO_MAX_BYTES", str(8 * 1024 * 1024)))
+    # Requests que superen cualquiera de estos limites se registran con sus consultas.
+    REQUEST_BUDGET_MS = float(os.getenv("REQUEST_BUDGET_MS", "1000"))
+    REQUEST_BUDGET_QUERIES = int(os.getenv("REQUEST_BUDGET_QUERIES", "50"))
+    # Hilos del pool que ejecuta los trabajos en segundo plano (ver trabajos.py).
+    TRABAJOS_WORKERS = int(os.getenv("TRABAJOS_WORKERS", "2"))
+    # Vigencia de las respuestas guardadas por Idempotency-Key (ver idempotencia.py).
+    IDEMPOTENCIA_TTL_HORAS = int(os.getenv("IDEMPOTENCIA_TTL_HORAS", "24"))
+    # Tiempo que una clave queda reservada mientras corre su request original.
+    IDEMPOTENCIA_RESERVA_SEGUNDOS = int(
+        os.getenv("IDEMPOTENCIA_RESERVA_SEGUNDOS", "300")
+    )
@@ -0,0 +1,208 @@
+"""Soporte del header Idempotency-Key para endpoints POST.
+
+Los clientes moviles reintentan los POST cuando vence el timeout. Con
+Idempotencia.idempotente, el primer request con una clave guarda su
+respuesta en claves_idempotencia y los reintentos con la misma clave (y el
+mismo cuerpo) reciben esa respuesta sin volver a ejecutar la vista.
+
+La vista corre en una transaccion externa y la respuesta se guarda en esa
+misma transaccion, asi el trabajo de la vista y la clave se confirman juntos.
+Mientras corre, la clave queda reservada por IDEMPOTENCIA_RESERVA_SEGUNDOS;
+si el proceso muere, un reintento posterior al vencimiento la reclama.
+
+Solo se guardan respuestas exitosas (< 400): ante un error la clave se libera
+para que el cliente pueda reintentar. Las claves vencen a las
+IDEMPOTENCIA_TTL_HORAS; las vencidas se purgan periodicamente y con el
+comando purgar-claves-idempotencia.
+"""
+
+from datetime import datetime, timedelta
+from functools import wraps
+import hashlib
+
+import click
+from flask import Response, jsonify, make_response, request
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from models import ClaveIdempotencia, db
+
+HEADER = "Idempotency-Key"
+LARGO_MAXIMO = 255
+# Intervalo minimo entre purgas automaticas de claves vencidas.
+INTERVALO_PURGA = timedelta(hours=1)
+
+
+class Idempotencia:
+    def __init__(self, app=None):
+        self.app = None
+        self.ttl = timedelta(hours=24)
+        self.reserva = timedelta(seconds=300)
+        self._proxima_purga = datetime.min
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.ttl = timedelta(hours=app.config.get("IDEMPOTENCIA_TTL_HORAS", 24))
+        self.reserva = timedelta(
+            seconds=app.config.get("IDEMPOTENCIA_RESERVA_SEGUNDOS", 300)
+        )
+        app.extensions["idempotencia"] = self
+
+        @app.cli.command("purgar-claves-idempotencia")
+        def purgar_claves_idempotencia():
+            """Elimina las claves de idempotencia vencidas."""
+            click.echo(f"Claves eliminadas: {self.purgar()}")
+
+    def purgar(self) -> int:
+        ahora = datetime.utcnow()
+        eliminadas = ClaveIdempotencia.query.filter(
+            ClaveIdempotencia.expira_en <= ahora
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        self._proxima_purga = ahora + INTERVALO_PURGA
+        return eliminadas
+
+    def idempotente(self, vista):
+        """Decorador para vistas POST que aceptan el header Idempotency-Key."""
+
+        @wraps(vista)
+        def envoltura(*args, **kwargs):
+            clave = (request.headers.get(HEADER) or "").strip()
+            if not clave:
+                return vista(*args, **kwargs)
+            if len(clave) > LARGO_MAXIMO:
+                mensaje = f"{HEADER} admite hasta {LARGO_MAXIMO} caracteres"
+                return jsonify({"error": mensaje}), 400
+
+            huella = _huella_request()
+            ahora = datetime.utcnow()
+            if ahora >= self._proxima_purga:
+                self.purgar()
+
+            registro = ClaveIdempotencia.query.filter_by(
+                clave=clave, endpoint=request.endpoint
+            ).first()
+            if registro is not None and registro.expira_en <= ahora:
+                # Clave vencida o reserva abandonada. El DELETE condicionado
+                # no borra una respuesta que se guardo mientras tanto.
+                borradas = ClaveIdempotencia.query.filter(
+                    ClaveIdempotencia.id == registro.id,
+                    ClaveIdempotencia.expira_en <= ahora,
+                ).delete(synchronize_session=False)
+                db.session.commit()
+                if not borradas:
+                    db.session.refresh(registro)
+                    return _respuesta_guardada(registro, huella)
+                registro = None
+            if registro is not None:
+                return _respuesta_guardada(registro, huella)
+
+            registro = ClaveIdempotencia(
+                clave=clave,
+                endpoint=request.endpoint,
+                huella=huella,
+                creado_en=ahora,
+                expira_en=ahora + self.reserva,
+            )
+            db.session.add(registro)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Otro request con la misma clave la reservo primero.
+                db.session.rollback()
+                return _en_proceso()
+            registro_id = registro.id
+
+            respuesta = self._ejecutar(vista, args, kwargs, registro_id)
+            if respuesta is None:
+                return _en_proceso()
+            if respuesta.status_code >= 400:
+                _liberar(registro_id)
+            return respuesta
+
+        return envoltura
+
+    def _ejecutar(self, vista, args, kwargs, registro_id):
+        """Corre la vista y guarda la respuesta en una sola transaccion.
+
+        La sesion de la vista se une a una transaccion externa: sus commit()
+        solo hacen flush y nada se confirma hasta guardar la respuesta.
+        Devuelve None si la reserva se perdio (vencio y otro request la
+        reclamo); en ese caso el trabajo de la vista se descarta.
+        """
+        original = db.session()
+        conexion = db.engine.connect()
+        transaccion = conexion.begin()
+        # Session de SQLAlchemy (no la de Flask-SQLAlchemy, que elige el
+        # engine por modelo e ignoraria la conexion).
+        sesion = Session(bind=conexion, join_transaction_mode="rollback_only")
+        db.session.registry.set(sesion)
+        try:
+            respuesta = make_response(vista(*args, **kwargs))
+            if respuesta.status_code >= 400:
+                # Las rutas de error no confirman nada de lo que dejaron.
+                transaccion.rollback()
+                return respuesta
+            sesion.flush()
+            guardada = conexion.execute(
+                update(ClaveIdempotencia)
+                .where(
+                    ClaveIdempotencia.id == registro_id,
+                    ClaveIdempotencia.status.is_(None),
+                )
+                .values(
+                    status=respuesta.status_code,
+                    cuerpo=respuesta.get_data(as_text=True),
+                    mimetype=respuesta.mimetype,
+                    expira_en=datetime.utcnow() + self.ttl,
+                )
+            )
+            if guardada.rowcount != 1:
+                transaccion.rollback()
+                return None
+            transaccion.commit()
+            return respuesta
+        except Exception:
+            if transaccion.is_active:
+                transaccion.rollback()
+            db.session.registry.set(original)
+            _liberar(registro_id)
+            raise
+        finally:
+            sesion.close()
+            conexion.close()
+            db.session.registry.set(original)
+
+
+def _huella_request() -> str:
+    digest = hashlib.sha256()
+    digest.update(request.method.encode())
+    digest.update(request.path.encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def _respuesta_guardada(registro: ClaveIdempotencia, huella: str):
+    if registro.huella != huella:
+        mensaje = f"{HEADER} ya se uso con un request distinto"
+        return jsonify({"error": mensaje}), 422
+    if registro.status is None:
+        return _en_proceso()
+    respuesta = Response(
+        registro.cuerpo, status=registro.status, mimetype=registro.mimetype
+    )
+    respuesta.headers["Idempotent-Replayed"] = "true"
+    return respuesta
+
+
+def _en_proceso():
+    mensaje = f"Hay un request en proceso con el mismo {HEADER}"
+    return jsonify({"error": mensaje}), 409
+
+
+def _liberar(registro_id: int):
+    ClaveIdempotencia.query.filter_by(id=registro_id).delete(synchronize_session=False)
+    db.session.commit()
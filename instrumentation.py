@@ -0,0 +1,221 @@
+"""Instrumentacion por request: consultas SQL, tiempo de BD y latencia.
+
+init_instrumentation(app) engancha eventos del engine de SQLAlchemy y los
+hooks de Flask. Cada respuesta lleva un header Server-Timing y /metrics
+expone los acumulados en formato de texto de Prometheus.
+"""
+
+import heapq
+import threading
+import time
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Limites superiores (segundos) del histograma de latencia.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Sentencias mas lentas que se guardan por request para el log de presupuesto.
+SENTENCIAS_MAX = 20
+
+_lock = threading.Lock()
+_por_ruta = {}
+_por_estado = {}
+_eventos_registrados = False
+
+
+def _antes_de_ejecutar(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and "_instr_inicio" in g:
+        pila = conn.info.setdefault("_instr_pila", [])
+        pila.append((id(context), time.perf_counter()))
+
+
+def _terminar_sentencia(conn, context, statement):
+    # Solo se saca el inicio apilado por esta misma ejecucion.
+    pila = conn.info.get("_instr_pila")
+    if not pila or pila[-1][0] != id(context):
+        return
+    duracion = time.perf_counter() - pila.pop()[1]
+    if not has_request_context() or "_instr_inicio" not in g:
+        return
+    g._instr_consultas += 1
+    g._instr_db += duracion
+    sentencias = g._instr_sentencias
+    if len(sentencias) < SENTENCIAS_MAX:
+        heapq.heappush(sentencias, (duracion, statement))
+    else:
+        heapq.heappushpop(sentencias, (duracion, statement))
+
+
+def _despues_de_ejecutar(conn, cursor, statement, parameters, context, executemany):
+    _terminar_sentencia(conn, context, statement)
+
+
+def _error_al_ejecutar(contexto):
+    # Una sentencia que falla no llega a after_cursor_execute.
+    if contexto.connection is not None:
+        _terminar_sentencia(
+            contexto.connection, contexto.execution_context, contexto.statement
+        )
+
+
+def _registrar_eventos():
+    global _eventos_registrados
+    if _eventos_registrados:
+        return
+    event.listen(Engine, "before_cursor_execute", _antes_de_ejecutar)
+    event.listen(Engine, "after_cursor_execute", _despues_de_ejecutar)
+    event.listen(Engine, "handle_error", _error_al_ejecutar)
+    _eventos_registrados = True
+
+
+def _acumular(metodo, ruta, estado, duracion, consultas, db_segundos):
+    with _lock:
+        agg = _por_ruta.get((metodo, ruta))
+        if agg is None:
+            agg = _por_ruta[(metodo, ruta)] = {
+                "buckets": [0] * len(BUCKETS),
+                "count": 0,
+                "sum": 0.0,
+                "consultas": 0,
+                "db": 0.0,
+            }
+        agg["count"] += 1
+        agg["sum"] += duracion
+        agg["consultas"] += consultas
+        agg["db"] += db_segundos
+        for i, limite in enumerate(BUCKETS):
+            if duracion <= limite:
+                agg["buckets"][i] += 1
+        clave = (metodo, ruta, estado)
+        _por_estado[clave] = _por_estado.get(clave, 0) + 1
+
+
+def _etiquetas(**valores) -> str:
+    partes = []
+    for nombre, valor in valores.items():
+        valor = str(valor).replace("\\", "\\\\").replace('"', '\\"')
+        partes.append(f'{nombre}="{valor}"')
+    return "{" + ",".join(partes) + "}"
+
+
+def render_metrics() -> str:
+    lineas = [
+        "# HELP coproda_http_requests_total Requests atendidos.",
+        "# TYPE coproda_http_requests_total counter",
+    ]
+    with _lock:
+        por_ruta = {
+            k: dict(v, buckets=list(v["buckets"])) for k, v in _por_ruta.items()
+        }
+        por_estado = dict(_por_estado)
+
+    for (metodo, ruta, estado), total in sorted(por_estado.items()):
+        etiquetas = _etiquetas(method=metodo, route=ruta, status=estado)
+        lineas.append(f"coproda_http_requests_total{etiquetas} {total}")
+
+    lineas += [
+        "# HELP coproda_http_request_duration_seconds Latencia del handler.",
+        "# TYPE coproda_http_request_duration_seconds histogram",
+    ]
+    for (metodo, ruta), agg in sorted(por_ruta.items()):
+        for limite, conteo in zip(BUCKETS, agg["buckets"]):
+            etiquetas = _etiquetas(method=metodo, route=ruta, le=limite)
+            lineas.append(
+                f"coproda_http_request_duration_seconds_bucket{etiquetas} {conteo}"
+            )
+        etiquetas = _etiquetas(method=metodo, route=ruta, le="+Inf")
+        lineas.append(
+            f"coproda_http_request_duration_seconds_bucket{etiquetas} {agg['count']}"
+        )
+        etiquetas = _etiquetas(method=metodo, route=ruta)
+        lineas.append(
+            f"coproda_http_request_duration_seconds_sum{etiquetas} {agg['sum']:.6f}"
+        )
+        lineas.append(
+            f"coproda_http_request_duration_seconds_count{etiquetas} {agg['count']}"
+        )
+
+    lineas += [
+        "# HELP coproda_db_queries_total Sentencias SQL ejecutadas.",
+        "# TYPE coproda_db_queries_total counter",
+    ]
+    for (metodo, ruta), agg in sorted(por_ruta.items()):
+        etiquetas = _etiquetas(method=metodo, route=ruta)
+        lineas.append(f"coproda_db_queries_total{etiquetas} {agg['consultas']}")
+
+    lineas += [
+        "# HELP coproda_db_time_seconds_total Tiempo acumulado en la base de datos.",
+        "# TYPE coproda_db_time_seconds_total counter",
+    ]
+    for (metodo, ruta), agg in sorted(por_ruta.items()):
+        etiquetas = _etiquetas(method=metodo, route=ruta)
+        lineas.append(f"coproda_db_time_seconds_total{etiquetas} {agg['db']:.6f}")
+
+    return "\n".join(lineas) + "\n"
+
+
+def init_instrumentation(app):
+    _registrar_eventos()
+
+    @app.before_request
+    def _instr_iniciar():
+        g._instr_inicio = time.perf_counter()
+        g._instr_consultas = 0
+        g._instr_db = 0.0
+        g._instr_sentencias = []
+
+    def _instr_registrar(estado):
+        g._instr_registrado = True
+        duracion = time.perf_counter() - g._instr_inicio
+        ruta = request.url_rule.rule if request.url_rule else "<sin_ruta>"
+        _acumular(
+            request.method, ruta, estado, duracion, g._instr_consultas, g._instr_db
+        )
+        return duracion
+
+    @app.after_request
+    def _instr_finalizar(response):
+        if "_instr_inicio" not in g:
+            return response
+        duracion = _instr_registrar(response.status_code)
+        consultas = g._instr_consultas
+        db_segundos = g._instr_db
+
+        response.headers.add(
+            "Server-Timing",
+            f'db;dur={db_segundos * 1000:.2f};desc="{consultas} consultas", '
+            f"app;dur={duracion * 1000:.2f}",
+        )
+
+        limite_ms = app.config.get("REQUEST_BUDGET_MS")
+        limite_consultas = app.config.get("REQUEST_BUDGET_QUERIES")
+        excede_tiempo = limite_ms is not None and duracion * 1000 > limite_ms
+        excede_consultas = limite_consultas is not None and consultas > limite_consultas
+        if excede_tiempo or excede_consultas:
+            detalle = "\n".join(
+                f"  {d * 1000:8.2f} ms  {sql}"
+                for d, sql in sorted(g._instr_sentencias, reverse=True)
+            )
+            app.logger.warning(
+                "Request fuera de presupuesto: %s %s %.1f ms, %d consultas (%.1f ms BD)"
+                "; las %d mas lentas:\n%s",
+                request.method,
+                request.path,
+                duracion * 1000,
+                consultas,
+                db_segundos * 1000,
+                len(g._instr_sentencias),
+                detalle,
+            )
+        return response
+
+    @app.teardown_request
+    def _instr_excepcion(exc):
+        # Las excepciones no manejadas pueden saltarse after_request.
+        if exc is not None and "_instr_inicio" in g and "_instr_registrado" not in g:
+            _instr_registrar(500)
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
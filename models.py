@@ -1,11 +1,27 @@
 from datetime import datetime
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Numeric
+from sqlalchemy import DDL, Numeric, event
 from werkzeug.security import check_password_hash, generate_password_hash
 
 db = SQLAlchemy()
 
+# Los indices de busqueda (trigramas) requieren pg_trgm en Postgres.
+event.listen(
+    db.metadata,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
+
+
+def _indice_trigramas(tabla: str, columna: str):
+    return db.Index(
+        f"ix_{tabla}_{columna}_trgm",
+        columna,
+        postgresql_using="gin",
+        postgresql_ops={columna: "gin_trgm_ops"},
+    )
+
 
 class CategoriaProducto(db.Model):
     __tablename__ = "categorias_producto"
@@ -24,12 +40,35 @@ class CategoriaProducto(db.Model):
         return f"<CategoriaProducto {self.nombre}>"
 
 
+class FotoProducto(db.Model):
+    """Imagen de producto direccionada por contenido (sha256 del original)."""
+
+    __tablename__ = "fotos_producto"
+
+    id = db.Column(db.Integer, primary_key=True)
+    hash = db.Column(db.String(64), unique=True, nullable=False, index=True)
+    mimetype = db.Column(db.String(50), nullable=False)
+    contenido = db.deferred(db.Column(db.LargeBinary, nullable=False))
+    miniatura_mimetype = db.Column(db.String(50), nullable=False)
+    miniatura = db.deferred(db.Column(db.LargeBinary, nullable=False))
+    creado_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self) -> str:
+        return f"<FotoProducto {self.hash[:12]}>"
+
+
 class Producto(db.Model):
     __tablename__ = "productos"
+    __table_args__ = (
+        _indice_trigramas("productos", "nombre"),
+        _indice_trigramas("productos", "codigo"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(150), nullable=False)
-    foto = db.Column(db.Text)
+    # Legado: URL externa o data URI. Las fotos nuevas viven en fotos_producto.
+    foto = db.deferred(db.Column(db.Text))
+    foto_id = db.Column(db.Integer, db.ForeignKey("fotos_producto.id"))
     codigo = db.Column(db.String(50), unique=True, nullable=False, index=True)
     categoria_id = db.Column(
         db.Integer, db.ForeignKey("categorias_producto.id"), nullable=False
@@ -53,6 +92,7 @@ class Producto(db.Model):
     )
 
     categoria = db.relationship("CategoriaProducto", back_populates="productos")
+    foto_archivo = db.relationship("FotoProducto", lazy="joined")
     bom_items = db.relationship(
         "ProductoMateriaPrima", back_populates="producto", lazy="dynamic"
     )
@@ -84,6 +124,10 @@ class Producto(db.Model):
 
 class Cliente(db.Model):
     __tablename__ = "clientes"
+    __table_args__ = (
+        _indice_trigramas("clientes", "nombre"),
+        _indice_trigramas("clientes", "codigo"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     codigo = db.Column(db.String(50), unique=True, nullable=False, index=True)
@@ -107,8 +151,64 @@ class Cliente(db.Model):
         return f"<Cliente {self.codigo}>"
 
 
+class ListaPrecio(db.Model):
+    """Lista de precios vigente por fechas, de una clasificacion o un cliente.
+
+    Exactamente uno de clasificacion (cf, minorista, mayorista) o cliente_id.
+    """
+
+    __tablename__ = "listas_precio"
+
+    id = db.Column(db.Integer, primary_key=True)
+    nombre = db.Column(db.String(150), nullable=False)
+    clasificacion = db.Column(db.String(20))
+    cliente_id = db.Column(db.Integer, db.ForeignKey("clientes.id"), index=True)
+    vigente_desde = db.Column(db.Date, default=datetime.utcnow, nullable=False)
+    vigente_hasta = db.Column(db.Date)
+    activo = db.Column(db.Boolean, default=True, nullable=False)
+    creado_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    actualizado_en = db.Column(
+        db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False
+    )
+
+    items = db.relationship("ListaPrecioItem", back_populates="lista", lazy="dynamic")
+
+    def __repr__(self) -> str:
+        return f"<ListaPrecio {self.nombre}>"
+
+
+class ListaPrecioItem(db.Model):
+    __tablename__ = "lista_precio_items"
+    __table_args__ = (
+        db.UniqueConstraint("lista_id", "producto_id", name="uq_lista_precio_producto"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    lista_id = db.Column(
+        db.Integer, db.ForeignKey("listas_precio.id"), nullable=False, index=True
+    )
+    producto_id = db.Column(db.Integer, db.ForeignKey("productos.id"), nullable=False)
+    precio = db.Column(Numeric(12, 2), nullable=False)
+    creado_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    actualizado_en = db.Column(
+        db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False
+    )
+
+    lista = db.relationship("ListaPrecio", back_populates="items")
+    producto = db.relationship("Producto")
+
+    def __repr__(self) -> str:
+        return f"<ListaPrecioItem {self.lista_id} {self.producto_id}>"
+
+
 class Bancos(db.Model):
     __tablename__ = "bancos"
+    __table_args__ = (
+        # _recalcular_cartera_cliente: cliente + asignado, ordenado por fecha, id.
+        db.Index(
+            "ix_bancos_cliente_asignado_fecha", "cliente_id", "asignado", "fecha", "id"
+        ),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     fecha = db.Column(db.Date, default=datetime.utcnow, nullable=False)
@@ -129,6 +229,35 @@ class Bancos(db.Model):
         return f"<Bancos {self.referencia}>"
 
 
+class CarteraVencimiento(db.Model):
+    """Saldo pendiente (ordenes en estado 3) por cliente y fecha limite de pago.
+
+    Se guarda la fecha limite y no el tramo de antiguedad para que las filas no
+    cambien con el paso de los dias; el tramo se calcula al consultar.
+    """
+
+    __tablename__ = "cartera_vencimientos"
+    __table_args__ = (
+        db.UniqueConstraint(
+            "cliente_id", "fecha_limite", name="uq_cartera_vencimiento_cliente_fecha"
+        ),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    cliente_id = db.Column(
+        db.Integer, db.ForeignKey("clientes.id"), nullable=False, index=True
+    )
+    fecha_limite = db.Column(db.Date, nullable=False)
+    saldo = db.Column(Numeric(14, 2), default=0, nullable=False)
+    ordenes = db.Column(db.Integer, default=0, nullable=False)
+    actualizado_en = db.Column(
+        db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False
+    )
+
+    def __repr__(self) -> str:
+        return f"<CarteraVencimiento {self.cliente_id} {self.fecha_limite}>"
+
+
 usuarios_permisos = db.Table(
     "usuarios_permisos",
     db.Column("usuario_id", db.Integer, db.ForeignKey("usuarios.id"), primary_key=True),
@@ -223,6 +352,14 @@ class EstadoOrden(db.Model):
 
 class Orden(db.Model):
     __tablename__ = "ordenes"
+    __table_args__ = (
+        # Abonos y cartera: cliente + estado + saldo pendiente.
+        db.Index(
+            "ix_ordenes_cliente_estado_saldo", "cliente_id", "estado_id", "saldo"
+        ),
+        # Listado y reporte Excel por rango de fechas.
+        db.Index("ix_ordenes_fecha_id", "fecha", "id"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     codigo_orden = db.Column(db.String(100), unique=True)
@@ -237,6 +374,8 @@ class Orden(db.Model):
     cliente_id = db.Column(db.Integer, db.ForeignKey("clientes.id"), nullable=False)
     total = db.Column(Numeric(12, 2), default=0, nullable=False)
     saldo = db.Column(Numeric(12, 2), default=0, nullable=False)
+    # total - saldo al entrar a la cartera: lo pagado antes del envio.
+    anticipo = db.Column(Numeric(12, 2), default=0, nullable=False)
     creado_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     actualizado_en = db.Column(
         db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False
@@ -256,7 +395,9 @@ class OrdenItem(db.Model):
     __tablename__ = "orden_items"
 
     id = db.Column(db.Integer, primary_key=True)
-    orden_id = db.Column(db.Integer, db.ForeignKey("ordenes.id"), nullable=False)
+    orden_id = db.Column(
+        db.Integer, db.ForeignKey("ordenes.id"), nullable=False, index=True
+    )
     producto_id = db.Column(db.Integer, db.ForeignKey("productos.id"), nullable=False)
     precio = db.Column(Numeric(12, 2), nullable=False, default=0)
     cantidad = db.Column(db.Integer, nullable=False, default=1)
@@ -272,6 +413,44 @@ class OrdenItem(db.Model):
         return f"<OrdenItem {self.id} Orden {self.orden_id}>"
 
 
+class EnvioOrden(db.Model):
+    """Envio parcial de una orden; las cantidades van en EnvioOrdenItem."""
+
+    __tablename__ = "envios_orden"
+
+    id = db.Column(db.Integer, primary_key=True)
+    orden_id = db.Column(
+        db.Integer, db.ForeignKey("ordenes.id"), nullable=False, index=True
+    )
+    fecha = db.Column(db.Date, default=datetime.utcnow, nullable=False)
+    usuario_id = db.Column(db.Integer, db.ForeignKey("usuarios.id"))
+    creado_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    items = db.relationship("EnvioOrdenItem", back_populates="envio")
+
+    def __repr__(self) -> str:
+        return f"<EnvioOrden {self.id} Orden {self.orden_id}>"
+
+
+class EnvioOrdenItem(db.Model):
+    __tablename__ = "envio_orden_items"
+
+    id = db.Column(db.Integer, primary_key=True)
+    envio_id = db.Column(
+        db.Integer, db.ForeignKey("envios_orden.id"), nullable=False, index=True
+    )
+    orden_item_id = db.Column(
+        db.Integer, db.ForeignKey("orden_items.id"), nullable=False, index=True
+    )
+    cantidad = db.Column(db.Integer, nullable=False)
+
+    envio = db.relationship("EnvioOrden", back_populates="items")
+    orden_item = db.relationship("OrdenItem")
+
+    def __repr__(self) -> str:
+        return f"<EnvioOrdenItem {self.id} Envio {self.envio_id}>"
+
+
 class MateriaPrima(db.Model):
     __tablename__ = "materias_primas"
 
@@ -422,7 +601,7 @@ class OrdenProduccion(db.Model):
     cantidad_final_buena = db.Column(Numeric(12, 4))
     estado = db.Column(db.String(30), nullable=False, default="BORRADOR")
     fecha_inicio = db.Column(db.DateTime)
-    fecha_fin = db.Column(db.DateTime)
+    fecha_fin = db.Column(db.DateTime, index=True)
     prioridad = db.Column(db.String(20))
     notas = db.Column(db.Text)
     creado_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
@@ -451,6 +630,8 @@ class ProcesoOrden(db.Model):
         db.UniqueConstraint(
             "orden_produccion_id", "orden", name="uq_orden_proceso_orden"
         ),
+        # Reporte de ordenes atascadas: estado + inicio.
+        db.Index("ix_procesos_orden_estado_inicio", "estado", "inicio"),
     )
 
     id = db.Column(db.Integer, primary_key=True)
@@ -461,7 +642,7 @@ class ProcesoOrden(db.Model):
     orden = db.Column(db.Integer, nullable=False)
     estado = db.Column(db.String(30), nullable=False, default="PENDIENTE")
     inicio = db.Column(db.DateTime)
-    fin = db.Column(db.DateTime)
+    fin = db.Column(db.DateTime, index=True)
     cantidad_entrada = db.Column(Numeric(12, 4))
     cantidad_salida = db.Column(Numeric(12, 4))
     cantidad_perdida = db.Column(Numeric(12, 4))
@@ -489,6 +670,11 @@ class ProcesoOrden(db.Model):
 
 class ConsumoMateriaPrima(db.Model):
     __tablename__ = "consumos_materia_prima"
+    __table_args__ = (
+        db.Index(
+            "ix_consumos_mp_orden_materia", "orden_produccion_id", "materia_prima_id"
+        ),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     orden_produccion_id = db.Column(
@@ -519,6 +705,11 @@ class ConsumoMateriaPrima(db.Model):
 
 class ConsumoProductoComponente(db.Model):
     __tablename__ = "consumos_componentes_producto"
+    __table_args__ = (
+        db.Index(
+            "ix_consumos_comp_orden_componente", "orden_produccion_id", "componente_id"
+        ),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     orden_produccion_id = db.Column(
@@ -569,3 +760,108 @@ class MateriaPrimaAjuste(db.Model):
 
     def __repr__(self) -> str:
         return f"<MateriaPrimaAjuste {self.materia_prima_id} {self.tipo}>"
+
+
+class KpiProcesoDiario(db.Model):
+    """Acumulado diario de procesos completados por proceso y producto."""
+
+    __tablename__ = "kpi_proceso_diario"
+    __table_args__ = (
+        db.UniqueConstraint(
+            "fecha", "proceso_id", "producto_id", name="uq_kpi_proceso_diario"
+        ),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    fecha = db.Column(db.Date, nullable=False, index=True)
+    proceso_id = db.Column(db.Integer, db.ForeignKey("procesos.id"), nullable=False)
+    producto_id = db.Column(db.Integer, db.ForeignKey("productos.id"), nullable=False)
+    procesos_completados = db.Column(db.Integer, default=0, nullable=False)
+    duracion_total_min = db.Column(Numeric(14, 2), default=0, nullable=False)
+    duracion_max_min = db.Column(Numeric(14, 2))
+    cantidad_entrada = db.Column(Numeric(14, 4), default=0, nullable=False)
+    cantidad_salida = db.Column(Numeric(14, 4), default=0, nullable=False)
+    cantidad_perdida = db.Column(Numeric(14, 4), default=0, nullable=False)
+    costo_teorico = db.Column(Numeric(16, 4), default=0, nullable=False)
+    costo_real = db.Column(Numeric(16, 4), default=0, nullable=False)
+    actualizado_en = db.Column(
+        db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False
+    )
+
+    def __repr__(self) -> str:
+        return f"<KpiProcesoDiario {self.fecha} {self.proceso_id}-{self.producto_id}>"
+
+
+class KpiProductoDiario(db.Model):
+    """Acumulado diario de ordenes de produccion cerradas por producto."""
+
+    __tablename__ = "kpi_producto_diario"
+    __table_args__ = (
+        db.UniqueConstraint("fecha", "producto_id", name="uq_kpi_producto_diario"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    fecha = db.Column(db.Date, nullable=False, index=True)
+    producto_id = db.Column(db.Integer, db.ForeignKey("productos.id"), nullable=False)
+    ordenes_cerradas = db.Column(db.Integer, default=0, nullable=False)
+    cantidad_planeada = db.Column(Numeric(14, 4), default=0, nullable=False)
+    cantidad_final_buena = db.Column(Numeric(14, 4), default=0, nullable=False)
+    duracion_total_min = db.Column(Numeric(14, 2), default=0, nullable=False)
+    costo_teorico = db.Column(Numeric(16, 4), default=0, nullable=False)
+    costo_real = db.Column(Numeric(16, 4), default=0, nullable=False)
+    actualizado_en = db.Column(
+        db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False
+    )
+
+    def __repr__(self) -> str:
+        return f"<KpiProductoDiario {self.fecha} {self.producto_id}>"
+
+
+class Trabajo(db.Model):
+    """Trabajo en segundo plano (reportes, recalculos, importaciones)."""
+
+    __tablename__ = "trabajos"
+    __table_args__ = (db.Index("ix_trabajos_estado_creado", "estado", "creado_en"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(80), nullable=False)
+    estado = db.Column(db.String(20), nullable=False, default="PENDIENTE")
+    parametros = db.Column(db.JSON)
+    resultado = db.Column(db.JSON)
+    error = db.Column(db.Text)
+    archivo = db.deferred(db.Column(db.LargeBinary))
+    archivo_nombre = db.Column(db.String(255))
+    archivo_mimetype = db.Column(db.String(150))
+    creado_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    iniciado_en = db.Column(db.DateTime)
+    finalizado_en = db.Column(db.DateTime)
+
+    def __repr__(self) -> str:
+        return f"<Trabajo {self.id} {self.tipo} {self.estado}>"
+
+
+class ClaveIdempotencia(db.Model):
+    """Respuesta guardada para un Idempotency-Key (ver idempotencia.py)."""
+
+    __tablename__ = "claves_idempotencia"
+    __table_args__ = (
+        db.UniqueConstraint(
+            "clave", "endpoint", name="uq_claves_idempotencia_clave_endpoint"
+        ),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    clave = db.Column(db.String(255), nullable=False)
+    endpoint = db.Column(db.String(120), nullable=False)
+    # sha256 del metodo, la ruta y el cuerpo del request original.
+    huella = db.Column(db.String(64), nullable=False)
+    # NULL mientras el request original se esta ejecutando.
+    status = db.Column(db.Integer)
+    cuerpo = db.Column(db.Text)
+    mimetype = db.Column(db.String(100))
+    creado_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    # Con status NULL es el vencimiento de la reserva; luego, el de la respuesta.
+    expira_en = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self) -> str:
+        return f"<ClaveIdempotencia {self.endpoint} {self.clave}>"
@@ -0,0 +1,175 @@
+"""Cola de trabajos en segundo plano sin broker externo.
+
+Los trabajos se guardan en la tabla trabajos y se ejecutan en un
+ThreadPoolExecutor del mismo proceso. Cada tipo de trabajo se registra con
+ColaTrabajos.tarea y recibe sus parametros (dict JSON); puede devolver un
+dict, que queda en Trabajo.resultado, o un ArchivoTrabajo para descargar.
+
+Un trabajo lo ejecuta el proceso que lo encolo; si ese proceso termina antes
+de finalizarlo, el trabajo queda en PENDIENTE o EN_PROCESO.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
+
+from flask import jsonify, request, send_file, url_for
+
+from models import Trabajo, db
+
+ArchivoTrabajo = namedtuple("ArchivoTrabajo", "contenido nombre mimetype")
+
+ESTADOS = ("PENDIENTE", "EN_PROCESO", "COMPLETADO", "ERROR")
+
+
+def trabajo_to_dict(trabajo: Trabajo) -> dict:
+    return {
+        "id": trabajo.id,
+        "tipo": trabajo.tipo,
+        "estado": trabajo.estado,
+        "parametros": trabajo.parametros,
+        "resultado": trabajo.resultado,
+        "error": trabajo.error,
+        "archivo_nombre": trabajo.archivo_nombre,
+        "archivo_url": (
+            url_for("descargar_archivo_trabajo", trabajo_id=trabajo.id)
+            if trabajo.archivo_nombre
+            else None
+        ),
+        "creado_en": trabajo.creado_en.isoformat() if trabajo.creado_en else None,
+        "iniciado_en": trabajo.iniciado_en.isoformat() if trabajo.iniciado_en else None,
+        "finalizado_en": (
+            trabajo.finalizado_en.isoformat() if trabajo.finalizado_en else None
+        ),
+    }
+
+
+class ColaTrabajos:
+    def __init__(self, app=None):
+        self.tareas = {}
+        self.app = None
+        self._executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self._executor = ThreadPoolExecutor(
+            max_workers=app.config.get("TRABAJOS_WORKERS", 2),
+            thread_name_prefix="trabajo",
+        )
+        app.extensions["trabajos"] = self
+        _registrar_rutas(app, self)
+
+    def tarea(self, tipo: str):
+        """Decorador que registra la funcion que ejecuta los trabajos de un tipo."""
+
+        def registrar(funcion):
+            self.tareas[tipo] = funcion
+            return funcion
+
+        return registrar
+
+    def encolar(self, tipo: str, parametros: dict = None) -> Trabajo:
+        """Guarda el trabajo (hace commit) y lo envia al pool."""
+        if tipo not in self.tareas:
+            raise LookupError(f"Tipo de trabajo desconocido: {tipo}")
+        trabajo = Trabajo(tipo=tipo, estado="PENDIENTE", parametros=parametros or {})
+        db.session.add(trabajo)
+        db.session.commit()
+        self._executor.submit(self._ejecutar, trabajo.id)
+        return trabajo
+
+    def _ejecutar(self, trabajo_id: int):
+        with self.app.app_context():
+            # El UPDATE condicional evita que un trabajo se ejecute dos veces.
+            tomado = Trabajo.query.filter_by(id=trabajo_id, estado="PENDIENTE").update(
+                {"estado": "EN_PROCESO", "iniciado_en": datetime.utcnow()},
+                synchronize_session=False,
+            )
+            db.session.commit()
+            if not tomado:
+                return
+            trabajo = Trabajo.query.get(trabajo_id)
+            try:
+                resultado = self.tareas[trabajo.tipo](dict(trabajo.parametros or {}))
+            except Exception as exc:
+                db.session.rollback()
+                self.app.logger.exception(
+                    "Trabajo %s (%s) fallo", trabajo_id, trabajo.tipo
+                )
+                trabajo = Trabajo.query.get(trabajo_id)
+                trabajo.estado = "ERROR"
+                trabajo.error = str(exc) or exc.__class__.__name__
+            else:
+                trabajo = Trabajo.query.get(trabajo_id)
+                if isinstance(resultado, ArchivoTrabajo):
+                    trabajo.archivo = resultado.contenido
+                    trabajo.archivo_nombre = resultado.nombre
+                    trabajo.archivo_mimetype = resultado.mimetype
+                else:
+                    trabajo.resultado = resultado
+                trabajo.estado = "COMPLETADO"
+            trabajo.finalizado_en = datetime.utcnow()
+            db.session.commit()
+            db.session.remove()
+
+
+def respuesta_encolado(trabajo: Trabajo):
+    """Respuesta 202 estandar para endpoints con ?asincrono=true."""
+    resp = jsonify(trabajo_to_dict(trabajo))
+    resp.status_code = 202
+    resp.headers["Location"] = url_for("obtener_trabajo", trabajo_id=trabajo.id)
+    return resp
+
+
+def _registrar_rutas(app, cola: ColaTrabajos):
+    @app.route("/trabajos", methods=["GET"])
+    def listar_trabajos():
+        q = Trabajo.query
+        estado = (request.args.get("estado") or "").strip().upper()
+        if estado:
+            if estado not in ESTADOS:
+                return jsonify({"error": "estado inválido"}), 400
+            q = q.filter(Trabajo.estado == estado)
+        tipo = (request.args.get("tipo") or "").strip()
+        if tipo:
+            q = q.filter(Trabajo.tipo == tipo)
+        trabajos = q.order_by(Trabajo.id.desc()).limit(100).all()
+        return jsonify([trabajo_to_dict(t) for t in trabajos])
+
+    @app.route("/trabajos", methods=["POST"])
+    def crear_trabajo():
+        data = request.get_json(silent=True) or {}
+        tipo = (data.get("tipo") or "").strip()
+        if not tipo:
+            return jsonify({"error": "tipo es requerido"}), 400
+        parametros = data.get("parametros") or {}
+        if not isinstance(parametros, dict):
+            return jsonify({"error": "parametros debe ser un objeto"}), 400
+        try:
+            trabajo = cola.encolar(tipo, parametros)
+        except LookupError as exc:
+            return jsonify({"error": str(exc)}), 400
+        return respuesta_encolado(trabajo)
+
+    @app.route("/trabajos/<int:trabajo_id>", methods=["GET"])
+    def obtener_trabajo(trabajo_id: int):
+        return jsonify(trabajo_to_dict(Trabajo.query.get_or_404(trabajo_id)))
+
+    @app.route("/trabajos/<int:trabajo_id>/archivo", methods=["GET"])
+    def descargar_archivo_trabajo(trabajo_id: int):
+        trabajo = Trabajo.query.get_or_404(trabajo_id)
+        if trabajo.estado == "ERROR":
+            return jsonify({"error": "El trabajo terminó con error"}), 409
+        if trabajo.estado != "COMPLETADO":
+            return jsonify({"error": "El trabajo no ha terminado"}), 409
+        if not trabajo.archivo_nombre:
+            return jsonify({"error": "El trabajo no genero archivo"}), 404
+        return send_file(
+            BytesIO(trabajo.archivo),
+            mimetype=trabajo.archivo_mimetype,
+            as_attachment=True,
+            download_name=trabajo.archivo_nombre,
+        )